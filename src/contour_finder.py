@@ -1,6 +1,16 @@
 import numpy as np
-import math
+import cv2
+import copy
+import weakref
 import tools
+from collections import OrderedDict
+from contour_optimizers import make_optimizer, GradientAscentOptimizer, AdamOptimizer
+
+# Maximum number of images (e.g. the levels of an image pyramid) for which the derivative images are kept in memory
+_MAX_CACHED_DERIVATIVE_IMAGES = 8
+
+# Maximum number of contours for which the score samples are kept in memory
+_MAX_CACHED_SCORE_SAMPLES = 1024
 
 class ContourFinder:
 
@@ -10,9 +20,28 @@ class ContourFinder:
         self.gradient_step_size = 5e-3
         self.edge_sample_distance = 50.0
         self.vertex_distance_threshold = 0.5
+        self.analytic_gradient = False
+        self.optimizer = GradientAscentOptimizer.NAME  # the NAME of one of the optimizers in contour_optimizers.OPTIMIZERS
+        self.adam_step_size = 1.0  # in pixels (only used by the Adam optimizer)
         self.verbose = False
 
-    def set_optimization_parameters(self, h_for_gradient_approximation, max_iterations, vertex_distance_threshold, gradient_step_size, edge_sample_distance, verbose):
+        # Statistics for each iteration of the most recent contour optimization, and the number of score and
+        # gradient evaluations (shared with scaled copies of the contour finder, see _scaled_copy())
+        self.convergence_statistics = []
+        self._evaluation_counts = {'scores': 0, 'gradients': 0}
+
+        # Cached x and y derivative images of the most recently used preprocessed overview images (for the analytic gradient);
+        # a list of (image, (dx_image, dy_image)) pairs, most recently used first
+        self._derivative_images = []
+
+        # Cached score samples of recently scored contours, so that for example the scores of an optimized contour
+        # need not be resampled when it is used as template during ribbon building.
+        # An ordered dictionary (id(image), edge_sample_distance, contour coordinates) -> (weak reference to the image, score samples),
+        # least recently used first. (The weak reference is used to check that the id was not reused by another image,
+        # without keeping a replaced image in memory.)
+        self._score_cache = OrderedDict()
+
+    def set_optimization_parameters(self, h_for_gradient_approximation, max_iterations, vertex_distance_threshold, gradient_step_size, edge_sample_distance, verbose, analytic_gradient=False, optimizer=GradientAscentOptimizer.NAME):
         """
         XXX
         :param h_for_gradient_approximation: step size h used for numeric gradient approximation: gradient = (f(x+h)-f(x)) / h
@@ -22,6 +51,10 @@ class ContourFinder:
         :param gradient_step_size: the distance to move along the gradient during each iteration of gradient descent
         :param edge_sample_distance: XXX
         :param verbose: XXX
+        :param analytic_gradient: if True the gradient of the contour score is calculated analytically from precomputed
+               image derivatives; if False it is approximated with finite differences (slower, but useful for validation)
+        :param optimizer: the NAME of the optimizer to use (see contour_optimizers.OPTIMIZERS); for the optimizers
+               other than Adam, gradient_step_size is the (initial) step size
         """
         self.h_for_gradient_approximation = h_for_gradient_approximation
         self.max_iterations = max_iterations
@@ -29,47 +62,175 @@ class ContourFinder:
         self.gradient_step_size = gradient_step_size
         self.edge_sample_distance = edge_sample_distance
         self.verbose = verbose
+        self.analytic_gradient = analytic_gradient
+        self.optimizer = optimizer
 
-    def optimize_contour(self, image, initial_contour):
+    def clear_caches(self):
+        """
+        Forgets the cached derivative images and score samples, so the images they refer to can be freed,
+        e.g. when a new preprocessed overview image replaces the old one.
+        """
+        # Note: the caches are cleared in place, because they are shared with the scaled copies of this contour finder.
+        del self._derivative_images[:]
+        self._score_cache.clear()
+
+    def optimize_contour(self, image, initial_contour, pyramid=None, return_edge_scores=False):
         """
         :param image: preprocessed overview image with the ribbons of slices
         :param initial_contour: list of (x,y) vertex coordinates
-        :return: optimized contour, as list of (x,y) vertex coordinates
+        :param pyramid: optional image pyramid of the preprocessed overview image, as returned by build_image_pyramid();
+               if it has more than one level the contour is optimized coarse-to-fine, starting at the coarsest level
+        :param return_edge_scores: if True, the score of each edge of the optimized contour is returned as well
+        :return: optimized contour, as list of (x,y) vertex coordinates;
+                 or, if return_edge_scores is True, a tuple (optimized contour, list with the n edge scores)
         """
+        if return_edge_scores:
+            contours, edge_scores = self.optimize_contours(image, [initial_contour], pyramid, return_edge_scores)
+            return contours[0], edge_scores[0]
+        return self.optimize_contours(image, [initial_contour], pyramid)[0]
 
+    def optimize_contours(self, image, initial_contours, pyramid=None, return_edge_scores=False):
+        """
+        Optimizes many contours at once. This is equivalent to calling optimize_contour() on each contour in turn,
+        but the contours are stacked into a single array and their gradients are calculated with a single batched
+        image sampling call per iteration. Contours that have converged are masked out of further iterations.
+        Afterwards, self.convergence_statistics holds a list with statistics for each iteration.
+
+        :param image: preprocessed overview image with the ribbons of slices
+        :param initial_contours: list of contours, each a list of (x,y) vertex coordinates; all contours must have the same number of vertices
+        :param pyramid: optional image pyramid of the preprocessed overview image (see optimize_contour())
+        :param return_edge_scores: if True, the edge scores of the optimized contours are returned as well
+        :return: list with the optimized contours, each as list of (x,y) vertex coordinates;
+                 or, if return_edge_scores is True, a tuple (optimized contours, list with for each contour a list with its n edge scores)
+        """
+        self.convergence_statistics = []
+
+        contour_vectors = np.array([contour_to_vector(contour) for contour in initial_contours])  # k x 2n
+        if len(contour_vectors) > 0:
+            if pyramid is not None and len(pyramid) > 1:
+                contour_vectors = self._optimize_contour_vectors_coarse_to_fine(pyramid, contour_vectors)
+            else:
+                contour_vectors = self._optimize_contour_vectors(image, contour_vectors)
+
+        contours = [vector_to_contour(contour_vector) for contour_vector in contour_vectors]
+
+        # The score samples of the optimized contours are calculated (in one batch) and cached, so they can be reused later.
+        score_samples = self._calculate_and_cache_score_samples(image, contour_vectors)
+        if return_edge_scores:
+            return contours, [_edge_scores(contour_samples) for contour_samples in score_samples]
+        return contours
+
+    def _optimize_contour_vectors(self, image, contour_vectors):
+        """
+        Optimizes contours at the resolution of the given image.
+        :param image: preprocessed overview image (or a level of its image pyramid)
+        :param contour_vectors: a k x 2n numpy array with the initial contours; each row is the vector representation [x1, y1, ..., xn, yn] of a contour
+        :return: a k x 2n numpy array with the optimized contours
+        """
         # We are trying to maximize the score. The score is measured in the preprocessed overview image,
         # where edges are white (high intensity value = high score) and background black (low intensity value = low score).
         # So edge pixels in the preprocessed image score many points, background pixels few points.
 
-        iteration = 0
-        vertex_distance_change = 10 * self.vertex_distance_threshold  # 10 just to initialize to something larger than the initial threshold
-        previous_contour_vector = contour_to_vector(initial_contour)
+        contour_vectors = contour_vectors.copy()
+        active = np.ones(len(contour_vectors), dtype=bool)  # contours that did not converge yet
 
-        current_contour = initial_contour
-        current_contour_vector = contour_to_vector(current_contour)
+        if self.verbose:
+            initial_scores = self._calculate_total_contour_scores(image, contour_vectors)
 
-        while vertex_distance_change > self.vertex_distance_threshold and iteration < self.max_iterations:
-            gradient_vector = self._calculate_gradient(image, current_contour_vector)
-            current_contour_vector = current_contour_vector + self.gradient_step_size * gradient_vector   # we are looking for a maximum of the score, so we move along the positive gradient
-            if self.verbose:
-                print('Contour update: gradient step size={} pos update={}'.format(self.gradient_step_size, self.gradient_step_size * gradient_vector))
-                print('Iteration {} score={}'.format(iteration, self.calculate_total_contour_score(image, current_contour_vector)))
-            # note: the gradient points towards higher values of the function
-            vertex_distance_change = np.max(_vertex_distances(previous_contour_vector, current_contour_vector))
-            # print('   iteration={} change={}'.format(iteration, vertex_distance_change))
-            previous_contour_vector = current_contour_vector
+        optimizer = self._make_optimizer()
+        optimizer.start(*contour_vectors.shape)
+        score_function = lambda vectors: self._calculate_total_contour_scores(image, vectors)
+        gradient_function = lambda vectors: self._calculate_gradients(image, vectors)
+
+        iteration = 0
+        while np.any(active) and iteration < self.max_iterations:
+            previous_contour_vectors = contour_vectors[active]
+            current_contour_vectors = optimizer.step(score_function, gradient_function, previous_contour_vectors, np.flatnonzero(active))
+            contour_vectors[active] = current_contour_vectors
+
+            vertex_distance_changes = np.max(_vertex_distances(previous_contour_vectors, current_contour_vectors), axis=-1)
+            self._add_convergence_statistics(iteration, vertex_distance_changes)
+            active[np.flatnonzero(active)[vertex_distance_changes <= self.vertex_distance_threshold]] = False
             iteration += 1
 
         if self.verbose:
-            initial_score = self.calculate_total_contour_score(image, contour_to_vector(initial_contour))
-            final_score = self.calculate_total_contour_score(image, current_contour_vector)
-            print('Original score={} optimized score after {} iterations={} last max vertex displacement={}'.format(initial_score, iteration, final_score, vertex_distance_change))
+            final_scores = self._calculate_total_contour_scores(image, contour_vectors)
+            for i in range(len(contour_vectors)):
+                print('Contour {}: original score={} optimized score={}'.format(i, initial_scores[i], final_scores[i]))
+            print('Optimized {} contours in {} iterations, {} did not converge'.format(len(contour_vectors), iteration, np.sum(active)))
+
+        return contour_vectors
+
+    def _make_optimizer(self):
+        # Note: the Adam optimizer normalizes the gradient, so its step size is expressed in pixels.
+        step_size = self.adam_step_size if self.optimizer == AdamOptimizer.NAME else self.gradient_step_size
+        return make_optimizer(self.optimizer, step_size)
+
+    def _add_convergence_statistics(self, iteration, vertex_distance_changes):
+        statistics = {'iteration': iteration,
+                      'active_contours': len(vertex_distance_changes),
+                      'max_vertex_displacement': np.max(vertex_distance_changes),
+                      'mean_vertex_displacement': np.mean(vertex_distance_changes),
+                      'score_evaluations': self._evaluation_counts['scores'],  # cumulative number of contour scorings (also those for finite difference gradients)
+                      'gradient_evaluations': self._evaluation_counts['gradients']}  # cumulative number of contour gradient calculations
+        self.convergence_statistics.append(statistics)
+        if self.verbose:
+            print('Iteration {iteration}: {active_contours} active contour(s), max vertex displacement={max_vertex_displacement:.3f}, '
+                  '{score_evaluations} score evaluations, {gradient_evaluations} gradient evaluations'.format(**statistics))
 
-        return vector_to_contour(current_contour_vector)
+    def _optimize_contour_vectors_coarse_to_fine(self, pyramid, contour_vectors):
+        """
+        Optimizes contours first at the coarsest level of an image pyramid, and then refines them at each finer level.
+        At a level with scale s (s = 1/2 ** level), the contour coordinates and the edge sample distance are scaled by s.
+        The score gradient with respect to the scaled coordinates is 1/s times larger, so the gradient step size is scaled by s ** 2,
+        which makes a gradient step move the vertices as far (in full resolution pixels) as it would at full resolution.
+        The vertex distance threshold however is expressed in pixels of the level, so the optimization at the coarse (and smoother)
+        levels stops as soon as it gets near the edge, and only a few iterations are needed at the finer levels.
+
+        :param pyramid: image pyramid of the preprocessed overview image, as returned by build_image_pyramid()
+        :param contour_vectors: a k x 2n numpy array with the initial contours, in full resolution image coordinates
+        :return: a k x 2n numpy array with the optimized contours
+        """
+        for level in reversed(range(len(pyramid))):
+            scale = 0.5 ** level
+            level_finder = self._scaled_copy(scale)
+            level_finder.convergence_statistics = []
+            if self.verbose:
+                print('Optimizing at pyramid level {} (scale {})'.format(level, scale))
+            contour_vectors = level_finder._optimize_contour_vectors(pyramid[level], contour_vectors * scale) / scale
+            for statistics in level_finder.convergence_statistics:
+                statistics['level'] = level
+            self.convergence_statistics.extend(level_finder.convergence_statistics)
+        return contour_vectors
+
+    def _scaled_copy(self, scale):
+        """
+        Returns a (shallow) copy of this contour finder for optimizing contours in an image scaled by the given factor.
+        The copy shares the cached derivative images and score samples with this contour finder.
+        """
+        finder = copy.copy(self)
+        finder.edge_sample_distance = self.edge_sample_distance * scale
+        finder.gradient_step_size = self.gradient_step_size * scale ** 2
+        finder.adam_step_size = self.adam_step_size * scale  # in pixels
+        return finder
+
+    def _calculate_gradients(self, image, contour_vectors):
+        """
+        Returns the gradients of the contour score function of one or more contours, either calculated analytically
+        or estimated with finite differences, depending on self.analytic_gradient.
+        :param image: a preprocessed overview image
+        :param contour_vectors: a k x 2n numpy array; each row is the vector representation [x1, y1, ..., xn, yn] of a contour
+        :return: a k x 2n numpy array; each row is the gradient of the corresponding contour's score
+        """
+        self._evaluation_counts['gradients'] += len(contour_vectors)
+        if self.analytic_gradient:
+            return self._calculate_analytic_gradients(image, contour_vectors)
+        else:
+            return self._calculate_finite_difference_gradients(image, contour_vectors)
 
-    def _calculate_gradient(self, image, contour_vector):
+    def _calculate_finite_difference_gradients(self, image, contour_vectors):
         """
-        Returns an estimate of the gradient of the contour score function.
+        Returns an estimate of the gradient of the contour score function, for one or more contours.
         The gradient is approximated as (f(x+h) - f(x)) / h
         IMPROVEME? (f(x+h/2)-f(x-h/2))/h is a more accurate estimate
 
@@ -77,47 +238,141 @@ class ContourFinder:
         contour edges and low intensity for background and inside the sections,
         (ii) little noise and debris, (iii) an intensity profile that starts relatively "far" from edges and
         increases smoothly towards the edge center.
-        :param contour_vector: a numpy row vector representation [x1, y1, x2, y2, ..., xn, yn] of a contour
-        :return: a numpy row vector representation of the gradient of the contour's score;
+        :param contour_vectors: a k x 2n numpy array; each row is the vector representation [x1, y1, x2, y2, ..., xn, yn] of a contour
+        :return: a k x 2n numpy array; each row is the gradient of the corresponding contour's score;
                  for a quadrilateral slice contour this is [dscore/dx1, dscore/dy1, dscore/dx2, dscore/dy2,...,dscore/dx4, dscore/dy4]
         """
-        n = len(contour_vector)
+        k, n = contour_vectors.shape
         assert(n % 2 == 0)
 
         h = self.h_for_gradient_approximation
 
-        gradient = np.zeros(n, np.float)
-        contour_score = self.calculate_total_contour_score(image, contour_vector)
-        for i in range(0, n):
-            # Build displacement vector, it only displaces a single x or y coordinate
-            delta = np.zeros(n, np.float)
-            delta[i] = h
+        # For each contour, build the original contour plus n displaced contours, each displacing only a single x or y coordinate by h,
+        # and score all of them with a single batched image sampling call.
+        displacements = np.vstack((np.zeros(n), h * np.eye(n)))  # (n+1) x n
+        displaced_contour_vectors = contour_vectors[:, np.newaxis, :] + displacements[np.newaxis, :, :]  # k x (n+1) x n
+        scores = self._calculate_total_contour_scores(image, displaced_contour_vectors.reshape(-1, n)).reshape(k, n + 1)
 
-            # Calculate score if one endpoint is displaced slightly
-            dispaced_contour_score = self.calculate_total_contour_score(image, contour_vector + delta)
+        # Numerically estimate the gradient in each of the n directions
+        return (scores[:, 1:] - scores[:, :1]) / h
 
-            # Numerically estimate the gradient in the i-th direction
-            gradient[i] = (dispaced_contour_score - contour_score) / h
+    def _calculate_analytic_gradients(self, image, contour_vectors):
+        """
+        Calculates the gradient of the contour score function of one or more contours analytically.
+        A score sample at position p = v1 + t * (v2 - v1) on the edge v1-v2 contributes weight * (1 - t) * grad(image)(p)
+        to the gradient with respect to v1, and weight * t * grad(image)(p) to the gradient with respect to v2.
+        The image gradient is sampled from x and y derivative images that are calculated only once per image.
+        (The number of samples per edge, and hence the sample weights, are piecewise constant in the vertex positions,
+        so they do not contribute to the gradient.)
+
+        :param image: a preprocessed overview image
+        :param contour_vectors: a k x 2n numpy array; each row is the vector representation [x1, y1, ..., xn, yn] of a contour
+        :return: a k x 2n numpy array; each row is the gradient [dscore/dx1, dscore/dy1, ..., dscore/dxn, dscore/dyn] of the corresponding contour's score
+        """
+        k, n = contour_vectors.shape
+        dx_image, dy_image = self._get_derivative_images(image)
+        positions, weights, num_samples = _contour_sample_positions(contour_vectors, self.edge_sample_distance)
+        edge_index, i = _sample_indices(num_samples)
+        t = i / num_samples.ravel()[edge_index].astype(np.float64)
+
+        # Gradient of the score with respect to each sample position.
+        # Sample positions outside the image are clipped to the image boundary, so there the score does not change.
+        image_height, image_width = image.shape
+        dscore_dx = tools.sample_image_at_positions(dx_image, positions) * weights
+        dscore_dy = tools.sample_image_at_positions(dy_image, positions) * weights
+        dscore_dx[(positions[:, 0] < 0) | (positions[:, 0] > image_width - 1)] = 0
+        dscore_dy[(positions[:, 1] < 0) | (positions[:, 1] > image_height - 1)] = 0
+
+        # Distribute the sample gradients over the edge start and end vertices, and accumulate per vertex coordinate.
+        num_vertices = n // 2
+        contour_index = edge_index // num_vertices
+        start_vertex = contour_index * num_vertices + edge_index % num_vertices
+        end_vertex = contour_index * num_vertices + (edge_index + 1) % num_vertices
+        indices = np.concatenate((2 * start_vertex, 2 * start_vertex + 1, 2 * end_vertex, 2 * end_vertex + 1))
+        values = np.concatenate(((1 - t) * dscore_dx, (1 - t) * dscore_dy, t * dscore_dx, t * dscore_dy))
+        return np.bincount(indices, weights=values, minlength=k * n).reshape(k, n)
+
+    def _get_derivative_images(self, image):
+        """
+        Returns the x and y derivative images of the given image. They are calculated only once, and cached
+        for as long as the contour finder is used with the same image (or the same few images, e.g. pyramid levels).
+        """
+        for i, (source, derivative_images) in enumerate(self._derivative_images):
+            if source is image:
+                if i > 0:
+                    self._derivative_images.insert(0, self._derivative_images.pop(i))
+                return derivative_images
+
+        # Sobel derivatives, scaled by 1/8 so they are expressed in intensity units per pixel
+        dx_image = cv2.Sobel(image, cv2.CV_32F, 1, 0, ksize=3, scale=0.125)
+        dy_image = cv2.Sobel(image, cv2.CV_32F, 0, 1, ksize=3, scale=0.125)
 
-        return gradient
+        # Note: the cache list is modified in place, because it is shared with the scaled copies of this contour finder.
+        self._derivative_images.insert(0, (image, (dx_image, dy_image)))
+        del self._derivative_images[_MAX_CACHED_DERIVATIVE_IMAGES:]
+        return dx_image, dy_image
 
     def calculate_contour_score_samples(self, image, contour_vector):
         """
-        XXX
-        :param image:
-        :param contour_vector:
+        Samples the contour score along each of the contour edges.
+        The score samples of recently scored (or optimized) contours are cached, so they are not resampled.
+        :param image: preprocessed overview image
+        :param contour_vector: a numpy row vector representation [x1, y1, x2, y2, ..., xn, yn] of a contour
         :return: a list of n (4 in our case) lists; each of the n lists holds the score samples along the n contour edges
         """
         n = len(contour_vector)
         assert(n % 2 == 0)
-        scores = [[] for i in range(n // 2)]
-        for i in range(0, n, 2):  # e.g. if n==8 we get i = 0, 2, 4, 6
-            x1 = contour_vector[ i         ]
-            y1 = contour_vector[ i + 1     ]
-            x2 = contour_vector[(i + 2) % n]
-            y2 = contour_vector[(i + 3) % n]
-            scores[i // 2] = self._calculate_segment_score_samples(image, (x1, y1), (x2, y2))
-        return scores
+        key = self._score_cache_key(image, contour_vector)
+        cached = self._score_cache.pop(key, None)
+        if cached is not None and cached[0]() is image:
+            self._score_cache[key] = cached  # re-insert as most recently used
+            return cached[1]
+        return self._calculate_and_cache_score_samples(image, np.asarray(contour_vector)[np.newaxis, :])[0]
+
+    def calculate_contour_edge_scores(self, image, contour_vector):
+        """
+        :param image: preprocessed overview image
+        :param contour_vector: a numpy row vector representation [x1, y1, x2, y2, ..., xn, yn] of a contour
+        :return: a list with the score of each of the n contour edges (the sum of the score samples along the edge)
+        """
+        return _edge_scores(self.calculate_contour_score_samples(image, contour_vector))
+
+    def _calculate_and_cache_score_samples(self, image, contour_vectors):
+        """
+        Samples the contour score along the edges of many contours (with the same number of vertices) at once,
+        and caches the score samples.
+        :param image: preprocessed overview image
+        :param contour_vectors: a k x 2n numpy array; each row is the vector representation [x1, y1, ..., xn, yn] of a contour
+        :return: a list with for each contour a list of n lists with the score samples along its n edges
+        """
+        if len(contour_vectors) == 0:
+            return []
+        samples, num_samples = self._calculate_score_samples(image, contour_vectors)
+        edge_ends = np.cumsum(num_samples.ravel())
+        edge_samples = [edge.tolist() for edge in np.split(samples, edge_ends[:-1])]
+        n = num_samples.shape[1]
+        score_samples = [edge_samples[i:i + n] for i in range(0, len(edge_samples), n)]
+
+        for contour_vector, contour_samples in zip(contour_vectors, score_samples):
+            self.cache_score_samples(image, contour_vector, contour_samples)
+        return score_samples
+
+    def cache_score_samples(self, image, contour_vector, score_samples):
+        """
+        Adds the score samples of a contour to the cache, for example score samples that were calculated
+        by another contour finder (with the same edge sample distance) on a background thread.
+        :param image: preprocessed overview image
+        :param contour_vector: a numpy row vector representation [x1, y1, x2, y2, ..., xn, yn] of a contour
+        :param score_samples: a list of n lists with the score samples along the n contour edges (see calculate_contour_score_samples())
+        """
+        key = self._score_cache_key(image, contour_vector)
+        self._score_cache.pop(key, None)
+        self._score_cache[key] = (weakref.ref(image), score_samples)
+        while len(self._score_cache) > _MAX_CACHED_SCORE_SAMPLES:
+            self._score_cache.popitem(last=False)  # evict the least recently used contour
+
+    def _score_cache_key(self, image, contour_vector):
+        return id(image), self.edge_sample_distance, tuple(np.asarray(contour_vector, dtype=np.float64).tolist())
 
     def calculate_total_contour_score(self, image, contour_vector):
         """
@@ -126,50 +381,117 @@ class ContourFinder:
         :param contour_vector:
         :return: the total score of the contour (a scalar value); contours with a larger score a more likely to represent a true section contour
         """
-        segment_scores = self.calculate_contour_score_samples(image, contour_vector)
-        return np.sum(np.sum(segment_scores))  # total score is the sum of all score samples, obtained over all contour edges
+        samples, _ = self._calculate_score_samples(image, np.asarray(contour_vector)[np.newaxis, :])
+        return np.sum(samples)  # total score is the sum of all score samples, obtained over all contour edges
 
-    def _calculate_segment_score_samples(self, image, p1, p2):
+    def _calculate_total_contour_scores(self, image, contour_vectors):
+        """
+        Calculates the total score of many contours (with the same number of vertices) at once.
+        :param image: preprocessed overview image
+        :param contour_vectors: a k x 2n numpy array; each row is the vector representation [x1, y1, ..., xn, yn] of a contour
+        :return: a numpy array with the k total contour scores
         """
-        XXXX
-        :param image: XXX
-        :param p1: a pair (x1, y1), coordinates of the starting point of the segment
-        :param p2: a pair (x2, y2), coordinates of the end point of the segment
-        :return: a list with score samples along the line segment p1-p2
+        self._evaluation_counts['scores'] += len(contour_vectors)
+        samples, num_samples = self._calculate_score_samples(image, contour_vectors)
+        contour_ends = np.cumsum(np.sum(num_samples, axis=1))
+        contour_starts = contour_ends - np.sum(num_samples, axis=1)
+        # Note: we sum each contour's samples separately (instead of e.g. np.add.reduceat) so the summation order,
+        # and hence the result, is exactly the same as for calculate_total_contour_score().
+        return np.array([np.sum(samples[start:end]) for start, end in zip(contour_starts, contour_ends)])
+
+    def _calculate_score_samples(self, image, contour_vectors):
+        """
+        Batched edge-sampling engine: calculates the score samples along all edges of one or more contours
+        with a single vectorized image sampling call.
+        :param image: preprocessed overview image
+        :param contour_vectors: a k x 2n numpy array; each row is the vector representation [x1, y1, ..., xn, yn] of a contour
+        :return: a tuple (samples, num_samples), with samples a 1D numpy array with all score samples, ordered by contour,
+                 then by edge, then by position along the edge; and num_samples a k x n integer numpy array with the number
+                 of score samples along each edge of each contour.
         """
         # TODO?
         # Perhaps experiment with a score function that is a weighed version of the current score and a scalar value that measures how
         # much the shape of the slice contour resembles the shape of a template slice contour.
+        positions, weights, num_samples = _contour_sample_positions(contour_vectors, self.edge_sample_distance)
+        samples = tools.sample_image_at_positions(image, positions) * weights
+        # FIXME / CHECKME: Is the score normalized by contour length? If not, change this, I think it should be.
+        # (If we don't normalize, then perhaps the optimization will prefer slightly bigger contours
+        # that collect less score per sample, over smaller but more accurate contours that collect more score per sample, but less overall?)
+        return samples, num_samples
 
-        v1 = np.array(p1)
-        v2 = np.array(p2)
-        distance_v1_v2 = math.sqrt(sum((v2 - v1) ** 2))
-        direction = (v2 - v1) / distance_v1_v2
 
-        # Collect equidistant image samples along the edge p1p2.
-        # The first sample is collected in edge start point p1, but no sample is collected on the end point side of the edge (near p2).
-        # This way, for a closed contour, calling this method on each edge in turn will nicely sample all vertices of the polygon.
+def _edge_scores(score_samples):
+    # The score of each edge is the sum of the score samples along it.
+    return [np.sum(edge_samples) for edge_samples in score_samples]
 
-        approx_distance_between_samples = self.edge_sample_distance
-        num_samples = max(1, int(distance_v1_v2 / approx_distance_between_samples))
-        exact_distance_between_samples = distance_v1_v2 / num_samples
 
-        # 1) One possible scoring function which works
-        # sample_weight = distance_v1_v2 / num_samples
+def _contour_sample_positions(contour_vectors, edge_sample_distance):
+    """
+    Calculates where to sample the image along the edges of one or more contours, and the weight of each sample.
+
+    :param contour_vectors: a k x 2n numpy array; each row is the vector representation [x1, y1, ..., xn, yn] of a contour
+    :param edge_sample_distance: the approximate distance between consecutive samples along an edge
+    :return: a tuple (positions, weights, num_samples): positions is an m x 2 numpy array with the (x, y) sample positions,
+             weights is a numpy array with the m sample weights, and num_samples is a k x n integer numpy array
+             with the number of samples along each edge of each contour. The samples are ordered by contour,
+             then by edge, then by position along the edge.
+    """
+    k = contour_vectors.shape[0]
+    v1 = contour_vectors.reshape(k, -1, 2).astype(np.float64)  # k x n x 2 array of edge start points
+    v2 = np.roll(v1, -1, axis=1)                                # k x n x 2 array of edge end points
+    edges = v2 - v1
+    distances_v1_v2 = np.sqrt(edges[:, :, 0] ** 2 + edges[:, :, 1] ** 2)
+    directions = edges / distances_v1_v2[:, :, np.newaxis]
+
+    # Collect equidistant image samples along each edge p1p2.
+    # The first sample is collected in edge start point p1, but no sample is collected on the end point side of the edge (near p2).
+    # This way, for a closed contour, sampling each edge in turn will nicely sample all vertices of the polygon.
+    num_samples = np.maximum(1, (distances_v1_v2 / edge_sample_distance).astype(int))
+    exact_distances_between_samples = distances_v1_v2 / num_samples
+
+    # 1) One possible scoring function which works
+    # sample_weights = distances_v1_v2 / num_samples
+
+    # 2) Below is another scoring function, which seems to work better in a ribbon-growing experiment.
+    #    The factor 1000 was needed so that the other parameters such as gradient descent step size etc
+    #    could be preserved as is (compared to the score that is proportional to the distance between p1 and p2).
+    sample_weights = 1000.0 / num_samples
+
+    edge_index, i = _sample_indices(num_samples)
+    positions = v1.reshape(-1, 2)[edge_index] + \
+                (i * exact_distances_between_samples.ravel()[edge_index])[:, np.newaxis] * directions.reshape(-1, 2)[edge_index]
+    weights = sample_weights.ravel()[edge_index]
+    return positions, weights, num_samples
+
+
+def _sample_indices(num_samples):
+    """
+    :param num_samples: a k x n integer numpy array with the number of samples along each edge of k contours with n vertices
+    :return: a tuple (edge_index, i) of numpy arrays, with for each sample the (flattened) index of the edge it belongs to,
+             and its index i along that edge
+    """
+    counts = num_samples.ravel()
+    edge_index = np.repeat(np.arange(counts.size), counts)
+    first_sample = np.cumsum(counts) - counts
+    i = np.arange(np.sum(counts)) - first_sample[edge_index]
+    return edge_index, i
 
-        # 2) Below is another scoring function, which seems to work better in a ribbon-growing experiment.
-        #    The factor 1000 was needed so that the other parameters such as gradient descent step size etc
-        #    could be preserved as is (compared to the score that is proportional to the distance between p1 and p2).
-        sample_weight = 1000.0 / num_samples
 
-        scores = [0.0] * num_samples
-        for i in range(num_samples):
-            pos = v1 + i * exact_distance_between_samples * direction
-            scores[i] = tools.sample_image(image, pos) * sample_weight
-        return scores
-        # FIXME / CHECKME: Is the score normalized by contour length? If not, change this, I think it should be.
-        # (If we don't normalize, then perhaps the optimization will prefer slightly bigger contours
-        # that collect less score per sample, over smaller but more accurate contours that collect more score per sample, but less overall?)
+def build_image_pyramid(image, num_levels):
+    """
+    Builds a Gaussian image pyramid, for coarse-to-fine contour optimization.
+    :param image: preprocessed overview image
+    :param num_levels: the number of downsampled levels to add to the pyramid
+    :return: a list [image, image at 1/2 resolution, image at 1/4 resolution, ...] with at most num_levels + 1 images;
+             a pixel with coordinates (x, y) at level 0 corresponds to (x / 2 ** level, y / 2 ** level) at a given level.
+    """
+    pyramid = [image]
+    for level in range(num_levels):
+        if min(pyramid[-1].shape) < 2:
+            break
+        pyramid.append(cv2.pyrDown(pyramid[-1]))
+    return pyramid
+
 
 def contour_to_vector(contour):
     """
@@ -198,10 +520,11 @@ def vector_to_contour(vec):
 
 
 def _vertex_distances(contour1, contour2):
-    # contour1 and 2 are numpy row vectors [x1, y1, x2, y2, ..., xn, yn] where n=number of vertices (=4 because are sections are quadrilaterals)
-    # returns a numpy array (with n elements) with the Euclidean distance between corresponding vertices in the two contours
-    difference = contour1.reshape(-1, 2) - contour2.reshape(-1, 2)  # reshape to an nx2 matrix (so each row is the x,y of a vertex), and subtract
-    distances = np.linalg.norm(difference, axis=1)  # distances[i] = euclidean distances between vertex i in contour1 and contour2
+    # contour1 and 2 are numpy row vectors [x1, y1, x2, y2, ..., xn, yn] where n=number of vertices (=4 because are sections are quadrilaterals),
+    # or k x 2n numpy arrays with k such row vectors
+    # returns a numpy array (with n elements, or k x n elements) with the Euclidean distance between corresponding vertices in the two contours
+    difference = contour1.reshape(contour1.shape[:-1] + (-1, 2)) - contour2.reshape(contour2.shape[:-1] + (-1, 2))  # reshape so each row is the x,y of a vertex, and subtract
+    distances = np.linalg.norm(difference, axis=-1)  # distances[..., i] = euclidean distances between vertex i in contour1 and contour2
     return distances
 
 
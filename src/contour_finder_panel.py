@@ -6,7 +6,12 @@ import os
 import tools
 from contour_finder import ContourFinder
 from contour_finder import contour_to_vector
+from contour_finder import build_image_pyramid
+from contour_optimizers import OPTIMIZERS, GradientAscentOptimizer
+from parallel_contour_finder import ParallelContourFinder
+from ribbon_growing import RibbonGrowingThread, group_seed_slices
 from preprocess_dialog import PreprocessDialog
+from preprocessing_cache import PreprocessingCache
 from polygon_selector_mixin import MSG_SLICE_SELECTION_CHANGED
 from pubsub import pub
 import matplotlib
@@ -28,11 +33,19 @@ class ContourFinderPanel(wx.Panel):
         self._contour_finder = ContourFinder()
         self._ghost_polygons = []  # floatcanvas handles for the ghost slice polygons
         self._preprocessed_overview_image = None
+        self._preprocessed_overview_pyramid = None  # Gaussian pyramid of the preprocessed overview image, for coarse-to-fine contour optimization
+        self._parallel_contour_finder = None  # pool of worker processes sharing the preprocessed overview image pyramid
+        self._parallel_contour_finder_pyramid = None  # the image pyramid shared with the worker processes
+        self._improving_contours = False  # True while contours are being improved in the background by the worker processes
 
         # Ribbon building
         self._num_slices = 1  # number of new slices to detect by extending a seed slice contour and using the preprocessed overview image which highlights edges
         self._max_score_drop_ratio = 0.3
         self._draw_ghosts = False  # for debugging: draw tentative slice polygons during ribbon building
+        self._ribbon_growing_thread = None  # background thread that is growing a ribbon, or None
+        self._growing_all_ribbons = False  # True while the worker processes are growing ribbons
+        self._num_grown_ribbons = 0  # number of ribbons grown by the worker processes so far
+        self._num_grown_slices = 0  # number of new slices in these ribbons
 
         # Contour energy minimization parameters
         # TODO: combine into a structure, this class already has too many member variables
@@ -41,6 +54,10 @@ class ContourFinderPanel(wx.Panel):
         self.vertex_distance_threshold = 0.5
         self.gradient_step_size = 5e-3
         self.edge_sample_distance = 10.0
+        self.pyramid_levels = 0  # number of downsampled image pyramid levels for coarse-to-fine contour optimization; 0 = optimize at full resolution only
+        self.analytic_gradient = False
+        self.optimizer = GradientAscentOptimizer.NAME
+        self.parallel = False  # improve contours in a pool of worker processes, on all CPU cores
         self.verbose = False
 
         self._set_contour_finder_options()
@@ -57,18 +74,20 @@ class ContourFinderPanel(wx.Panel):
         self._vertex_distance_threshold_edit = wx.TextCtrl(self, wx.ID_ANY, str(self.vertex_distance_threshold), size=(w, -1))
         self._gradient_step_size_edit = wx.TextCtrl(self, wx.ID_ANY, str(self.gradient_step_size), size=(w, -1))
         self._edge_sample_distance_edit = wx.TextCtrl(self, wx.ID_ANY, str(self.edge_sample_distance), size=(w, -1))
+        self._pyramid_levels_edit = wx.TextCtrl(self, wx.ID_ANY, str(self.pyramid_levels), size=(w, -1))
 
         self.Bind(wx.EVT_TEXT, self._on_h_for_gradient_approximation_change, self._h_for_gradient_approximation_edit)
         self.Bind(wx.EVT_TEXT, self._on_max_iterations_change, self._max_iterations_edit)
         self.Bind(wx.EVT_TEXT, self._on_gradient_step_size_change, self._gradient_step_size_edit)
         self.Bind(wx.EVT_TEXT, self._on_edge_sample_distance_change, self._edge_sample_distance_edit)
         self.Bind(wx.EVT_TEXT, self._on_vertex_distance_threshold_change, self._vertex_distance_threshold_edit)
+        self.Bind(wx.EVT_TEXT, self._on_pyramid_levels_change, self._pyramid_levels_edit)
 
         # Buttons
         button_size = (125, -1)
 
-        preprocess_button = wx.Button(self, wx.ID_ANY, "Preprocess", size=button_size)
-        load_button = wx.Button(self, wx.ID_ANY, "Load", size=button_size)
+        self._preprocess_button = wx.Button(self, wx.ID_ANY, "Preprocess", size=button_size)
+        self._load_button = wx.Button(self, wx.ID_ANY, "Load", size=button_size)
         self._save_button = wx.Button(self, wx.ID_ANY, "Save", size=button_size)
         self._save_button.Enable(False)
 
@@ -90,9 +109,28 @@ class ContourFinderPanel(wx.Panel):
         self._print_score_button = wx.Button(self, wx.ID_ANY, "Print Contour Score", size=button_size)
         self._print_score_button.Enable(False)
 
+        self._complete_all_ribbons_button = wx.Button(self, wx.ID_ANY, "Complete All Ribbons", size=button_size)
+        self._complete_all_ribbons_button.Enable(False)
+
+        self._cancel_ribbon_button = wx.Button(self, wx.ID_ANY, "Cancel", size=button_size)
+        self._cancel_ribbon_button.Enable(False)
+
+        self._ribbon_status_text = wx.StaticText(self, wx.ID_ANY, "")
+
         self._plot_score_button = wx.Button(self, wx.ID_ANY, "Plot Contour Score", size=button_size)
         self._plot_score_button.Enable(False)
 
+        optimizer_names = [optimizer.NAME for optimizer in OPTIMIZERS]
+        self._optimizer_choice = wx.Choice(self, wx.ID_ANY, choices=optimizer_names)
+        self._optimizer_choice.SetSelection(optimizer_names.index(self.optimizer))
+        self.Bind(wx.EVT_CHOICE, self._on_optimizer_change, self._optimizer_choice)
+
+        analytic_gradient_checkbox = wx.CheckBox(self, wx.ID_ANY, label="Analytic gradient")
+        analytic_gradient_checkbox.SetValue(self.analytic_gradient)
+
+        parallel_checkbox = wx.CheckBox(self, wx.ID_ANY, label="Use all CPU cores")
+        parallel_checkbox.SetValue(self.parallel)
+
         verbose_checkbox = wx.CheckBox(self, wx.ID_ANY, label="Verbose")
         verbose_checkbox.SetValue(self.verbose)
 
@@ -101,16 +139,20 @@ class ContourFinderPanel(wx.Panel):
 
         self.done_button = wx.Button(self, wx.ID_ANY, "Done", size=button_size)  # Not this panel but the ApplicationFame will listen to clicks on this button.
 
-        self.Bind(wx.EVT_BUTTON, self._on_preprocess_button_click, preprocess_button)
+        self.Bind(wx.EVT_BUTTON, self._on_preprocess_button_click, self._preprocess_button)
         self.Bind(wx.EVT_BUTTON, self._on_jitter_button_click, self._jitter_button)
         self.Bind(wx.EVT_BUTTON, self._on_print_score_button_click, self._print_score_button)
         self.Bind(wx.EVT_BUTTON, self._on_plot_score_button_click, self._plot_score_button)
         self.Bind(wx.EVT_BUTTON, self._on_improve_button_click, self._improve_button)
-        self.Bind(wx.EVT_BUTTON, self._on_load_button_click, load_button)
+        self.Bind(wx.EVT_BUTTON, self._on_load_button_click, self._load_button)
         self.Bind(wx.EVT_BUTTON, self._on_save_button_click, self._save_button)
         self.Bind(wx.EVT_BUTTON, self._on_show_button_click, self._show_button)
         self.Bind(wx.EVT_BUTTON, self._on_add_slices_button_click, self._add_slices_button)
         self.Bind(wx.EVT_BUTTON, self._on_complete_ribbon_button_click, self._complete_ribbon_button)
+        self.Bind(wx.EVT_BUTTON, self._on_complete_all_ribbons_button_click, self._complete_all_ribbons_button)
+        self.Bind(wx.EVT_BUTTON, self._on_cancel_ribbon_button_click, self._cancel_ribbon_button)
+        self.Bind(wx.EVT_CHECKBOX, self._on_analytic_gradient_checkbox, analytic_gradient_checkbox)
+        self.Bind(wx.EVT_CHECKBOX, self._on_parallel_checkbox, parallel_checkbox)
         self.Bind(wx.EVT_CHECKBOX, self._on_verbose_checkbox, verbose_checkbox)
         self.Bind(wx.EVT_CHECKBOX, self._on_draw_ghosts_checkbox, draw_ghosts_checkbox)
 
@@ -125,16 +167,22 @@ class ContourFinderPanel(wx.Panel):
         parameters_sizer.Add(self._edge_sample_distance_edit, flag=wx.RIGHT)
         parameters_sizer.Add(wx.StaticText(self, wx.ID_ANY, "Vertex distance threshold:"), flag=wx.LEFT | wx.ALIGN_RIGHT)
         parameters_sizer.Add(self._vertex_distance_threshold_edit, flag=wx.RIGHT)
+        parameters_sizer.Add(wx.StaticText(self, wx.ID_ANY, "Pyramid levels:"), flag=wx.LEFT | wx.ALIGN_RIGHT)
+        parameters_sizer.Add(self._pyramid_levels_edit, flag=wx.RIGHT)
+        parameters_sizer.Add(wx.StaticText(self, wx.ID_ANY, "Optimizer:"), flag=wx.LEFT | wx.ALIGN_RIGHT)
+        parameters_sizer.Add(self._optimizer_choice, flag=wx.RIGHT)
 
         contours_box = wx.StaticBox(self, -1, 'Contours')
         contours_sizer = wx.StaticBoxSizer(contours_box, wx.VERTICAL)
         contours_sizer.Add(parameters_sizer, 0, wx.ALL | wx.CENTER, 5)
+        contours_sizer.Add(analytic_gradient_checkbox, 0, wx.ALL | wx.CENTER, 5)
+        contours_sizer.Add(parallel_checkbox, 0, wx.ALL | wx.CENTER, 5)
         contours_sizer.Add(self._improve_button, 0, wx.ALL | wx.CENTER, 5)
 
         preprocessing_box = wx.StaticBox(self, -1, 'Preprocessing')
         preprocessing_sizer = wx.StaticBoxSizer(preprocessing_box, wx.VERTICAL)
-        preprocessing_sizer.Add(preprocess_button, 0, wx.BOTTOM | wx.CENTER, 5)
-        preprocessing_sizer.Add(load_button, 0, wx.BOTTOM | wx.CENTER, 5)
+        preprocessing_sizer.Add(self._preprocess_button, 0, wx.BOTTOM | wx.CENTER, 5)
+        preprocessing_sizer.Add(self._load_button, 0, wx.BOTTOM | wx.CENTER, 5)
         preprocessing_sizer.Add(self._save_button, 0, wx.BOTTOM | wx.CENTER, 5)
         preprocessing_sizer.Add(self._show_button, 0, wx.BOTTOM | wx.CENTER, 5)
 
@@ -164,9 +212,13 @@ class ContourFinderPanel(wx.Panel):
         ribbon_sizer = wx.StaticBoxSizer(ribbon_box, wx.VERTICAL)
         ribbon_sizer.Add(complete_ribbon_params_sizer, 0, wx.ALL | wx.CENTER, 5)
         ribbon_sizer.Add(self._complete_ribbon_button, 0, wx.ALL | wx.CENTER, 5)
+        ribbon_sizer.Add(self._complete_all_ribbons_button, 0, wx.ALL | wx.CENTER, 5)
         ribbon_sizer.Add(wx.StaticLine(self, wx.ID_ANY))
         ribbon_sizer.Add(add_slices_params_sizer, 0, wx.ALL | wx.CENTER, 5)
         ribbon_sizer.Add(self._add_slices_button, 0, wx.ALL | wx.CENTER, 5)
+        ribbon_sizer.Add(wx.StaticLine(self, wx.ID_ANY))
+        ribbon_sizer.Add(self._cancel_ribbon_button, 0, wx.ALL | wx.CENTER, 5)
+        ribbon_sizer.Add(self._ribbon_status_text, 0, wx.ALL | wx.CENTER, 5)
 
         b = 2  # border size
         contents = wx.BoxSizer(wx.VERTICAL)
@@ -182,20 +234,32 @@ class ContourFinderPanel(wx.Panel):
         contents.Fit(self)
 
     def activate(self):
+        if self._preprocessed_overview_image is None:
+            self._load_cached_preprocessed_image()
         self._update_buttons()
         pub.subscribe(self._on_slice_selection_change, MSG_SLICE_SELECTION_CHANGED)
 
     def deactivate(self):
         pub.unsubscribe(self._on_slice_selection_change, MSG_SLICE_SELECTION_CHANGED)
+        if self._ribbon_growing_thread is not None:
+            # Cancel ribbon growing, and forget the thread, so the callbacks it still posts to the GUI thread
+            # (for the slice it is finishing) are ignored, instead of adding slices after the panel was deactivated.
+            self._ribbon_growing_thread.cancel()
+            self._ribbon_growing_thread = None
+        self._close_parallel_contour_finder()  # stops the worker processes and deletes their copy of the preprocessed image
         self._remove_ghosts()
 
-    def _set_contour_finder_options(self):
-        self._contour_finder.set_optimization_parameters(self.h_for_gradient_approximation,
-                                                         self.max_iterations,
-                                                         self.vertex_distance_threshold,
-                                                         self.gradient_step_size,
-                                                         self.edge_sample_distance,
-                                                         self.verbose)
+    def _set_contour_finder_options(self, contour_finder=None):
+        if contour_finder is None:
+            contour_finder = self._contour_finder
+        contour_finder.set_optimization_parameters(self.h_for_gradient_approximation,
+                                                   self.max_iterations,
+                                                   self.vertex_distance_threshold,
+                                                   self.gradient_step_size,
+                                                   self.edge_sample_distance,
+                                                   self.verbose,
+                                                   self.analytic_gradient,
+                                                   self.optimizer)
 
     def _on_slice_selection_change(self, old_selected_slices, new_selected_slices):
         self._update_buttons()
@@ -206,15 +270,33 @@ class ContourFinderPanel(wx.Panel):
         slices_selected = num_selected_slices > 0
         one_or_two_slices_selected = (num_selected_slices == 1) or (num_selected_slices == 2)
         one_slice_selected = num_selected_slices == 1
+        growing_ribbon = self._ribbon_growing_thread is not None or self._growing_all_ribbons
+        workers_busy = self._improving_contours or self._growing_all_ribbons  # a new preprocessed image would restart the worker processes
+        self._preprocess_button.Enable(not workers_busy)
+        self._load_button.Enable(not workers_busy)
         self._show_button.Enable(preprocessed)
         self._save_button.Enable(preprocessed)
         self._jitter_button.Enable(slices_selected)
-        self._improve_button.Enable(preprocessed and slices_selected)
+        self._improve_button.Enable(preprocessed and slices_selected and not self._improving_contours and not growing_ribbon)
         self._print_score_button.Enable(preprocessed and slices_selected)
-        self._add_slices_button.Enable(preprocessed and one_or_two_slices_selected)
-        self._complete_ribbon_button.Enable(preprocessed and one_or_two_slices_selected)
+        self._add_slices_button.Enable(preprocessed and one_or_two_slices_selected and not growing_ribbon)
+        self._complete_ribbon_button.Enable(preprocessed and one_or_two_slices_selected and not growing_ribbon)
+        self._complete_all_ribbons_button.Enable(preprocessed and slices_selected and not self._improving_contours and not growing_ribbon)
+        self._cancel_ribbon_button.Enable(self._ribbon_growing_thread is not None)
         self._plot_score_button.Enable(preprocessed and one_slice_selected)
 
+    def _on_optimizer_change(self, event):
+        self.optimizer = self._optimizer_choice.GetStringSelection()
+        print('optimizer={}'.format(self.optimizer))
+
+    def _on_analytic_gradient_checkbox(self, event):
+        self.analytic_gradient = event.GetEventObject().GetValue()
+        print('analytic_gradient={}'.format(self.analytic_gradient))
+
+    def _on_parallel_checkbox(self, event):
+        self.parallel = event.GetEventObject().GetValue()
+        print('parallel={}'.format(self.parallel))
+
     def _on_verbose_checkbox(self, event):
         self.verbose = event.GetEventObject().GetValue()
         print('verbose={}'.format(self.verbose))
@@ -252,6 +334,31 @@ class ContourFinderPanel(wx.Panel):
         self.vertex_distance_threshold = float(self._vertex_distance_threshold_edit.GetValue())
         print('vertex_distance_threshold={}'.format(self.vertex_distance_threshold))
 
+    def _on_pyramid_levels_change(self, event):
+        self.pyramid_levels = max(0, int(self._pyramid_levels_edit.GetValue()))
+        print('pyramid_levels={}'.format(self.pyramid_levels))
+
+    def _get_preprocessed_overview_pyramid(self):
+        # The pyramid is built only once per preprocessed image (and number of pyramid levels)
+        if self._preprocessed_overview_pyramid is None or len(self._preprocessed_overview_pyramid) != self.pyramid_levels + 1:
+            self._preprocessed_overview_pyramid = build_image_pyramid(self._preprocessed_overview_image, self.pyramid_levels)
+        return self._preprocessed_overview_pyramid
+
+    def _get_parallel_contour_finder(self):
+        # The worker processes share the current preprocessed overview image pyramid, so they need to be restarted if it changes.
+        pyramid = self._get_preprocessed_overview_pyramid()
+        if self._parallel_contour_finder is None or self._parallel_contour_finder_pyramid is not pyramid:
+            self._close_parallel_contour_finder()
+            self._parallel_contour_finder = ParallelContourFinder(pyramid)
+            self._parallel_contour_finder_pyramid = pyramid
+        return self._parallel_contour_finder
+
+    def _close_parallel_contour_finder(self):
+        if self._parallel_contour_finder is not None:
+            self._parallel_contour_finder.close()
+            self._parallel_contour_finder = None
+            self._parallel_contour_finder_pyramid = None
+
     def _on_print_score_button_click(self, event):
         # Print the contour score for all selected slices. The higher the score the better the contour is supposed to
         # match the actual slice outline.
@@ -259,8 +366,7 @@ class ContourFinderPanel(wx.Panel):
         for i in selected_slices:
             contour = self._model.slice_polygons[i]
             contour_vector = contour_to_vector(contour)
-            score_samples = self._contour_finder.calculate_contour_score_samples(self._preprocessed_overview_image, contour_vector)
-            edge_scores = [np.sum(edge_samples) for edge_samples in score_samples]
+            edge_scores = self._contour_finder.calculate_contour_edge_scores(self._preprocessed_overview_image, contour_vector)  # cached if the contour was optimized recently
             assert len(edge_scores) == 4
             s1, s2, s3, s4 = edge_scores[0], edge_scores[1], edge_scores[2], edge_scores[3]
             print('Slice #{} score = {:.1f} = {:.1f} + {:.1f} + {:.1f} + {:.1f}'.format(i+1, s1 + s2 + s3 + s4, s1, s2, s3, s4))
@@ -271,7 +377,7 @@ class ContourFinderPanel(wx.Panel):
         idx = selected_slices[0]
         contour = self._model.slice_polygons[idx]
         contour_vector = contour_to_vector(contour)
-        sample_scores = self._contour_finder.calculate_contour_score_samples(self._preprocessed_overview_image, contour_vector)
+        sample_scores = self._contour_finder.calculate_contour_score_samples(self._preprocessed_overview_image, contour_vector)  # cached if the contour was optimized recently
         plot_contour_sample_scores(idx + 1, sample_scores)
 
     def _on_load_button_click(self, event):
@@ -324,13 +430,40 @@ class ContourFinderPanel(wx.Panel):
         with PreprocessDialog(img, self._model, None, wx.ID_ANY, "Preprocess Overview Image") as dlg:
             dlg.CenterOnScreen()
             if dlg.ShowModal() == wx.OK:
-                wait = wx.BusyInfo("Preprocessing {} x {} pixels overview image...".format(img.shape[1], img.shape[0]))
-                dlg.preprocess(img)
-                self._preprocessed_overview_image = dlg.get_preprocessed_image()
-                del wait
+                parameters = dlg.get_preprocessing_parameters()
+                self._model.preprocessing_parameters = parameters
+                self._model.write_parameters()  # remember the parameters, so next time the preprocessed image can be taken from the cache
+
+                cache = self._get_preprocessing_cache()
+                preprocessed_image = cache.get(self._model.overview_image_path, parameters)
+                if preprocessed_image is None:
+                    wait = wx.BusyInfo("Preprocessing {} x {} pixels overview image...".format(img.shape[1], img.shape[0]))
+                    preprocessed_image = dlg.preprocess_tiled(img)
+                    cache.put(self._model.overview_image_path, parameters, preprocessed_image)
+                    del wait
+                else:
+                    print('Using cached preprocessed overview image')
+                self._preprocessed_overview_image = preprocessed_image
                 self._got_preprocessed_image()
 
+    def _get_preprocessing_cache(self):
+        return PreprocessingCache(self._model.preprocessing_cache_folder, self._model.preprocessing_cache_max_size_mb * 1024 * 1024)
+
+    def _load_cached_preprocessed_image(self):
+        # If the overview image was preprocessed before (with the most recently used preprocessing parameters),
+        # then get the preprocessed image from the cache, so the user does not need to preprocess it again.
+        if self._model.preprocessing_parameters is None:
+            return
+        preprocessed_image = self._get_preprocessing_cache().get(self._model.overview_image_path, self._model.preprocessing_parameters)
+        if preprocessed_image is not None:
+            print('Using cached preprocessed overview image')
+            self._preprocessed_overview_image = preprocessed_image
+            self._got_preprocessed_image()
+
     def _got_preprocessed_image(self):
+        self._preprocessed_overview_pyramid = None
+        self._contour_finder.clear_caches()  # free the derivative images and score samples of the old preprocessed image
+        self._close_parallel_contour_finder()
         self._update_buttons()
 
     def _on_show_button_click(self, event):
@@ -375,13 +508,37 @@ class ContourFinderPanel(wx.Panel):
     def _on_improve_button_click(self, event):
         self._set_contour_finder_options()
 
+        # Optimize all selected slices together, and only redraw the canvas once at the end.
         selected_slices = self._selector.get_selected_slices()
-        for i in selected_slices:
-            polygon = self._model.slice_polygons[i]
-            optimized_polygon = self._contour_finder.optimize_contour(self._preprocessed_overview_image, polygon)
+        polygons = [self._model.slice_polygons[i] for i in selected_slices]
+        if self.parallel:
+            self._improve_contours_in_parallel(selected_slices, polygons)
+            return
+
+        optimized_polygons = self._contour_finder.optimize_contours(self._preprocessed_overview_image, polygons, self._get_preprocessed_overview_pyramid())
+        for i, optimized_polygon in zip(selected_slices, optimized_polygons):
             self._model.set_slice_polygon(i, optimized_polygon)  # update model
             self._canvas.set_slice_outline(i, self._flipY(optimized_polygon))  # update canvas  # TODO? listen to model changes instead?
-            self._canvas.redraw(True)
+        self._canvas.redraw(True)
+
+    def _improve_contours_in_parallel(self, slice_indices, polygons):
+        # The contours are optimized in the worker processes, the canvas is updated whenever a batch of contours is ready.
+        # The callbacks are called on a background thread, so we forward them to the GUI thread.
+        self._improving_contours = True
+        self._update_buttons()
+        self._get_parallel_contour_finder().optimize_contours(self._contour_finder, polygons,
+                                                              lambda indices, optimized_polygons: wx.CallAfter(self._got_improved_contours, [slice_indices[i] for i in indices], optimized_polygons),
+                                                              lambda: wx.CallAfter(self._improved_contours_done))
+
+    def _got_improved_contours(self, slice_indices, optimized_polygons):
+        for i, optimized_polygon in zip(slice_indices, optimized_polygons):
+            self._model.set_slice_polygon(i, optimized_polygon)  # update model
+            self._canvas.set_slice_outline(i, self._flipY(optimized_polygon))  # update canvas
+        self._canvas.redraw(True)
+
+    def _improved_contours_done(self):
+        self._improving_contours = False
+        self._update_buttons()
 
     def _on_complete_ribbon_button_click(self, event):
         self._grow_ribbon(complete_ribbon=True)
@@ -389,15 +546,55 @@ class ContourFinderPanel(wx.Panel):
     def _on_add_slices_button_click(self, event):
         self._grow_ribbon(complete_ribbon=False)
 
+    def _on_complete_all_ribbons_button_click(self, event):
+        # Each selected slice (or pair of selected slices, one attached below the other) is the seed of a different ribbon.
+        # All these ribbons are grown concurrently by the worker processes.
+        self._set_contour_finder_options()
+        selected_slices = sorted(self._selector.get_selected_slices())
+        seed_slices = group_seed_slices([self._model.slice_polygons[i] for i in selected_slices])
+
+        self._growing_all_ribbons = True
+        self._num_grown_ribbons = 0
+        self._num_grown_slices = 0
+        self._ribbon_status_text.SetLabel("Growing {} ribbons...".format(len(seed_slices)))
+        self._update_buttons()
+        self._get_parallel_contour_finder().grow_ribbons(self._contour_finder, seed_slices, self._max_score_drop_ratio,
+                                                         lambda ribbon_index, new_slices: wx.CallAfter(self._got_grown_ribbon, ribbon_index, new_slices),
+                                                         lambda: wx.CallAfter(self._all_ribbons_grown, len(seed_slices)))
+
+    def _got_grown_ribbon(self, ribbon_index, new_slices):
+        # The ribbons arrive in ribbon order, so the new slices are appended to the model ribbon by ribbon.
+        self._model.slice_polygons.extend(new_slices)
+        self._canvas.add_slice_outlines()
+        self._canvas.redraw(True)
+        self._num_grown_ribbons += 1
+        self._num_grown_slices += len(new_slices)
+        self._ribbon_status_text.SetLabel("Grew {} ribbons...".format(self._num_grown_ribbons))
+
+    def _all_ribbons_grown(self, num_ribbons):
+        self._ribbon_status_text.SetLabel("Added {} new slices to {} of {} ribbons".format(self._num_grown_slices, self._num_grown_ribbons, num_ribbons))
+        print('Ribbon building: {} new slices in {} ribbons'.format(self._num_grown_slices, self._num_grown_ribbons))
+        self._growing_all_ribbons = False
+        self._update_buttons()
+
+    def _on_cancel_ribbon_button_click(self, event):
+        if self._ribbon_growing_thread is not None:
+            self._ribbon_growing_thread.cancel()
+
     def _grow_ribbon(self, complete_ribbon):
         """
-        Grow one or two selected "seed" slices into a ribbon of slices.
-        
+        Grow one or two selected "seed" slices into a ribbon of slices. The ribbon is grown on a background thread,
+        the new slices are added to the model and the canvas in batches, as they are found.
+
         :param complete_ribbon: boolean, if True then we will keep on adding new slices until its scores becomes too low,
         if False then we will add at most self._num_slices (and also stop if the score of a new slice is too low)
         """
 
-        self._set_contour_finder_options()
+        # The background thread gets its own contour finder, so it does not share the contour finder's caches with the GUI thread.
+        # The score samples of the new slices are handed back with each batch, and cached in our own contour finder (see _got_ribbon_slices()).
+        contour_finder = ContourFinder()
+        self._set_contour_finder_options(contour_finder)
+        self._set_contour_finder_options()  # same edge sample distance, so the cached score samples match
 
         selected_slice_indices = self._selector.get_selected_slices()
 
@@ -407,62 +604,46 @@ class ContourFinderPanel(wx.Panel):
         # Collect the actual slice contours of the slices with the given indices.
         slices = [self._model.slice_polygons[i] for i in selected_slice_indices]
 
-        # convert from [(x,y)] to [np.array] for easier calculations on point vectors
-        slices = [[np.array(vertex) for vertex in s] for s in slices]
-
-        old_slice, mat = _ribbon_building_bootstrap(slices)
-        i = 0
-        while True:
-            if not complete_ribbon:
-                if i >= self._num_slices:
-                    break
-
-            # Predict an approximate next slice (approximate shape and approximate position)
-            new_slice = _transform_slice(old_slice, mat)
-            self._draw_ghost(new_slice, "Blue")
-
-            # Use gradient descent to find the true location and shape of the next slice,
-            # in the neighborhood of our approximation.
-            new_slice_for_model = self._contour_finder.optimize_contour(self._preprocessed_overview_image, new_slice)
-
-            # Assess if tentative new slice stands a chance of being correct. If not, then terminate ribbon building.
-            template_slice = old_slice  # use the previously slice (which turned out to be good) as the template to judge the quality of the new slice
-            if self._terminate_ribbon_building(template_slice, new_slice_for_model, self._max_score_drop_ratio):
-                print('Tentative new contour of low quality; terminating ribbon building')
-                self._draw_ghost(new_slice_for_model, "Red")
-                break
-
-            # Add to model and update canvas.
-            self._model.slice_polygons.extend([new_slice_for_model])
-            self._canvas.set_slice_polygons(self._model.slice_polygons)
-            self._canvas.redraw(True)
+        max_slices = None if complete_ribbon else self._num_slices
+        # The callbacks pass the thread along, so callbacks of a thread that is no longer ours (see deactivate()) can be ignored.
+        ghost_callback = (lambda contour, color: wx.CallAfter(self._draw_ribbon_ghost, thread, contour, color)) if self._draw_ghosts else None
+
+        thread = RibbonGrowingThread(contour_finder, self._preprocessed_overview_image, self._get_preprocessed_overview_pyramid(),
+                                     slices, max_slices, self._max_score_drop_ratio,
+                                     lambda new_slices, score_samples, num_slices, slices_per_second: wx.CallAfter(self._got_ribbon_slices, thread, new_slices, score_samples, num_slices, slices_per_second),
+                                     lambda num_slices, slices_per_second, cancelled: wx.CallAfter(self._ribbon_growing_done, thread, num_slices, slices_per_second, cancelled),
+                                     ghost_callback)
+        self._ribbon_growing_thread = thread
+        self._ribbon_status_text.SetLabel("Growing ribbon...")
+        self._update_buttons()
+        thread.start()
 
-            # Prepare for estimating the next slice
-            new_slice = [np.array(vertex) for vertex in
-                         new_slice_for_model]  # convert from [(x,y)] to [np.array([x,y])] for easier calculations on point vectors
-            mat = _estimate_transformation(old_slice, new_slice)
-            old_slice = new_slice
-            i = i + 1
+    def _got_ribbon_slices(self, thread, new_slices, score_samples, num_slices, slices_per_second):
+        if thread is not self._ribbon_growing_thread:
+            return
 
-    def _terminate_ribbon_building(self, template_contour, new_contour, max_score_drop_ratio):
-        """
-        Returns whether to terminate automatic ribbon building because. This may happen because we reached the end of a
-        ribbon, or because we failed to track the ribbon correctly (typically because of a sudden break or kink in the ribbon)
-
-        :param template_contour: xxx
-        :param new_contour: xxx
-        :param max_score_drop_ratio:
-        :return: true if the tentative new contour is likely to be an incorrect or spurious slice contour;
-                 false if there is a good chance that the new contour matches a real slice outline
-        """
-        template_scores = np.array(self._edge_scores(template_contour))
-        new_scores = np.array(self._edge_scores(new_contour))
-        poor_quality = np.any(new_scores < template_scores * max_score_drop_ratio)
-        return poor_quality
+        # Cache the score samples of the new slices, so printing or plotting their scores does not resample them.
+        for new_slice, slice_score_samples in zip(new_slices, score_samples):
+            self._contour_finder.cache_score_samples(self._preprocessed_overview_image, contour_to_vector(new_slice), slice_score_samples)
+
+        # Add to model and update canvas. Only outlines for the new slices are added to the canvas.
+        self._model.slice_polygons.extend(new_slices)
+        self._canvas.add_slice_outlines()
+        self._canvas.redraw(True)
+        self._ribbon_status_text.SetLabel("{} new slices ({:.1f} slices/s)".format(num_slices, slices_per_second))
 
-    def _edge_scores(self, contour):
-        sample_scores = self._contour_finder.calculate_contour_score_samples(self._preprocessed_overview_image, contour_to_vector(contour))
-        return [np.sum(edge_samples) for edge_samples in sample_scores]
+    def _ribbon_growing_done(self, thread, num_slices, slices_per_second, cancelled):
+        if thread is not self._ribbon_growing_thread:
+            return
+
+        self._ribbon_growing_thread = None
+        self._ribbon_status_text.SetLabel("{} {} new slices ({:.1f} slices/s)".format("Cancelled after" if cancelled else "Added", num_slices, slices_per_second))
+        print('Ribbon building: {} new slices, {:.1f} slices/s{}'.format(num_slices, slices_per_second, ' (cancelled)' if cancelled else ''))
+        self._update_buttons()
+
+    def _draw_ribbon_ghost(self, thread, contour, color):
+        if thread is self._ribbon_growing_thread:
+            self._draw_ghost(contour, color)
 
     def _draw_ghost(self, contour, color="Green"):
         if self._draw_ghosts:
@@ -477,89 +658,6 @@ class ContourFinderPanel(wx.Panel):
         self._canvas.Canvas.Draw()
 
 
-def _ribbon_building_bootstrap(slices):
-    assert len(slices) == 1 or len(slices) == 2
-    if len(slices) == 1:
-        mat = _estimate_initial_transformation(slices[0])
-        slic = slices[0]
-    else:
-        mat = _estimate_transformation(slices[0], slices[1])
-        slic = slices[1]
-
-    return slic, mat
-
-
-def _estimate_initial_transformation(slice):
-    mid_bottom = (slice[0] + slice[1]) / 2.0
-    mid_top = (slice[2] + slice[3]) / 2.0
-
-    translation = mid_bottom - mid_top
-
-    # The rotation angle would be:
-    # (a) the angle between the top and the bottom edge of the slice
-    # plus
-    # (b) the angle due to a possible wedge-shaped gap between slices.
-    # For now we assume that the top and bottom edge of the slice are parallel (IMPROVE)
-    # and the gap cannot be estimated from a single slice. So we assume the rotation angle to be zero for now.
-    # rotation_angle = 0
-
-    return _build_transformation_matrix(translation)
-
-
-def _estimate_transformation(slice1, slice2):
-    """
-    Estimate a rigid coordinate transformation that approximately maps one slice onto another.
-
-    :param slice1: the source slice, as a list of np.array([x,y]) vertex coordinates
-    :param slice2: the target slice (cfr slice1)
-    :return: a 3x3 numpy transformation matrix that transforms the coordinates of slice1 into the coordinates of the
-             approximate position of slice2, assuming that slice2 is attached at the bottom edge of slice1,
-             forming a ribbon. For now the transformation is always a simple translation.
-    """
-
-    # Estimate translation
-    mid_top1 = (slice1[2] + slice1[3]) / 2.0
-    mid_top2 = (slice2[2] + slice2[3]) / 2.0
-    translation = mid_top2 - mid_top1
-
-    # Estimate rotation from angle between top1 en top2, in degrees
-    # Not yet implemented!
-    # rotation_angle = 0
-
-    return _build_transformation_matrix(translation)
-
-
-def _build_transformation_matrix(translation):
-    # Note: if rotation ever needs to be implemented, then we will need both the rotation angle and the rotation
-    # center as additional arguments. The full transformation then consists of (1) translating the rotation center to
-    # the origin, (2) rotating, (3) translating back, and (4) the translation from one slice to the next.
-
-    tx, ty = translation
-
-    mat = np.array([[1, 0, tx],
-                    [0, 1, ty],
-                    [0, 0,  1]])
-    return mat
-
-
-def _transform_slice(slice, mat):
-    """
-    :param slice: a list of four 2x1 numpy arrays, one for each vertex in the slice outline
-    :param mat: the transformation matrix
-    :return: the transformed slice outline (as list of numpy arrays)
-    """
-
-    # Make homogeneous coordinates
-    slice = [np.array([x, y, 1.0]) for (x, y) in slice]
-
-    # Transform each vertex in the slice outline
-    slice = [np.dot(mat, vertex) for vertex in slice]
-
-    # From homogeneous coordinates back to *whataretheycalled?*, so drop the final 1
-    # (Also, but not obvious here: convert from numpy array to (x, y) pair as vertex representation)
-    return [vertex[0:2] for vertex in slice]
-
-
 def display_image(image, window='Preprocessed Overview Image', max_height=1080 - 100, max_width=1920 - 100):
     """
     Show an image in a window with a given maximum size on screen. The image will be scaled uniformly to fit the
@@ -0,0 +1,155 @@
+# Optimization strategies for ContourFinder, which maximizes the score of slice contours in a preprocessed overview image.
+#
+# All optimizers work on a batch of contours at once. A batch is a k x 2n numpy array, each row being the vector
+# representation [x1, y1, ..., xn, yn] of a contour. Optimizers with per-contour state (such as a momentum vector
+# or an adaptive step size) keep it for all k contours of the batch, so contours that have already converged
+# can be masked out of the remaining iterations.
+
+import numpy as np
+
+
+class ContourOptimizer:
+    NAME = None
+
+    def __init__(self, step_size):
+        self._step_size = step_size
+
+    def start(self, num_contours, num_coordinates):
+        # Called once before the first iteration, with the number of contours in the batch
+        # and the number of coordinates (2n) in each contour vector.
+        pass
+
+    def step(self, score_function, gradient_function, contour_vectors, indices):
+        """
+        Performs one iteration of the optimizer.
+        :param score_function: function that takes an m x 2n array of contour vectors and returns their m total scores
+        :param gradient_function: function that takes an m x 2n array of contour vectors and returns the m x 2n gradients of their scores
+        :param contour_vectors: m x 2n array with the contours that have not converged yet
+        :param indices: array with the m indices of these contours in the batch, to look up their optimizer state
+        :return: m x 2n array with the updated contour vectors
+        """
+        pass
+
+
+class GradientAscentOptimizer(ContourOptimizer):
+    # Plain gradient ascent with a fixed step size. We are looking for a maximum of the score,
+    # so we move along the positive gradient.
+    NAME = 'Gradient ascent'
+
+    def step(self, score_function, gradient_function, contour_vectors, indices):
+        return contour_vectors + self._step_size * gradient_function(contour_vectors)
+
+
+class MomentumOptimizer(ContourOptimizer):
+    # Gradient ascent with (heavy ball) momentum. The velocity accumulates consistent gradients,
+    # so contours far from an edge speed up, while oscillating gradient components cancel out.
+    NAME = 'Momentum'
+
+    def __init__(self, step_size, momentum=0.9):
+        ContourOptimizer.__init__(self, step_size)
+        self._momentum = momentum
+        self._velocity = None
+
+    def start(self, num_contours, num_coordinates):
+        self._velocity = np.zeros((num_contours, num_coordinates))
+
+    def step(self, score_function, gradient_function, contour_vectors, indices):
+        gradients = gradient_function(contour_vectors)
+        self._velocity[indices] = self._momentum * self._velocity[indices] + self._step_size * gradients
+        return contour_vectors + self._velocity[indices]
+
+
+class AdamOptimizer(ContourOptimizer):
+    # Adam (Kingma and Ba, 2015). The update is normalized by a running estimate of the gradient magnitude,
+    # so the step size is expressed in pixels and does not depend on the magnitude of the score.
+    NAME = 'Adam'
+
+    def __init__(self, step_size, beta1=0.9, beta2=0.999, eps=1e-8):
+        ContourOptimizer.__init__(self, step_size)
+        self._beta1 = beta1
+        self._beta2 = beta2
+        self._eps = eps
+        self._m = None  # first moment estimates
+        self._v = None  # second moment estimates
+        self._t = None  # number of updates of each contour
+
+    def start(self, num_contours, num_coordinates):
+        self._m = np.zeros((num_contours, num_coordinates))
+        self._v = np.zeros((num_contours, num_coordinates))
+        self._t = np.zeros(num_contours)
+
+    def step(self, score_function, gradient_function, contour_vectors, indices):
+        gradients = gradient_function(contour_vectors)
+        self._t[indices] += 1
+        self._m[indices] = self._beta1 * self._m[indices] + (1 - self._beta1) * gradients
+        self._v[indices] = self._beta2 * self._v[indices] + (1 - self._beta2) * gradients ** 2
+        t = self._t[indices][:, np.newaxis]
+        m_hat = self._m[indices] / (1 - self._beta1 ** t)
+        v_hat = self._v[indices] / (1 - self._beta2 ** t)
+        return contour_vectors + self._step_size * m_hat / (np.sqrt(v_hat) + self._eps)
+
+
+class LineSearchOptimizer(ContourOptimizer):
+    # Gradient ascent with backtracking line search: starting from twice the step size that was accepted
+    # in the previous iteration, the step size is halved until the score increases sufficiently (Armijo condition).
+    # The line searches of all contours in the batch are done together, so each backtracking round costs
+    # only one batched score evaluation.
+    NAME = 'Line search'
+
+    def __init__(self, step_size, shrink=0.5, grow=2.0, armijo=1e-4, max_backtracks=10):
+        ContourOptimizer.__init__(self, step_size)
+        self._shrink = shrink
+        self._grow = grow
+        self._armijo = armijo
+        self._max_backtracks = max_backtracks
+        self._step_sizes = None  # last accepted step size of each contour
+        self._scores = None  # score of the current contour, or nan if not known yet
+
+    def start(self, num_contours, num_coordinates):
+        self._step_sizes = np.full(num_contours, self._step_size / self._grow)
+        self._scores = np.full(num_contours, np.nan)
+
+    def step(self, score_function, gradient_function, contour_vectors, indices):
+        unknown = np.isnan(self._scores[indices])
+        if np.any(unknown):
+            self._scores[indices[unknown]] = score_function(contour_vectors[unknown])
+        scores = self._scores[indices]
+
+        gradients = gradient_function(contour_vectors)
+        squared_gradient_norms = np.sum(gradients ** 2, axis=1)
+
+        step_sizes = self._step_sizes[indices] * self._grow
+        new_contour_vectors = contour_vectors.copy()  # contours for which no acceptable step is found, stay where they are
+        new_scores = scores.copy()
+        searching = np.ones(len(indices), dtype=bool)
+        for backtrack in range(self._max_backtracks):
+            candidates = contour_vectors[searching] + step_sizes[searching][:, np.newaxis] * gradients[searching]
+            candidate_scores = score_function(candidates)
+            accepted = candidate_scores >= scores[searching] + self._armijo * step_sizes[searching] * squared_gradient_norms[searching]
+
+            accepted_indices = np.flatnonzero(searching)[accepted]
+            new_contour_vectors[accepted_indices] = candidates[accepted]
+            new_scores[accepted_indices] = candidate_scores[accepted]
+            searching[accepted_indices] = False
+            if not np.any(searching):
+                break
+            step_sizes[searching] *= self._shrink
+
+        self._step_sizes[indices] = step_sizes
+        self._scores[indices] = new_scores
+        return new_contour_vectors
+
+
+OPTIMIZERS = [GradientAscentOptimizer, MomentumOptimizer, AdamOptimizer, LineSearchOptimizer]
+
+
+def make_optimizer(name, step_size):
+    """
+    :param name: the NAME of one of the optimizers in OPTIMIZERS
+    :param step_size: the (initial) step size of the optimizer
+    :return: a new optimizer object
+    """
+    for optimizer_class in OPTIMIZERS:
+        if optimizer_class.NAME == name:
+            return optimizer_class(step_size)
+    raise ValueError('Unknown contour optimizer: {}'.format(name))
@@ -0,0 +1,131 @@
+# Gaussian blur with a choice of implementation.
+#
+# cv2.GaussianBlur() convolves the image with a separable Gaussian kernel, so its cost grows linearly with the kernel
+# size. For the very large kernels used in preprocessing (up to 163 pixels) a cascade of box filters is much faster:
+# each box filter costs the same regardless of its size (OpenCV uses running sums), and by the central limit theorem
+# a few successive box filters approximate a Gaussian well.
+#
+# Run this module to compare the speed and accuracy of the methods:
+#   python src/gaussian_blur.py
+
+import math
+import time
+import cv2
+import numpy as np
+
+# Blur methods
+EXACT_BLUR = 'exact'  # always cv2.GaussianBlur()
+FAST_BLUR = 'fast'  # cv2.GaussianBlur() for small kernels, a box filter cascade for large kernels
+BLUR_METHODS = [EXACT_BLUR, FAST_BLUR]
+
+# The fast blur method uses a box filter cascade for kernels of this size and larger
+FAST_BLUR_MIN_KERNEL_SIZE = 51
+
+# Number of box filters in the cascade. With 3 box filters the filter does not extend beyond the Gaussian kernel
+# that it approximates (so the same halo suffices for preprocessing in tiles). For the preprocessed edge images the
+# result typically differs only a few gray levels from cv2.GaussianBlur() (see benchmark() and fast_blur_error_bound()).
+# More box filters would not make the approximation much better, because OpenCV truncates its Gaussian kernel.
+BOX_FILTER_PASSES = 3
+
+
+def gaussian_blur(image, kernel_size, method=EXACT_BLUR):
+    """
+    Blurs an image with a Gaussian kernel, like cv2.GaussianBlur(image, (kernel_size, kernel_size), 0, 0).
+    :param image: a grayscale image
+    :param kernel_size: the size of the (square) kernel, must be odd; the standard deviation of the Gaussian is derived from it
+    :param method: EXACT_BLUR or FAST_BLUR; the fast method approximates the Gaussian by a cascade of box filters for large kernels
+    :return: the blurred image, of the same type as the input image
+    """
+    if method == EXACT_BLUR or kernel_size < FAST_BLUR_MIN_KERNEL_SIZE:
+        sigma_x, sigma_y = 0, 0   # 0 means calculate sigma from the kernel size
+        return cv2.GaussianBlur(image, (kernel_size, kernel_size), sigma_x, sigma_y)
+    elif method == FAST_BLUR:
+        return box_filter_cascade(image, box_filter_sizes(gaussian_sigma(kernel_size), BOX_FILTER_PASSES))
+    else:
+        raise ValueError('Unknown blur method: {}'.format(method))
+
+
+def gaussian_sigma(kernel_size):
+    """
+    Returns the standard deviation of the Gaussian that OpenCV uses for the given kernel size (when sigma is 0).
+    """
+    return 0.3 * ((kernel_size - 1) * 0.5 - 1) + 0.8
+
+
+def box_filter_sizes(sigma, num_passes):
+    """
+    Returns the sizes of num_passes successive box filters which together approximate a Gaussian with standard deviation sigma.
+    The sizes are odd (so the filters are centered) and differ at most by 2. See W. Wells, "Efficient synthesis of
+    Gaussian filters by cascaded uniform filters", IEEE PAMI, 1986; and P. Kovesi, "Fast almost-Gaussian filtering", DICTA 2010.
+    """
+    # A box filter of size w has variance (w*w - 1) / 12, the variances of the successive filters add up.
+    ideal_size = math.sqrt(12.0 * sigma * sigma / num_passes + 1)
+    lower_size = int(math.floor(ideal_size))
+    if lower_size % 2 == 0:
+        lower_size -= 1
+    upper_size = lower_size + 2
+    num_lower = int(round((12.0 * sigma * sigma - num_passes * lower_size * lower_size - 4 * num_passes * lower_size - 3 * num_passes) / (-4.0 * lower_size - 4)))
+    num_lower = max(0, min(num_passes, num_lower))
+    return [lower_size] * num_lower + [upper_size] * (num_passes - num_lower)
+
+
+def box_filter_cascade(image, sizes):
+    """
+    Filters an image with successive (normalized, square) box filters of the given sizes.
+    The intermediate results are floating point, and the result is rounded to the type of the input image.
+    """
+    result = image.astype(np.float32)
+    for size in sizes:
+        cv2.blur(result, (size, size), dst=result)
+    if image.dtype == np.float32:
+        return result
+    np.add(result, 0.5, out=result)  # round (rather than truncate) when converting back to integer
+    return result.astype(image.dtype)
+
+
+def fast_blur_error_bound(kernel_size):
+    """
+    Returns an upper bound on the difference between the fast and the exact blur of an image, relative to the maximum
+    intensity in the image: the L1 distance between the 2D box filter cascade kernel and the 2D Gaussian kernel.
+    The bound holds for any image, typical images have much smaller errors (see benchmark()).
+    """
+    if kernel_size < FAST_BLUR_MIN_KERNEL_SIZE:
+        return 0.0
+    box_kernel = np.ones(1)
+    for size in box_filter_sizes(gaussian_sigma(kernel_size), BOX_FILTER_PASSES):
+        box_kernel = np.convolve(box_kernel, np.ones(size) / size)
+    gaussian_kernel = cv2.getGaussianKernel(kernel_size, 0)[:, 0]
+    padding = (len(gaussian_kernel) - len(box_kernel)) // 2  # the box filter cascade is not larger than the Gaussian kernel
+    box_kernel = np.pad(box_kernel, (padding, padding), 'constant')
+    return np.sum(np.abs(np.outer(box_kernel, box_kernel) - np.outer(gaussian_kernel, gaussian_kernel)))
+
+
+def benchmark(image_size=4000, kernel_sizes=(31, 51, 63, 101, 131, 163)):
+    """
+    Compares the speed and accuracy of the fast blur method with the exact one, on a synthetic image similar to the
+    thresholded Laplacian that is blurred during preprocessing: a binary 16-bit image with thin curved edges.
+    The error is reported in gray levels of the 8-bit preprocessed image, together with the upper bound for any image.
+    """
+    rng = np.random.RandomState(0)
+    noise = cv2.GaussianBlur(rng.rand(image_size, image_size).astype(np.float32), (31, 31), 0)
+    edges = cv2.Laplacian(noise, cv2.CV_32F, ksize=5) > 0
+    image = edges.astype(np.uint16) * 65535
+
+    print('Kernel size  Exact (s)  Fast (s)  Speedup  Max error  Mean error  Error bound')
+    for kernel_size in kernel_sizes:
+        start = time.time()
+        exact = gaussian_blur(image, kernel_size, EXACT_BLUR)
+        exact_time = time.time() - start
+
+        start = time.time()
+        fast = gaussian_blur(image, kernel_size, FAST_BLUR)
+        fast_time = time.time() - start
+
+        error = np.abs((exact // 257).astype(np.int16) - (fast // 257).astype(np.int16))
+        error_bound = 255 * fast_blur_error_bound(kernel_size) + 1  # + 1 for rounding
+        print('{:11d}  {:9.3f}  {:8.3f}  {:7.1f}  {:9d}  {:10.3f}  {:11.1f}'.format(kernel_size, exact_time, fast_time, exact_time / fast_time,
+                                                                                  np.max(error), np.mean(error), error_bound))
+
+
+if __name__ == "__main__":
+    benchmark()
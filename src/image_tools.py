@@ -0,0 +1,96 @@
+# Image file I/O, pixel type conversion and intensity histogram functions.
+# Unlike tools.py, this module does not depend on wxPython, so it can be used without a GUI (e.g. by preprocess_overviews.py).
+
+import cv2
+import numpy as np
+
+
+def grayscale_image_16bit_to_8bit(image):
+    # Convert a 16-bit OpenCV grayscale image to 8-bit.
+    # The full 16-bit range is mapped onto 0 to 255.
+    assert image.dtype == np.uint16
+    # Each 8-bit value corresponds to 257 consecutive 16-bit values (65535 = 255 * 257 exactly), so the 8-bit value is floor(value / 257).
+    # convertScaleAbs() rounds instead of truncating, so we subtract 128/257, which yields exactly floor(value / 257) for all 16-bit values.
+    # (This is equivalent to (image / 257).astype(np.uint8), but without the temporary float64 image.)
+    return cv2.convertScaleAbs(image, alpha=1.0 / 257, beta=-128.0 / 257)
+
+
+def grayscale_image_float_to_8bit(image):
+    # Convert a floating point OpenCV grayscale image to 8-bit.
+    # The range between the lowest and the highest floating point pixel intensity
+    # is mapped linearly onto 0 to 255.
+    assert image.dtype == np.float64 or image.dtype == np.float32
+    min_val = np.min(image)
+    max_val = np.max(image)
+    # linearly map min to max -> 0 to 255
+    image = ((image - min_val) / (max_val - min_val) * 255).astype(np.uint8)
+    return image
+
+
+def read_image_as_grayscale(filename, flags=cv2.IMREAD_GRAYSCALE):
+    """
+    Reads an image file and returns it as an OpenCV image object.
+    This may be preferable over reading it through wxPython since (I think) wxPython expands grayscale images to RGB,
+    and this is not ideal since we are dealing with potentially large images.
+    :param filename: full file path of the image to read
+    :param flags: XXX e.g. cv2.IMREAD_GRAYSCALE to convert image to grayscale after reading;
+                           cv2.IMREAD_ANYDEPTH to preserve 16-bit images as 16-bit (otherwise we get 8-bit automatically)
+    :return: An OpenCV grayscale image object, or None on error.
+             The image is indexed like this: img[y, x].
+    """
+    img = cv2.imread(filename, flags)
+    return img
+
+
+def save_image(image, filename):
+    """
+    :param image: the image data as a numpy array (8-bit and 16-bit grayscale images are supported, when saving to TIFF)
+    :param filename: filename to save the image to; extension determines the file format type
+    :return: True if saving was successful, False otherwise
+    """
+    assert len(image.shape) == 2  # only grayscale has been tested
+    return cv2.imwrite(filename, image)
+
+
+def intensity_histogram(image, sample_step=1):
+    """
+    Returns the intensity histogram of an 8-bit or 16-bit grayscale image, with a bin for each possible intensity.
+    :param image: an OpenCV grayscale image, with pixel type np.uint8 or np.uint16
+    :param sample_step: if larger than 1, the histogram is estimated from a subsample of the image: only every sample_step-th
+           pixel of every sample_step-th row is counted. This is much faster for huge images, and usually accurate enough for percentiles.
+    :return: the histogram, as an (n x 1) numpy array with pixel counts (n = 256 for 8-bit, 65536 for 16-bit images)
+    """
+    if sample_step > 1:
+        image = np.ascontiguousarray(image[::sample_step, ::sample_step])
+    max_intensity = np.iinfo(image.dtype).max
+    num_bins = max_intensity + 1
+    return cv2.calcHist([image], [0], None, [num_bins], [0, max_intensity])
+
+
+def histogram_percentiles(histogram, percentiles):
+    """
+    Returns the intensities corresponding to any number of percentiles of an intensity histogram, in one vectorized lookup
+    in the cumulative histogram. The intensity for a percentile is the lowest intensity for which at least that percentage
+    of the pixels has an intensity smaller than or equal to it.
+    :param histogram: intensity histogram of an image, with a bin for each possible intensity (e.g. bins for 0, 1, 2,...65535
+           for a 16-bit image), for example as returned by intensity_histogram()
+    :param percentiles: a list or numpy array with the requested percentiles, e.g. [2, 98] for the 2nd and 98th percentile
+    :return: a numpy array with the intensity value for each of the percentiles
+    """
+    cumulative_histogram = np.cumsum(np.ravel(histogram), dtype=np.float64)
+    needed = cumulative_histogram[-1] * (np.asarray(percentiles, dtype=np.float64) / 100.0)
+    intensities = np.searchsorted(cumulative_histogram, needed, side='left')
+    return np.minimum(intensities, len(cumulative_histogram) - 1)
+
+
+def intensity_percentiles(image, percentiles, sample_step=1):
+    """
+    Returns the intensities corresponding to the given percentiles of the pixel intensities of an 8-bit or 16-bit grayscale image.
+    This is useful for contrast enhancement: stretching the range between e.g. the 2nd and 98th percentile ignores
+    a few very dark or very bright pixels (such as a thin dark border around microscope images).
+    :param image: an OpenCV grayscale image, with pixel type np.uint8 or np.uint16
+    :param percentiles: a list or numpy array with the requested percentiles
+    :param sample_step: see intensity_histogram()
+    :return: a numpy array with the intensity value for each of the percentiles
+    """
+    return histogram_percentiles(intensity_histogram(image, sample_step), percentiles)
@@ -110,4 +110,227 @@ def repeatedly_transform_point(quads, starting_point):
 
         return transformed_points
     except:
-        return None
\ No newline at end of file
+        return None
+
+
+# Vectorized versions of the functions above, for mapping many points (e.g. a grid of points of interest) at once.
+# Points that cannot be mapped get NaN coordinates (instead of an exception being thrown).
+
+# Columns of the quad coefficient table returned by quad_coefficients()
+X1, X2, X3, X4, Y1, Y2, Y3, Y4, A, B, C, D, E, F, SUM_X, SUM_Y, A_ETA = range(17)
+NUM_QUAD_COEFFICIENTS = 17
+
+# Takes a list of N quadrilaterals (or an (N, 4, 2) array with their (x, y) coordinates)
+# and returns an (N, NUM_QUAD_COEFFICIENTS) numpy array with, for each quad, its coefficients
+# for normalize_point_position() and unnormalize_point_position() that do not depend on the point:
+# the corner coordinates (with the y-axis flipped), A-F, the sum of the corner x and y coordinates, and the quadratic coefficient a.
+def quad_coefficients(quads):
+    q = np.asarray(quads, dtype = np.float64).reshape(-1, 4, 2)
+    x1 = q[:, 0, 0]; y1 = -q[:, 0, 1]
+    x2 = q[:, 1, 0]; y2 = -q[:, 1, 1]
+    x3 = q[:, 2, 0]; y3 = -q[:, 2, 1]
+    x4 = q[:, 3, 0]; y4 = -q[:, 3, 1]
+
+    coefficients = np.empty((q.shape[0], NUM_QUAD_COEFFICIENTS))
+    coefficients[:, X1] = x1; coefficients[:, X2] = x2; coefficients[:, X3] = x3; coefficients[:, X4] = x4
+    coefficients[:, Y1] = y1; coefficients[:, Y2] = y2; coefficients[:, Y3] = y3; coefficients[:, Y4] = y4
+    coefficients[:, A] = -x1 + x2 + x3 - x4
+    coefficients[:, B] = -x1 - x2 + x3 + x4
+    coefficients[:, C] =  x1 - x2 + x3 - x4
+    coefficients[:, D] = -y1 + y2 + y3 - y4
+    coefficients[:, E] = -y1 - y2 + y3 + y4
+    coefficients[:, F] =  y1 - y2 + y3 - y4
+    coefficients[:, SUM_X] = x1 + x2 + x3 + x4
+    coefficients[:, SUM_Y] = y1 + y2 + y3 + y4
+    coefficients[:, A_ETA] = coefficients[:, E] * coefficients[:, C] - coefficients[:, B] * coefficients[:, F]
+    return coefficients
+
+# Same as normalize_point_position(), but for an (m, 2) array with the (x, y) coordinates of m points.
+# coefficients is a row of the quad coefficient table (see quad_coefficients()).
+# Returns an (m, 2) numpy array with the normalized coordinates (xi, eta) of the points.
+def normalize_points(coefficients, points):
+    points = np.asarray(points, dtype = np.float64).reshape(-1, 2)
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):  # points that cannot be mapped get NaN coordinates
+        xi, eta = _normalize(coefficients, points[:, 0], -points[:, 1])
+    return np.column_stack((xi, eta))
+
+# Same as unnormalize_point_position(), but for an (m, 2) array with the normalized coordinates (xi, eta) of m points.
+# coefficients is a row of the quad coefficient table (see quad_coefficients()).
+# Returns an (m, 2) numpy array with the (x, y) coordinates of the points mapped onto the quad.
+def unnormalize_points(coefficients, points_normalized):
+    points_normalized = np.asarray(points_normalized, dtype = np.float64).reshape(-1, 2)
+    x, y = _unnormalize(coefficients, points_normalized[:, 0], points_normalized[:, 1])
+    return np.column_stack((x, -y))
+
+# Same as transform_point(), but for an (m, 2) array with the (x, y) coordinates of m points.
+def transform_points(quad1, quad2, points):
+    coefficients = quad_coefficients([quad1, quad2])
+    return unnormalize_points(coefficients[1], normalize_points(coefficients[0], points))
+
+# Same as repeatedly_transform_point(), but for an (m, 2) array with the (x, y) coordinates of m starting points in quad 1.
+# Returns an (N-1, m, 2) numpy array with the positions of the points in quads 2 to N.
+# The coefficient table of the quads (see quad_coefficients()) can be passed if it was already calculated,
+# the quads themselves are then not used.
+def repeatedly_transform_points(quads, starting_points, coefficients = None):
+    if coefficients is None:
+        coefficients = quad_coefficients(quads)
+    num_quads = coefficients.shape[0]
+    starting_points = np.asarray(starting_points, dtype = np.float64).reshape(-1, 2)
+    transformed_points = np.empty((max(num_quads - 1, 0), starting_points.shape[0], 2))
+    x = starting_points[:, 0]
+    y = -starting_points[:, 1]  # the y-axis stays flipped until the end
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):  # points that cannot be mapped get NaN coordinates
+        for i in range(0, num_quads - 1):
+            xi, eta = _normalize(coefficients[i], x, y)
+            x, y = _unnormalize(coefficients[i + 1], xi, eta)
+            transformed_points[i, :, 0] = x
+            transformed_points[i, :, 1] = -y
+    return transformed_points
+
+# Returns arrays with the normalized coordinates (xi, eta) of points with coordinates p_x, p_y (y-axis flipped)
+# relative to the quad with coefficients (a row of the quad coefficient table). See normalize_point_position().
+def _normalize(coefficients, p_x, p_y):
+    A_, B_, C_, D_, E_, F_, SUM_X_, SUM_Y_, a = coefficients[A:].tolist()
+
+    G = 4 * p_x - SUM_X_
+    H = 4 * p_y - SUM_Y_
+
+    b = F_ * G + E_ * A_ - B_ * D_ - C_ * H
+    c = G * D_ - H * A_
+
+    m = np.minimum(np.minimum(a, b), c)
+    aa = a / m
+    bb = b / m
+    cc = c / m
+
+    discriminant = bb ** 2 - 4 * aa * cc
+    discriminant[discriminant < 0] = np.nan  # (math.sqrt() throws an exception for negative discriminants)
+    root = np.sqrt(discriminant)
+    eta_minus = (-bb - root) / (2 * aa)
+    eta_plus = (-bb + root) / (2 * aa)
+
+    # Pick the eta solution that is closest to 0 (see normalize_point_position())
+    eta = np.where(np.abs(eta_minus) < np.abs(eta_plus), eta_minus, eta_plus)
+
+    xi = (G - B_ * eta) / (A_ + C_ * eta)
+    return xi, eta
+
+# Returns arrays with the coordinates x, y (y-axis flipped) of points with normalized coordinates xi, eta,
+# mapped onto the quad with coefficients (a row of the quad coefficient table). See unnormalize_point_position().
+def _unnormalize(coefficients, xi, eta):
+    x1, x2, x3, x4, y1, y2, y3, y4 = coefficients[X1:A].tolist()
+
+    Ni_1 = (1 - xi) * (1 - eta) / 4.0
+    Ni_2 = (1 + xi) * (1 - eta) / 4.0
+    Ni_3 = (1 + xi) * (1 + eta) / 4.0
+    Ni_4 = (1 - xi) * (1 + eta) / 4.0
+
+    x = Ni_1 * x1 + Ni_2 * x2 + Ni_3 * x3 + Ni_4 * x4
+    y = Ni_1 * y1 + Ni_2 * y2 + Ni_3 * y3 + Ni_4 * y4
+    return x, y
+
+# A cached quad coefficient table (see quad_coefficients()) for a list of quads, e.g. the slice polygons of the model,
+# so that mapping points through the quads does not recalculate the coefficients of all quads every time.
+# Quads that change must be reported with invalidate(). The table is updated when it is used: only the coefficients
+# of the invalidated quads and of quads that were added to the end of the list are recalculated.
+# If the list is replaced by another one, or becomes shorter, the whole table is rebuilt.
+class QuadTransformTable:
+    def __init__(self):
+        self._quads = None  # the list of quads for which the table was built
+        self._coefficients = np.empty((0, NUM_QUAD_COEFFICIENTS))
+        self._rows = []  # the rows of the coefficient table as lists of floats (for fast access to single coefficients)
+        self._invalid = set()  # indices of the quads whose coefficients must be recalculated
+
+    # Marks the coefficients of the quad with the given index (or of all quads if index is None) as outdated.
+    def invalidate(self, index = None):
+        if index is None:
+            self._quads = None
+        else:
+            self._invalid.add(index)
+
+    # Same as repeatedly_transform_point(quads[first_quad_index:], starting_point), using the cached coefficients.
+    # (For a single point this is faster than repeatedly_transform_points(), which has the overhead of numpy calls for each quad.)
+    def repeatedly_transform_point(self, quads, first_quad_index, starting_point):
+        try:
+            self._update(quads)
+            transformed_points = []
+            x = float(starting_point[0]); y = float(-starting_point[1])  # the y-axis stays flipped until the end
+            rows = self._rows
+            for i in range(first_quad_index, len(rows) - 1):
+                xi, eta = _normalize_point(rows[i], x, y)
+                x, y = _unnormalize_point(rows[i + 1], xi, eta)
+                transformed_points.append((x, -y))
+            return list(np.array(transformed_points).reshape(-1, 2))  # a list of 2D numpy arrays
+        except:
+            return None
+
+    # Same as repeatedly_transform_points(quads[first_quad_index:], starting_points), using the cached coefficients.
+    def repeatedly_transform_points(self, quads, first_quad_index, starting_points):
+        self._update(quads)
+        return repeatedly_transform_points(None, starting_points, self._coefficients[first_quad_index:])
+
+    def _update(self, quads):
+        num_cached = self._coefficients.shape[0]
+        rebuild = quads is not self._quads or len(quads) < num_cached
+        if rebuild:
+            indices = list(range(0, len(quads)))
+        else:
+            indices = sorted(i for i in self._invalid if i < num_cached) + list(range(num_cached, len(quads)))
+
+        # (like the functions above, only the first 4 vertices of a quad are used)
+        # The new coefficients are calculated before changing the table, so it stays consistent if this fails.
+        new_coefficients = quad_coefficients([quads[i][:4] for i in indices])
+
+        if rebuild:
+            self._coefficients = new_coefficients
+            self._rows = new_coefficients.tolist()
+        else:
+            if len(quads) > num_cached:
+                self._coefficients = np.concatenate((self._coefficients, np.empty((len(quads) - num_cached, NUM_QUAD_COEFFICIENTS))))
+                self._rows.extend([None] * (len(quads) - num_cached))
+            self._coefficients[indices] = new_coefficients
+            for i, row in zip(indices, new_coefficients.tolist()):
+                self._rows[i] = row
+        self._quads = quads
+        self._invalid.clear()
+
+# Returns the normalized coordinates (xi, eta) of the point (p_x, p_y) (y-axis flipped) relative to the quad with
+# coefficients (a row of the quad coefficient table, as a list). Same as normalize_point_position(), also its exceptions.
+def _normalize_point(coefficients, p_x, p_y):
+    A_, B_, C_, D_, E_, F_, SUM_X_, SUM_Y_, a = coefficients[A:]
+
+    G = 4 * p_x - SUM_X_
+    H = 4 * p_y - SUM_Y_
+
+    b = F_ * G + E_ * A_ - B_ * D_ - C_ * H
+    c = G * D_ - H * A_
+
+    aa = a / min(a, b, c)
+    bb = b / min(a, b, c)
+    cc = c / min(a, b, c)
+
+    discriminant = bb ** 2 - 4 * aa * cc
+    eta_minus = (-bb - math.sqrt(discriminant)) / (2 * aa)
+    eta_plus = (-bb + math.sqrt(discriminant)) / (2 * aa)
+
+    if abs(eta_minus) < abs(eta_plus):
+        eta = eta_minus
+    else:
+        eta = eta_plus
+
+    xi = (G - B_ * eta) / (A_ + C_ * eta)
+    return xi, eta
+
+# Returns the coordinates (x, y) (y-axis flipped) of the point with normalized coordinates (xi, eta) mapped onto
+# the quad with coefficients (a row of the quad coefficient table, as a list). Same as unnormalize_point_position().
+def _unnormalize_point(coefficients, xi, eta):
+    x1, x2, x3, x4, y1, y2, y3, y4 = coefficients[X1:A]
+
+    Ni_1 = (1 - xi) * (1 - eta) / 4.0
+    Ni_2 = (1 + xi) * (1 - eta) / 4.0
+    Ni_3 = (1 + xi) * (1 + eta) / 4.0
+    Ni_4 = (1 - xi) * (1 + eta) / 4.0
+
+    x = Ni_1 * x1 + Ni_2 * x2 + Ni_3 * x3 + Ni_4 * x4
+    y = Ni_1 * y1 + Ni_2 * y2 + Ni_3 * y3 + Ni_4 * y4
+    return x, y
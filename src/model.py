@@ -2,6 +2,8 @@
 # (c) Vlaams Instituut voor Biotechnologie (VIB)
 # 2018-2019
 
+import os
+import json
 import wx
 from pubsub import pub
 
@@ -29,6 +31,9 @@ class TomoModel:
     _KEY_EM_REGISTRATION_OUTPUT_FOLDER = 'em_registration_output_folder'
     _KEY_TEMPLATE_SLICE_PATH = 'template_slice_path'
     _KEY_PREPROCESSED_OVERVIEW_IMAGE_PATH = 'preprocessed_overview_image_path'
+    _KEY_PREPROCESSING_PARAMETERS = 'preprocessing_parameters'
+    _KEY_PREPROCESSING_CACHE_FOLDER = 'preprocessing_cache_folder'
+    _KEY_PREPROCESSING_CACHE_MAX_SIZE_MB = 'preprocessing_cache_max_size_mb'
 
     def __init__(self):
         # Data stored in persistent storage, e.g. user defined model parameters
@@ -52,6 +57,9 @@ class TomoModel:
         self.em_registration_output_folder = None
         self.template_slice_path = None
         self.preprocessed_overview_image_path = None  # the path of the most recently loaded preprocessed overview image
+        self.preprocessing_parameters = None  # dictionary with the most recently used overview image preprocessing parameters (see PreprocessDialog.get_preprocessing_parameters()), or None
+        self.preprocessing_cache_folder = None  # folder where preprocessed overview images are cached
+        self.preprocessing_cache_max_size_mb = 0  # maximum total size of the cached preprocessed overview images, in megabytes
 
         # Data not stored in persistent storage, e.g. derived parameters or data unlikely to remain the same for multiple experiments
         self.slice_polygons = []
@@ -107,6 +115,9 @@ class TomoModel:
         self.lm_registration_images_pixels_per_mm    = self._config.ReadFloat(TomoModel._KEY_LM_REGISTRATION_IMAGES_PIXELS_PER_MM, 0.0)
         self.template_slice_path                     = self._config.Read(TomoModel._KEY_TEMPLATE_SLICE_PATH, r'/home/secom/some/folder/template_slice_contour.json')
         self.preprocessed_overview_image_path        = self._config.Read(TomoModel._KEY_PREPROCESSED_OVERVIEW_IMAGE_PATH, r'/home/secom/development/tomo/data/preprocessed_overview_image.tif')
+        self.preprocessing_parameters                = json.loads(self._config.Read(TomoModel._KEY_PREPROCESSING_PARAMETERS, 'null'))
+        self.preprocessing_cache_folder              = self._config.Read(TomoModel._KEY_PREPROCESSING_CACHE_FOLDER, os.path.join(os.path.expanduser('~'), '.tomo', 'preprocessing_cache'))
+        self.preprocessing_cache_max_size_mb         = self._config.ReadInt(TomoModel._KEY_PREPROCESSING_CACHE_MAX_SIZE_MB, 4096)
 
     def write_parameters(self):
         self._config.Write(TomoModel._KEY_OVERVIEW_IMAGE_PATH, self.overview_image_path)
@@ -128,6 +139,9 @@ class TomoModel:
         self._config.WriteFloat(TomoModel._KEY_LM_REGISTRATION_IMAGES_PIXELS_PER_MM, self.lm_registration_images_pixels_per_mm)
         self._config.Write(TomoModel._KEY_TEMPLATE_SLICE_PATH, self.template_slice_path)
         self._config.Write(TomoModel._KEY_PREPROCESSED_OVERVIEW_IMAGE_PATH, self.preprocessed_overview_image_path)
+        self._config.Write(TomoModel._KEY_PREPROCESSING_PARAMETERS, json.dumps(self.preprocessing_parameters))
+        self._config.Write(TomoModel._KEY_PREPROCESSING_CACHE_FOLDER, self.preprocessing_cache_folder)
+        self._config.WriteInt(TomoModel._KEY_PREPROCESSING_CACHE_MAX_SIZE_MB, self.preprocessing_cache_max_size_mb)
         self._config.Flush()
 
     ###############################
@@ -126,8 +126,17 @@ class OverviewCanvas(TomoCanvas):
         if self._show_slice_numbers:
             self._add_slice_numbers()
 
-    def _add_slice_outlines(self):
-        for polygon in self._slice_polygons:
+    def add_slice_outlines(self):
+        # Adds outlines (and slice numbers) for the slice polygons that were appended to the list of slice polygons
+        # (which is shared with the model) since the last call to set_slice_polygons() or add_slice_outlines(),
+        # without recreating the outlines of the existing slices.
+        first_new_slice = len(self._slice_outlines)
+        self._add_slice_outlines(first_new_slice)
+        if self._show_slice_numbers:
+            self._add_slice_numbers(first_new_slice)
+
+    def _add_slice_outlines(self, first_slice=0):
+        for polygon in self._slice_polygons[first_slice:]:
             pts = [(p[0], -p[1]) for p in polygon]  # note: flip y to convert from image coordinates (with y >= 0) back to canvas coords
             outline = self.Canvas.AddPolygon(pts, LineColor=NORMAL_COLOR, LineWidth=REGULAR_LINE_WIDTH)
             self._slice_outlines.append(outline)
@@ -144,9 +153,10 @@ class OverviewCanvas(TomoCanvas):
 
         self._show_slice_numbers = show_numbers
 
-    def _add_slice_numbers(self):
-        self._slice_numbers = []
-        for i, polygon in enumerate(self._slice_polygons):
+    def _add_slice_numbers(self, first_slice=0):
+        if first_slice == 0:
+            self._slice_numbers = []
+        for i, polygon in enumerate(self._slice_polygons[first_slice:], first_slice):
             pos = tools.polygon_center(polygon)
             pos = (pos[0], -pos[1])
             obj = self.Canvas.AddText(str(i+1), pos, Size=10, BackgroundColor=None, Color=NORMAL_COLOR, Position="cc")
@@ -0,0 +1,207 @@
+# Parallel contour optimization on multiple CPU cores.
+#
+# Optimizing slice contours is embarrassingly parallel: each contour only depends on its initial position and on the
+# (read-only) preprocessed overview image. ParallelContourFinder distributes batches of contours, or whole ribbons
+# that need to be grown, over a pool of worker processes. The preprocessed image (and its image pyramid, if any) is
+# written once to temporary .npy files which the workers memory-map, so the large image is not pickled and sent to
+# the workers for each task.
+
+import os
+import atexit
+import weakref
+import shutil
+import tempfile
+import threading
+import traceback
+import multiprocessing
+import numpy as np
+from contour_finder import ContourFinder
+from ribbon_growing import grow_ribbon
+
+# How often (in seconds) a thread collecting results from the worker processes checks whether it must stop
+_POLL_INTERVAL = 0.2
+
+# The attributes of a ContourFinder that are sent to the workers with each task
+_OPTIMIZATION_PARAMETERS = ['h_for_gradient_approximation', 'max_iterations', 'gradient_step_size', 'edge_sample_distance',
+                            'vertex_distance_threshold', 'analytic_gradient', 'optimizer', 'adam_step_size']
+
+# The ParallelContourFinders that are not closed yet (see _close_open_contour_finders())
+_open_contour_finders = weakref.WeakSet()
+
+# State of a worker process: its memory-mapped images, and a contour finder whose cached derivative images of
+# these images are reused by subsequent tasks
+_worker_image_paths = None
+_worker_images = None
+_worker_contour_finder = None
+
+
+class SharedImages:
+    """
+    A list of images (e.g. the levels of an image pyramid) stored in temporary .npy files, so that other processes
+    can memory-map them instead of receiving a copy.
+    """
+
+    def __init__(self, images):
+        self._directory = tempfile.mkdtemp(prefix='tomo_shared_images_')
+        self.paths = []
+        for i, image in enumerate(images):
+            path = os.path.join(self._directory, 'image{}.npy'.format(i))
+            np.save(path, np.ascontiguousarray(image))
+            self.paths.append(path)
+
+    def close(self):
+        """
+        Deletes the temporary image files. The images must not be memory-mapped anymore by any process.
+        """
+        shutil.rmtree(self._directory, ignore_errors=True)
+        self.paths = []
+
+
+def load_shared_images(paths):
+    """
+    :param paths: the paths of the image files of a SharedImages object
+    :return: list with the read-only memory-mapped images
+    """
+    return [np.load(path, mmap_mode='r') for path in paths]
+
+
+class ParallelContourFinder:
+
+    def __init__(self, pyramid, num_processes=None):
+        """
+        :param pyramid: image pyramid of the preprocessed overview image, as returned by contour_finder.build_image_pyramid();
+               a list with only the preprocessed overview image itself is fine too (no coarse-to-fine optimization)
+        :param num_processes: number of worker processes; None to use as many as there are CPU cores
+        """
+        self._shared_images = SharedImages(pyramid)
+        self._pool = multiprocessing.Pool(num_processes)
+        self._closing = threading.Event()  # tells the threads collecting results to stop
+        self._collector_threads = []
+        _open_contour_finders.add(self)
+
+    def optimize_contours(self, contour_finder, initial_contours, contours_callback, done_callback=None, contours_per_task=4):
+        """
+        Optimizes contours in the worker processes, without waiting for the result. Batches of optimized contours are
+        passed to contours_callback as soon as they are ready, in the order in which they finish.
+        Note: the callbacks are called on a background thread, GUI code must forward them to the GUI thread (e.g. with wx.CallAfter).
+
+        :param contour_finder: ContourFinder with the optimization parameters to use
+        :param initial_contours: list of contours, each a list of (x,y) vertex coordinates
+        :param contours_callback: function(indices, contours) called for each batch of optimized contours,
+               with the indices of the contours in initial_contours and the optimized contours (list of (x,y) vertex coordinates)
+        :param done_callback: function() called when all contours are optimized (or when the optimization failed)
+        :param contours_per_task: number of contours that a worker optimizes together (batched) in one task
+        :return: the background thread that collects the results
+        """
+        parameters = {name: getattr(contour_finder, name) for name in _OPTIMIZATION_PARAMETERS}
+        tasks = [(self._shared_images.paths, parameters, list(range(i, min(i + contours_per_task, len(initial_contours)))), initial_contours[i:i + contours_per_task])
+                 for i in range(0, len(initial_contours), contours_per_task)]
+        return self._start_tasks(self._pool.imap_unordered, _optimize_contours_task, tasks,
+                                 lambda result: contours_callback(*result), done_callback)
+
+    def grow_ribbons(self, contour_finder, seed_slices, max_score_drop_ratio, ribbon_callback, done_callback=None):
+        """
+        Grows several ribbons concurrently in the worker processes (see ribbon_growing.grow_ribbon()), without waiting
+        for the result. Each ribbon is grown until its own termination criterion is met.
+        The ribbons are passed to ribbon_callback in the same order as their seeds, as soon as they (and all ribbons before them) are ready.
+        Note: the callbacks are called on a background thread, GUI code must forward them to the GUI thread (e.g. with wx.CallAfter).
+
+        :param contour_finder: ContourFinder with the optimization parameters to use
+        :param seed_slices: list with, for each ribbon, a list of one or two seed slice contours (see ribbon_growing.grow_ribbon())
+        :param max_score_drop_ratio: see ribbon_growing.terminate_ribbon_building()
+        :param ribbon_callback: function(ribbon_index, new_slices) called for each ribbon, with the index of its seed in seed_slices
+               and the list of new slice contours
+        :param done_callback: function() called when all ribbons are grown (or when ribbon growing failed)
+        :return: the background thread that collects the results
+        """
+        parameters = {name: getattr(contour_finder, name) for name in _OPTIMIZATION_PARAMETERS}
+        tasks = [(self._shared_images.paths, parameters, i, seeds, max_score_drop_ratio) for i, seeds in enumerate(seed_slices)]
+        return self._start_tasks(self._pool.imap, _grow_ribbon_task, tasks,
+                                 lambda result: ribbon_callback(*result), done_callback)
+
+    def busy(self):
+        """
+        :return: True if results of contour optimization or ribbon growing are still being collected
+        """
+        self._collector_threads = [thread for thread in self._collector_threads if thread.is_alive()]
+        return len(self._collector_threads) > 0
+
+    def _start_tasks(self, imap, task_function, tasks, result_callback, done_callback):
+        thread = threading.Thread(target=self._collect_results, args=(imap, task_function, tasks, result_callback, done_callback))
+        thread.daemon = True
+        self._collector_threads.append(thread)
+        thread.start()
+        return thread
+
+    def _collect_results(self, imap, task_function, tasks, result_callback, done_callback):
+        # The results are waited for with a timeout, because they never arrive once the pool is terminated by close().
+        try:
+            results = imap(task_function, tasks)
+            while not self._closing.is_set():
+                try:
+                    result = results.next(_POLL_INTERVAL)
+                except multiprocessing.TimeoutError:
+                    continue
+                except StopIteration:
+                    break
+                result_callback(result)
+        except Exception:
+            traceback.print_exc()
+        finally:
+            if done_callback is not None:
+                done_callback()
+
+    def close(self):
+        """
+        Stops the worker processes and deletes the shared image files. Contour optimizations that are still running are
+        aborted; the results that were not collected yet are dropped, but the done_callback is still called.
+        """
+        self._closing.set()
+        self._pool.terminate()
+        self._pool.join()
+        for thread in self._collector_threads:
+            thread.join()
+        self._collector_threads = []
+        self._shared_images.close()
+        _open_contour_finders.discard(self)
+
+
+def _close_open_contour_finders():
+    # When the application exits, the worker processes of the ParallelContourFinders that are still open are stopped
+    # and their temporary image files are deleted, otherwise these files would be left behind.
+    for finder in list(_open_contour_finders):
+        finder.close()
+
+
+atexit.register(_close_open_contour_finders)
+
+
+def _optimize_contours_task(task):
+    # Runs in a worker process.
+    image_paths, parameters, indices, initial_contours = task
+    images, contour_finder = _prepare_worker(image_paths, parameters)
+    contours = contour_finder.optimize_contours(images[0], initial_contours, images)
+    return indices, contours
+
+
+def _grow_ribbon_task(task):
+    # Runs in a worker process.
+    image_paths, parameters, ribbon_index, seed_slices, max_score_drop_ratio = task
+    images, contour_finder = _prepare_worker(image_paths, parameters)
+    new_slices = list(grow_ribbon(contour_finder, images[0], images, seed_slices, max_score_drop_ratio))
+    return ribbon_index, new_slices
+
+
+def _prepare_worker(image_paths, parameters):
+    # Memory-maps the shared images (if this worker did not do so already for a previous task)
+    # and sets the optimization parameters of the worker's contour finder.
+    global _worker_image_paths, _worker_images, _worker_contour_finder
+    if image_paths != _worker_image_paths:
+        _worker_image_paths = image_paths
+        _worker_images = load_shared_images(image_paths)
+        _worker_contour_finder = ContourFinder()
+
+    for name, value in parameters.items():
+        setattr(_worker_contour_finder, name, value)
+
+    return _worker_images, _worker_contour_finder
@@ -1,6 +1,8 @@
 import wx
 import mapping
 import numpy as np
+from pubsub import pub
+from model import MSG_SLICE_POLYGON_CHANGED
 from mark_mode import MarkMode
 from constants import POINTER_MODE_NAME
 import tools
@@ -16,6 +18,11 @@ class PointOfInterestPanel(wx.Panel):
         self._num_pois = 0
         self._predicted_pois = []
 
+        # Cached coefficients for mapping points of interest through the slice polygons,
+        # kept up to date with the changes of the slice polygons in the model.
+        self._quad_transform_table = mapping.QuadTransformTable()
+        pub.subscribe(self._on_slice_polygon_changed, MSG_SLICE_POLYGON_CHANGED)
+
         # Build the user interface
         title = wx.StaticText(self, wx.ID_ANY, "Point of interest")
         title.SetFont(wx.Font(12, wx.DEFAULT, wx.NORMAL, wx.BOLD))
@@ -71,6 +78,9 @@ class PointOfInterestPanel(wx.Panel):
 
         self._canvas.Canvas.Unbind(MarkMode.EVT_TOMO_MARK_LEFT_DOWN)
 
+    def _on_slice_polygon_changed(self, index, polygon):
+        self._quad_transform_table.invalidate(index)
+
     def on_poi_loaded_from_file(self):
         # Called when point of interest data was loaded from file
         # (in application_frame.py)
@@ -155,11 +165,12 @@ class PointOfInterestPanel(wx.Panel):
         # We will only predict points-of-interest in subsequent slices.
 
         original_point_of_interest = poi_coords
-        slice_polygons = self._model.slice_polygons[reference_slice_index:]
 
-        transformed_points_of_interest = mapping.repeatedly_transform_point(slice_polygons, original_point_of_interest)
+        transformed_points_of_interest = self._quad_transform_table.repeatedly_transform_point(self._model.slice_polygons, reference_slice_index,
+                                                                                               original_point_of_interest)
         if transformed_points_of_interest is None:
             print("An error occurred while calculating predicted points-of-interest.")  # IMPROVEME: display a warning message (e.g. in red) in the panel instead.
+            transformed_points_of_interest = []
 
         return [original_point_of_interest] + transformed_points_of_interest
 
@@ -56,6 +56,14 @@ class PolygonEditorMixin:
     def _on_polygon_model_change(self, index, polygon):
         self._remove_slice_handles()
         self._add_slice_handles(self._selector.get_selected_slices())
+        if self._active_handle:
+            # The mouse is still over a handle (e.g. the one that was just dragged), make its replacement the active handle.
+            _, slice_idx, vertex_idx = self._active_handle
+            self._active_handle = None
+            for handle in self._handles:
+                if handle[1] == slice_idx and handle[2] == vertex_idx:
+                    handle[0].SetColor(ACTIVE_COLOR)
+                    self._active_handle = handle
         self._canvas.redraw(True)
 
     def _on_left_mouse_button_down(self, event):
@@ -100,7 +108,10 @@ class PolygonEditorMixin:
     def _on_left_mouse_button_up(self, event):
         # Check if user was dragging a handle and released it
         if self._dragging:
+            _, slice_idx, _ = self._dragging
             self._dragging = None
+            # While dragging the polygon was modified in place, now notify the listeners of the change
+            self._model.set_slice_polygon(slice_idx, self._model.slice_polygons[slice_idx])
             return
 
     def _add_slice_handles(self, slices):
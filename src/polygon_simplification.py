@@ -5,6 +5,10 @@
 
 import sys
 import math
+import time
+import heapq
+import multiprocessing
+import numpy as np
 
 
 # input:
@@ -13,34 +17,110 @@ import math
 # - acute_threshold: XXXX
 # output:
 # - output polygon with 'num' vertices (or the input polygon in case it had fewer than 'num' vertices already)
+#
+# The remaining vertices are kept in a doubly linked ring, and their importance in a priority queue (heap),
+# so the polygon is reduced in O(n log n) time. The result is the same as when repeatedly removing
+# the least important vertex (the first one in case of a tie) from a list, and recalculating the importance
+# of its neighbors. Like before, poly itself is reduced too.
 def reduce_polygon(poly, num, acute_threshold = 0):
     numv = len(poly)
+    if numv <= num:
+        return poly
+
+    # Doubly linked ring with the indices (in poly) of the vertices that are not removed yet
+    prev = [(v - 1) % numv for v in range(0, numv)]
+    next = [(v + 1) % numv for v in range(0, numv)]
+    removed = [False] * numv
 
     # Calculate initial importance of each vertex
-    imp = [vertex_importance(v, poly, numv, acute_threshold) for v in range(0, numv)]
+    imp = vertex_importances(poly, acute_threshold).tolist()
+
+    # Priority queue with (importance, vertex index). When the importance of a vertex changes, a new entry is added
+    # instead of updating the existing one; outdated entries are skipped when they come out of the queue.
+    heap = [(imp[v], v) for v in range(0, numv)]
+    heapq.heapify(heap)
 
     # Repeatedly remove the least important vertex until we end up
     # with a reduced polygon with the desired number of vertices.
     while numv > num:
         # Find least important vertex
-        _, i = min((imp[i], i) for i in range(0, len(imp)))  # i = argmin(imp) = index in imp with lowest importance
+        importance, i = heapq.heappop(heap)
+        if removed[i] or importance != imp[i]:
+            continue  # outdated entry
 
         # Remove least important vertex
-        del (poly[i])
-        del (imp[i])
+        removed[i] = True
         numv = numv - 1
+        vm = prev[i]
+        vp = next[i]
+        next[vm] = vp
+        prev[vp] = vm
 
         # Recalculate the importance values of the vertices
         # next to the vertex that was removed
-        vm = (i - 1) % numv
-        vp = i % numv
-
-        imp[vp] = vertex_importance(vp, poly, numv, acute_threshold)
-        imp[vm] = vertex_importance(vm, poly, numv, acute_threshold)
+        for v in (vp, vm):
+            imp[v] = _importance(poly[prev[v]], poly[v], poly[next[v]], acute_threshold)
+            heapq.heappush(heap, (imp[v], v))
 
     # Return the reduced polygon
+    poly[:] = [poly[v] for v in range(0, len(poly)) if not removed[v]]
     return poly
 
+# Simplifies a list of polygons (see reduce_polygon()).
+# inputs
+#    polys: list of polygons, each a list of vertex (x,y) pairs
+#    nums: desired number of vertices in the reduced polygons; a list with a number for each polygon, or a single number for all polygons
+#    acute_threshold: see reduce_polygon()
+#    num_processes: number of worker processes that simplify polygons concurrently; 1 to simplify them one after another
+#                   in this process, or None to use as many processes as there are CPU cores
+# returns:
+#    list with the reduced polygons, in the same order as polys (unlike reduce_polygon(), polys itself is not changed)
+def reduce_polygons(polys, nums, acute_threshold = 0, num_processes = 1):
+    if not isinstance(nums, (list, tuple)):
+        nums = [nums] * len(polys)
+    tasks = [(list(poly), num, acute_threshold) for poly, num in zip(polys, nums)]
+    if num_processes == 1 or len(tasks) <= 1:
+        return [_reduce_polygon_task(task) for task in tasks]
+    pool = multiprocessing.Pool(num_processes)
+    try:
+        return pool.map(_reduce_polygon_task, tasks)
+    finally:
+        pool.close()
+        pool.join()
+
+def _reduce_polygon_task(task):
+    # Reduces a single polygon (possibly in a worker process).
+    poly, num, acute_threshold = task
+    return reduce_polygon(poly, num, acute_threshold)
+
+# Returns a numpy array with the importance of each vertex of polygon poly (a list of vertex (x,y) pairs);
+# the same as vertex_importance() for each vertex, but calculated for all vertices at once.
+def vertex_importances(poly, acute_threshold):
+    p = np.asarray(poly, dtype = np.float64).reshape(-1, 2)
+    pm = np.roll(p, 1, axis = 0)  # previous vertex
+    pp = np.roll(p, -1, axis = 0)  # next vertex
+
+    dir1 = p - pm
+    dir2 = pp - p
+
+    len1 = np.hypot(dir1[:, 0], dir1[:, 1])
+    len2 = np.hypot(dir2[:, 0], dir2[:, 1])
+
+    len1_len2 = len1 * len2
+    eps = 1.0e-20
+    degenerate = len1_len2 < eps
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):  # degenerate vertices get importance 0 anyway
+        a = (dir1[:, 0] * dir2[:, 0] + dir1[:, 1] * dir2[:, 1]) / len1_len2
+
+    # Clip a to the domain of acos ([-1, 1]).
+    # Due to numeric inaccuracies a is sometimes slightly outside this interval
+    a = np.clip(a, -1, 1)
+
+    angle = np.arccos(a)    # 0 <= angle <= pi
+    importance = angle * len1_len2
+    importance[degenerate | (angle > math.pi - acute_threshold)] = 0
+    return importance
+
 # inputs
 #    v: index of vertex whose importance we will calculate
 #    poly: list [(x,y)] with vertex coordinates; only the first numv element are valid
@@ -54,9 +134,12 @@ def vertex_importance(v, poly, numv, acute_threshold):
     vp = (v + 1) % numv
     vm = (v - 1) % numv
 
-    #
-    dir1 = (poly[v][0] - poly[vm][0], poly[v][1] - poly[vm][1])
-    dir2 = (poly[vp][0] - poly[v][0], poly[vp][1] - poly[v][1])
+    return _importance(poly[vm], poly[v], poly[vp], acute_threshold)
+
+# Returns the importance of vertex p, with neighboring vertices pm (before p) and pp (after p).
+def _importance(pm, p, pp, acute_threshold):
+    dir1 = (p[0] - pm[0], p[1] - pm[1])
+    dir2 = (pp[0] - p[0], pp[1] - p[1])
 
     len1 = math.hypot(dir1[0], dir1[1])
     len2 = math.hypot(dir2[0], dir2[1])
@@ -78,3 +161,38 @@ def vertex_importance(v, poly, numv, acute_threshold):
             return 0
         else:
             return angle * len1_len2
+
+
+# Simplifies synthetic ribbon outlines of increasing size, like the findContours() outlines that SegmentationPanel
+# simplifies before segmenting the ribbons (to 5 vertices per slice), and prints the time it takes.
+def benchmark(num_vertices_list = (1000, 5000, 50000), vertices_per_slice = 5):
+    print('Vertices  Slices  Time (s)')
+    for num_vertices in num_vertices_list:
+        poly, num_slices = _synthetic_ribbon_outline(num_vertices)
+        num_outline_vertices = len(poly)
+        start = time.time()
+        reduce_polygon(poly, num_slices * vertices_per_slice)
+        print('{:8d}  {:6d}  {:8.3f}'.format(num_outline_vertices, num_slices, time.time() - start))
+
+# Returns a closed outline with about num_vertices integer vertices, one pixel apart (like the outlines found by
+# cv2.findContours() without contour approximation), of a ribbon of trapezoid slices with notches between the slices.
+# Also returns the number of slices.
+def _synthetic_ribbon_outline(num_vertices, slice_width = 400, slice_height = 300, notch = 40):
+    num_slices = max(1, int(round(num_vertices / (2.0 * slice_width))))  # the outline of a slice has about 2 * slice_width vertices
+    top = []
+    bottom = []
+    for i in range(0, num_slices):
+        x = i * slice_width
+        top += [(x, notch), (x + notch, 0), (x + slice_width - notch, 0)]
+        bottom += [(x, slice_height - notch), (x + notch, slice_height), (x + slice_width - notch, slice_height)]
+    length = num_slices * slice_width
+    corners = top + [(length, notch), (length, slice_height - notch)] + bottom[::-1]
+    poly = []
+    for (x1, y1), (x2, y2) in zip(corners, corners[1:] + corners[:1]):
+        steps = max(abs(x2 - x1), abs(y2 - y1))
+        poly += [(x1 + (x2 - x1) * k // steps, y1 + (y2 - y1) * k // steps) for k in range(0, steps)]
+    return poly, num_slices
+
+
+if __name__ == "__main__":
+    benchmark()
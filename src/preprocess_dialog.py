@@ -4,10 +4,16 @@
 
 import numpy as np
 import os
+import multiprocessing
 import cv2
 import wx
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
 import matplotlib
 import tools
+from gaussian_blur import EXACT_BLUR, FAST_BLUR
+from preprocessing import (PreprocessingPipeline, preprocess_tiled, preprocessing_halo, scaled_preprocessing_parameters,
+                           relevant_intensity_range, get_max_possible_intensity)
 matplotlib.use('wxagg')
 from matplotlib import pyplot as plt
 
@@ -20,14 +26,27 @@ class PreprocessDialog(wx.Dialog):
         self._model = model
 
         # Preprocessing parameters
-        self.histogram, self.lo_percentile_val, self.hi_percentile_val = relevant_intensity_range(self.orig_img, 2, 98)  # we need to do this on the full original image, but rest of interactive preprocessing will be on a cropped version of the original, for speed.
-        self.step = 0   # preprocessing step (0=original image, 1=blurred image, 2=..., 5=final preprocessed result)
+        self.lo_percentile = 2
+        self.hi_percentile = 98
         self.gaussian_kernel1_size = 29  # must be odd; larger kernels will suppress noise more
         self.gaussian_kernel2_size = 63  # must be odd; larger kernels will result in a wider edge, useful for attracting approximate slice contours from further away
         self.laplacian_delta = -270
+        self.edge_blur_method = EXACT_BLUR  # EXACT_BLUR or FAST_BLUR (faster for large edge blur kernels, but approximate)
+        if model.preprocessing_parameters is not None:  # start from the most recently used parameters
+            self.set_preprocessing_parameters(model.preprocessing_parameters)
+
+        self.histogram, self.lo_percentile_val, self.hi_percentile_val = relevant_intensity_range(self.orig_img, self.lo_percentile, self.hi_percentile)  # we need to do this on the full original image, but rest of interactive preprocessing will be on (a downsampled version of) the part of the image that is shown, for speed.
+        self.step = 0   # preprocessing step (0=original image, 1=blurred image, 2=..., 5=final preprocessed result)
+
+        # The preview initially shows the whole image, at reduced resolution.
+        # The user can zoom in (down to full resolution) and drag the preview to pan.
+        self._preview = PreprocessingPreview(img)
+        self.preview_level = self._preview.whole_image_level  # pyramid level shown in the preview (0=full resolution)
+        height, width = img.shape[:2]
+        self.preview_center = (width // 2, height // 2)  # center of the preview, in full resolution image coordinates
 
-        self.tile_top_left = (0, 0)
-        self.orig_img_crop = get_tile(img, self.tile_top_left[0], self.tile_top_left[1])
+        self._pipeline = PreprocessingPipeline()  # remembers the preprocessing step results of preprocess(), so that only the steps affected by a parameter change are recalculated
+        self._preview_update = None  # wx.CallLater for updating the preview after a slider change
 
         # Results of different preprocessing steps
         self.contrast_enhanced_img = None
@@ -44,14 +63,19 @@ class PreprocessDialog(wx.Dialog):
 
         slider_size = (250, -1)
         self.step_slider = wx.Slider(self, value=self.step, minValue=0, maxValue=5, style=wx.SL_HORIZONTAL | wx.SL_LABELS, size=slider_size)
+        self.zoom_slider = wx.Slider(self, value=self._preview.whole_image_level - self.preview_level, minValue=0, maxValue=max(1, self._preview.whole_image_level), style=wx.SL_HORIZONTAL | wx.SL_LABELS, size=slider_size)  # 0=whole image, maximum=full resolution
         self.blur1_slider = wx.Slider(self, value=(self.gaussian_kernel1_size - 3) / 2, minValue=0, maxValue=20, style=wx.SL_HORIZONTAL | wx.SL_LABELS, size=slider_size)
         self.delta_slider = wx.Slider(self, value=self.laplacian_delta, minValue=-500, maxValue=500, style=wx.SL_HORIZONTAL | wx.SL_LABELS, size=slider_size)
         self.blur2_slider = wx.Slider(self, value=(self.gaussian_kernel2_size - 3) / 2, minValue=0, maxValue=80, style=wx.SL_HORIZONTAL | wx.SL_LABELS, size=slider_size)
 
         self.step_slider.Bind(wx.EVT_SLIDER, self._on_preprocessing_step)
+        self.zoom_slider.Bind(wx.EVT_SLIDER, self._on_preview_zoom)
         self.blur1_slider.Bind(wx.EVT_SLIDER, self._on_gaussian1_kernel_size)
         self.delta_slider.Bind(wx.EVT_SLIDER, self._on_laplacian_delta)
         self.blur2_slider.Bind(wx.EVT_SLIDER, self._on_gaussian2_kernel_size)
+        self.edge_blur_method_choice = wx.Choice(self, wx.ID_ANY, choices=[label for label, _ in EDGE_BLUR_METHODS])
+        self.edge_blur_method_choice.SetSelection([method for _, method in EDGE_BLUR_METHODS].index(self.edge_blur_method))
+        self.edge_blur_method_choice.Bind(wx.EVT_CHOICE, self._on_edge_blur_method)
         self.Bind(wx.EVT_BUTTON, self._on_show_histogram, histogram_button)
         self.Bind(wx.EVT_BUTTON, self._on_accept, accept_button)
         self.Bind(wx.EVT_BUTTON, self._on_cancel, cancel_button)
@@ -63,6 +87,8 @@ class PreprocessDialog(wx.Dialog):
         self.image_ctrl.Bind(wx.EVT_LEFT_UP, self._on_left_up)
 
         sliders_sizer = wx.FlexGridSizer(cols=2, vgap=4, hgap=14)
+        sliders_sizer.Add(wx.StaticText(self, wx.ID_ANY, "Preview Zoom:"), flag=wx.LEFT | wx.ALIGN_RIGHT)
+        sliders_sizer.Add(self.zoom_slider, flag=wx.RIGHT)
         sliders_sizer.Add(wx.StaticText(self, wx.ID_ANY, "Preprocessing Step:"), flag=wx.LEFT | wx.ALIGN_RIGHT)
         sliders_sizer.Add(self.step_slider, flag=wx.RIGHT)
         sliders_sizer.Add(wx.StaticText(self, wx.ID_ANY, "Denoising Blur:"), flag=wx.LEFT | wx.ALIGN_RIGHT)
@@ -71,6 +97,8 @@ class PreprocessDialog(wx.Dialog):
         sliders_sizer.Add(self.delta_slider, flag=wx.RIGHT)
         sliders_sizer.Add(wx.StaticText(self, wx.ID_ANY, "Edge Blur:"), flag=wx.LEFT | wx.ALIGN_RIGHT)
         sliders_sizer.Add(self.blur2_slider, flag=wx.RIGHT)
+        sliders_sizer.Add(wx.StaticText(self, wx.ID_ANY, "Edge Blur Method:"), flag=wx.LEFT | wx.ALIGN_RIGHT | wx.ALIGN_CENTER_VERTICAL)
+        sliders_sizer.Add(self.edge_blur_method_choice, flag=wx.RIGHT)
 
         controls = wx.BoxSizer(wx.VERTICAL)
         controls.Add(sliders_sizer, 0, wx.ALL | wx.EXPAND, border=b)
@@ -87,44 +115,49 @@ class PreprocessDialog(wx.Dialog):
         self.SetSizer(contents)
         contents.Fit(self)
 
-        # Preprocess the selected tile and show it in the window
-        self.preprocess(self.orig_img_crop)
+        # Preprocess the visible part of the image and show it in the window
         self._redraw_window()
 
+    def get_preprocessing_parameters(self):
+        """
+        :return: a dictionary with the preprocessing parameters (e.g. for storing them, or as part of a cache key)
+        """
+        return {'lo_percentile': self.lo_percentile,
+                'hi_percentile': self.hi_percentile,
+                'gaussian_kernel1_size': self.gaussian_kernel1_size,
+                'laplacian_delta': self.laplacian_delta,
+                'gaussian_kernel2_size': self.gaussian_kernel2_size,
+                'edge_blur_method': self.edge_blur_method}
+
+    def set_preprocessing_parameters(self, parameters):
+        self.lo_percentile = parameters['lo_percentile']
+        self.hi_percentile = parameters['hi_percentile']
+        self.gaussian_kernel1_size = parameters['gaussian_kernel1_size']
+        self.laplacian_delta = parameters['laplacian_delta']
+        self.gaussian_kernel2_size = parameters['gaussian_kernel2_size']
+        self.edge_blur_method = parameters.get('edge_blur_method', EXACT_BLUR)  # older parameters do not have an edge blur method
+
     def preprocess(self, img):
-        # Imporant note: for the iterative contour finding to work well, the preprocessed image should have an intensity profile around the edges
-        # that varies smoothly, from relatively "far" from the edge, and with no local minima/maxima in the neighborhood.
-
-        # Contrast enhancement
-        lo_val, hi_val = self.lo_percentile_val, self.hi_percentile_val
-        self.contrast_enhanced_img = enhance_contrast(img, lo_val, hi_val)
-        # print('Contrast enhanced: shape={} dtype={} min={} max={}'.format(self.contrast_enhanced_img.shape, self.contrast_enhanced_img.dtype, np.min(self.contrast_enhanced_img), np.max(self.contrast_enhanced_img)))
-
-        # Gaussian blurring to remove some of the noise,
-        # Needed because afterwards we will use the Laplacian to detect edges,
-        # and this is very sensitive to the presence of noise.
-        kernel_size = (self.gaussian_kernel1_size, self.gaussian_kernel1_size)  # must be odd
-        sigma_x, sigma_y = 0, 0   # 0 means calculate sigma from the kernel size
-        self.blurred_img = cv2.GaussianBlur(self.contrast_enhanced_img, kernel_size, sigma_x, sigma_y)
-
-        # Laplacian (of the Gaussian) to detect edges.
-        # Note the use of an offset (self.laplacian_delta).
-        self.laplacian = cv2.Laplacian(self.blurred_img, cv2.CV_64F, 5, scale=1, delta=self.laplacian_delta)
-        # print('Laplacian (of Gaussian) 5 scale=1, delta={}: shape={} dtype={} min={} max={}'.format(self.laplacian_delta, self.laplacian.shape, self.laplacian.dtype, np.min(self.laplacian), np.max(self.laplacian)))
-
-        # The Laplacian is now a floating point image, having negative values.
-        # Threshold it to positive values to keep only the edges.
-        self.abs_laplacian = (self.laplacian > 0).astype(np.uint16) * 65535  # self.laplacian > 0  means edges
-
-        # Perform Gaussian blur on the detected edges, this is needed for the active contours lateron
-        # to feel the attraction of an edge even some distance away from the edge.
-        kernel_size = (self.gaussian_kernel2_size, self.gaussian_kernel2_size)  # must be odd
-        sigma_x, sigma_y = 0, 0   # 0 means calculate sigma from the kernel size
-        self.result = cv2.GaussianBlur(self.abs_laplacian, kernel_size, sigma_x, sigma_y)
-        # print('Gaussian of Laplacian of Gaussian: shape={} dtype={} min={} max={}'.format(self.abs_laplacian.shape, self.abs_laplacian.dtype, np.min(self.abs_laplacian), np.max(self.abs_laplacian)))
-
-        # Convert images to 8-bit so they can be more easily turned into wxPython bitmaps for viewing
-        self.result = tools.grayscale_image_16bit_to_8bit(self.result)
+        # Note: only the preprocessing steps whose parameters (or input image) changed since the previous call are recalculated.
+        (self.contrast_enhanced_img,
+         self.blurred_img,
+         self.laplacian,
+         self.abs_laplacian,
+         self.result) = self._pipeline.run(img, self.lo_percentile_val, self.hi_percentile_val,
+                                           self.gaussian_kernel1_size, self.laplacian_delta, self.gaussian_kernel2_size,
+                                           self.edge_blur_method)
+        return self.result
+
+    def preprocess_tiled(self, img, num_threads=None):
+        """
+        Preprocesses a (large) image tile by tile, on multiple threads. The result is identical to that of preprocess(),
+        but the intermediate results of the preprocessing steps are not kept, so this needs much less memory.
+        Afterwards get_preprocessed_image() returns the preprocessed image.
+        """
+        self.contrast_enhanced_img = self.blurred_img = self.laplacian = self.abs_laplacian = None
+        self.result = preprocess_tiled(img, self.lo_percentile_val, self.hi_percentile_val,
+                                       self.gaussian_kernel1_size, self.laplacian_delta, self.gaussian_kernel2_size,
+                                       self.edge_blur_method, num_threads=num_threads)
         return self.result
 
     #
@@ -187,25 +220,23 @@ class PreprocessDialog(wx.Dialog):
         tools.save_image(self.blurred_img, os.path.join(output_dir, "intermediate_3_blurred.png"))
         tools.save_image(self.abs_laplacian, os.path.join(output_dir, "intermediate_4_abs_laplacian.png"))
         tools.save_image(self.result, os.path.join(output_dir, "intermediate_5_blurred.png"))
-        # Restore normal state (= the preprocessed cropped image)
-        self.preprocess(self.orig_img_crop)
 
     def _on_accept(self, event):
         if False:  # for testing only
             self.save_intermediate_preprocessing_steps('e:\\')
+        self._stop_preview_update()
         self.EndModal(wx.OK)
 
     def _on_cancel(self, event):
+        self._stop_preview_update()
         self.EndModal(wx.CANCEL)
 
     def _redraw_window(self):
-        images = { 0: self.orig_img_crop,
-                   1: self.contrast_enhanced_img,
-                   2: self.blurred_img,
-                   3: self.laplacian,
-                   4: self.abs_laplacian,
-                   5: self.result }
-        img = images.get(self.step)
+        # Only the tiles of the preview that were not preprocessed before (with the current parameters) are preprocessed now.
+        x, y = self._preview_top_left()
+        img = self._preview.render(self.preview_level, x, y, self.step, self.lo_percentile_val, self.hi_percentile_val,
+                                   self.gaussian_kernel1_size, self.laplacian_delta, self.gaussian_kernel2_size,
+                                   self.edge_blur_method)
 
         # Pad the image in case it is smaller than the tile size (this occurs for tiles at the right and bottom of the image),
         # so that the previously drawn tile (possible larger) is erased.
@@ -220,21 +251,35 @@ class PreprocessDialog(wx.Dialog):
         self._move_down_position = (x, y)
 
     def _on_left_up(self, event):
-        # Figure out the new top-left corner of the preview
+        # Figure out the new center of the preview. The mouse moved dx, dy pixels in the preview,
+        # which corresponds to 2 ** preview_level as many pixels in the full resolution image.
         x, y = event.GetPosition()
         prevx, prevy = self._move_down_position
-        dx = x - prevx
-        dy = y - prevy
+        scale = 2 ** self.preview_level
+        dx = (x - prevx) * scale
+        dy = (y - prevy) * scale
         height, width = self.orig_img.shape[:2]
-        topleftx = min(max(0, self.tile_top_left[0] - dx), width - TILE_SIZE)
-        toplefty = min(max(0, self.tile_top_left[1] - dy), height - TILE_SIZE)
+        centerx = min(max(0, self.preview_center[0] - dx), width - 1)
+        centery = min(max(0, self.preview_center[1] - dy), height - 1)
 
         # Update the preview bitmap with the new preview tile
-        self.tile_top_left = (topleftx, toplefty)
-        self.orig_img_crop = get_tile(self.orig_img, topleftx, toplefty)
-        self.preprocess(self.orig_img_crop)
+        self.preview_center = (centerx, centery)
+        self._redraw_window()
+
+    def _on_preview_zoom(self, event):
+        zoom = event.GetEventObject().GetValue()  # 0=whole image, higher values zoom in
+        self.preview_level = max(0, self._preview.whole_image_level - zoom)
         self._redraw_window()
 
+    def _preview_top_left(self):
+        # Returns the top left corner of the preview, in the coordinates of the current preview pyramid level.
+        # The preview is centered on preview_center, but it does not extend beyond the image (if possible).
+        height, width = self._preview.level_shape(self.preview_level)
+        scale = 2 ** self.preview_level
+        x = min(max(0, self.preview_center[0] // scale - TILE_SIZE // 2), max(0, width - TILE_SIZE))
+        y = min(max(0, self.preview_center[1] // scale - TILE_SIZE // 2), max(0, height - TILE_SIZE))
+        return x, y
+
     def _on_show_histogram(self, event):
         plot_intensity_histogram(self.orig_img, self.histogram, self.lo_percentile_val, self.hi_percentile_val)
 
@@ -245,24 +290,54 @@ class PreprocessDialog(wx.Dialog):
     def _on_gaussian1_kernel_size(self, event):
         size = event.GetEventObject().GetValue()
         self.gaussian_kernel1_size = 2 * size + 3  # kernel size must be odd, and our sliders have steps of 1 (we could use +1 instead of +3 if we use 1 als the lowest slider value instead of 0)
-        self.preprocess(self.orig_img_crop)
-        self._redraw_window()
+        self._schedule_preview_update()
 
     def _on_gaussian2_kernel_size(self, event):
         size = event.GetEventObject().GetValue()
         self.gaussian_kernel2_size = 2 * size + 3  # kernel size must be odd, and our sliders have steps of 1
-        self.preprocess(self.orig_img_crop)
-        self._redraw_window()
+        self._schedule_preview_update()
 
     def _on_laplacian_delta(self, event):
         self.laplacian_delta = event.GetEventObject().GetValue()
-        self.preprocess(self.orig_img_crop)
+        self._schedule_preview_update()
+
+    def _on_edge_blur_method(self, event):
+        self.edge_blur_method = EDGE_BLUR_METHODS[event.GetEventObject().GetSelection()][1]
+        self._schedule_preview_update()
+
+    def _schedule_preview_update(self):
+        # While a slider is being dragged, we get many slider events. Instead of preprocessing the preview for each of them,
+        # we wait until the slider has not moved for a short while, and then preprocess only once, with the latest parameters.
+        if self._preview_update is not None and self._preview_update.IsRunning():
+            self._preview_update.Restart(PREVIEW_UPDATE_DELAY_MS)
+        else:
+            self._preview_update = wx.CallLater(PREVIEW_UPDATE_DELAY_MS, self._update_preview)
+
+    def _stop_preview_update(self):
+        if self._preview_update is not None:
+            self._preview_update.Stop()
+
+    def _update_preview(self):
         self._redraw_window()
 
 # To speedup previewing the result of image processing,
-# we only show a chunk (a "tile") of the complete image.
+# we only show a chunk (a "tile") of the complete image (or of a downsampled version of it).
 TILE_SIZE = 768
 
+# The preview is preprocessed in square tiles of this size (at the preview's pyramid level),
+# so that after panning only the newly visible tiles need to be preprocessed.
+PREVIEW_TILE_SIZE = 256
+
+# Maximum number of preview tiles (with the results of all their preprocessing steps) that are remembered
+PREVIEW_TILE_CACHE_SIZE = 48
+
+# The edge blur methods that the user can choose from: (label, method)
+EDGE_BLUR_METHODS = [('Exact', EXACT_BLUR),
+                     ('Fast (approximate for large kernels)', FAST_BLUR)]
+
+# Time (in milliseconds) that a preprocessing parameter slider must be left alone before the preview is updated
+PREVIEW_UPDATE_DELAY_MS = 150
+
 def empty_bitmap():
     # wx.EmptyBitmap() is deprecated but needed for wxPython Classic on the SECOM computer:
     # return wx.Bitmap(TILE_SIZE, TILE_SIZE)
@@ -270,60 +345,129 @@ def empty_bitmap():
     return wx.EmptyBitmap(TILE_SIZE, TILE_SIZE)
 
 
-def get_tile(image, x, y):
-    return image[y:y+TILE_SIZE, x:x+TILE_SIZE]
-
-
-def get_max_possible_intensity(image):
+class PreprocessingPreview:
     """
-    Returns the maximum intensity value that can be represented by the data type used to represent a pixel in the image.
+    Multi-resolution preview of the preprocessing of a (large) image. A pyramid of downsampled versions of the image
+    is built once, down to a level where the whole image fits in the preview. At a reduced resolution level the image
+    is preprocessed with kernels that are scaled down accordingly (see scaled_preprocessing_parameters()), which
+    approximates the result of preprocessing at full resolution. At level 0 the preview is identical to (a part of)
+    the full resolution preprocessed image.
+
+    The preview is preprocessed in tiles, on a pool of threads. The tiles are remembered, least recently used tiles are
+    forgotten first. Each tile remembers the results of all preprocessing steps, so panning back to a tile that was
+    shown before is instant, and after a parameter change only the affected preprocessing steps are recalculated.
     """
-    if image.dtype == np.uint16:
-        return 65535
-    elif image.dtype == np.uint8:
-        return 255
-    else:
-        raise RuntimeError('Only 8-bit and 16-bit images are supported.')
-
-
-def enhance_contrast(image, lo_val, hi_val):
-    """
-    Enhances the contrast of a given image by stretching the pixel intensities between lo_val and hi_val
-    to the maximum range possible for the image's pixel data type (e.g. it stretches to 0-255 for 8-bit images).
-    Returns the contrast enhanced image.
-    """
-
-    assert lo_val < hi_val
-
-    # note: Numpy subtract() and multiply() perform saturating arithmetic, so we're protected from overflow
-    image = cv2.subtract(image, lo_val)
-    one = np.ones(image.shape, dtype=image.dtype)
-    max_val = float(get_max_possible_intensity(image))
-    image = cv2.multiply(image, one, scale=max_val / (hi_val - lo_val))
-    return image
 
+    def __init__(self, img, view_size=TILE_SIZE, tile_size=PREVIEW_TILE_SIZE, max_cached_tiles=PREVIEW_TILE_CACHE_SIZE):
+        """
+        :param img: the (full resolution) image to preview
+        :param view_size: the width and height of the preview, in pixels
+        :param tile_size: the size of the tiles in which the preview is preprocessed
+        :param max_cached_tiles: the maximum number of tiles that are remembered; it must be larger than the number of tiles in the view
+        """
+        self._pyramid = [img]
+        while max(self._pyramid[-1].shape[:2]) > view_size:
+            self._pyramid.append(cv2.pyrDown(self._pyramid[-1]))
+        self._view_size = view_size
+        self._tile_size = tile_size
+        self._max_cached_tiles = max_cached_tiles
+        self._tiles = OrderedDict()  # maps (level, tile row, tile column) to _PreviewTile, the least recently used tile first
+
+    @property
+    def whole_image_level(self):
+        """
+        The pyramid level at which the whole image fits in the preview.
+        """
+        return len(self._pyramid) - 1
 
-def relevant_intensity_range(image, lo_percentile, hi_percentile):
-    """
-    Calculates the intensity histogram of the given image, as well as the pixel intensities for lo_percentile and hi_percentile percentiles.
-    :param image:
-    :param lo_percentile:
-    :param hi_percentile:
-    :return: a tuple with the histogram and the pixel intensities for the requested low and high percentiles.
-    """
-    # Build image histogram
-    max_intensity = get_max_possible_intensity(image)
-    num_bins = max_intensity + 1
-    histogram = cv2.calcHist([image], [0], None, [num_bins], [0, max_intensity])
-
-    # Find intensity value for the low and hi percentiles
-    # (e.g. 1 and 99-th percentile, of 0.5 and 99.5th percentile)
-    # These percentiles produce better contrast enhancement than just the minimum and maximum image intensity values,
-    # because the microscope images often have a thin but very dark border that we want to ignore.
-    lo_val = get_histogram_percentile(histogram, lo_percentile)
-    hi_val = get_histogram_percentile(histogram, hi_percentile)
+    def level_shape(self, level):
+        """
+        :return: the (height, width) of the image at the given pyramid level
+        """
+        return self._pyramid[level].shape[:2]
 
-    return histogram, lo_val, hi_val
+    def render(self, level, x, y, step, lo_val, hi_val, gaussian_kernel1_size, laplacian_delta, gaussian_kernel2_size, edge_blur_method=EXACT_BLUR):
+        """
+        Returns the preview of a preprocessing step, for the part of the image at pyramid level 'level' with its top left corner at (x, y).
+        :param level: the pyramid level (0 = full resolution, each next level has half the resolution of the previous one)
+        :param x, y: the top left corner of the preview, in the coordinates of the pyramid level
+        :param step: the preprocessing step (0=original image, 1=contrast enhanced image, ..., 5=final preprocessed result)
+        :param lo_val, hi_val, gaussian_kernel1_size, laplacian_delta, gaussian_kernel2_size, edge_blur_method: the preprocessing parameters for the full resolution image
+        :return: the preview image, at most view_size x view_size pixels (it is smaller near the right and bottom edges of the image)
+        """
+        image = self._pyramid[level]
+        height, width = image.shape[:2]
+        x1, y1 = min(x + self._view_size, width), min(y + self._view_size, height)
+        if step == 0:
+            return image[y:y1, x:x1]
+
+        parameters = ((lo_val, hi_val) + scaled_preprocessing_parameters(level, gaussian_kernel1_size, laplacian_delta, gaussian_kernel2_size) +
+                      (edge_blur_method,))
+        ts = self._tile_size
+        keys = [(level, row, col) for row in range(y // ts, (y1 - 1) // ts + 1) for col in range(x // ts, (x1 - 1) // ts + 1)]
+        for key in keys:
+            self._tiles[key] = self._tiles.pop(key, None) or _PreviewTile()  # (re)insert as the most recently used tile
+
+        # Note: OpenCV releases the GIL, so the tiles are really preprocessed in parallel.
+        pool = ThreadPool(min(len(keys), multiprocessing.cpu_count()))
+        try:
+            tiles_results = pool.map(lambda key: self._preprocess_tile(key, parameters), keys, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+
+        while len(self._tiles) > self._max_cached_tiles:
+            self._tiles.popitem(last=False)
+
+        # Assemble the preview from the tiles
+        preview = None
+        for (_, row, col), results in zip(keys, tiles_results):
+            tile = results[step - 1]
+            if preview is None:
+                preview = np.zeros((y1 - y, x1 - x), dtype=tile.dtype)
+            ty0, tx0 = row * ts, col * ts
+            cy0, cy1 = max(y, ty0), min(y1, ty0 + tile.shape[0])
+            cx0, cx1 = max(x, tx0), min(x1, tx0 + tile.shape[1])
+            preview[cy0 - y:cy1 - y, cx0 - x:cx1 - x] = tile[cy0 - ty0:cy1 - ty0, cx0 - tx0:cx1 - tx0]
+        return preview
+
+    def _preprocess_tile(self, key, parameters):
+        # Preprocesses a tile (together with a halo of surrounding pixels, see preprocess_tiled()) and returns
+        # the results of all preprocessing steps for the tile itself. Runs on a thread of the pool.
+        level, row, col = key
+        image = self._pyramid[level]
+        height, width = image.shape[:2]
+        _, _, gaussian_kernel1_size, _, gaussian_kernel2_size, _ = parameters
+        halo = preprocessing_halo(gaussian_kernel1_size, gaussian_kernel2_size)
+        y0, x0 = row * self._tile_size, col * self._tile_size
+        y1, x1 = min(height, y0 + self._tile_size), min(width, x0 + self._tile_size)
+        region = (max(0, y0 - halo), min(height, y1 + halo), max(0, x0 - halo), min(width, x1 + halo))
+
+        # A tile that was preprocessed with a wider halo before (for larger kernels) can be reused as is,
+        # so that only the preprocessing steps whose parameters changed need to be recalculated.
+        tile = self._tiles[key]
+        if not _region_contains(tile.region, region):
+            tile.region = region
+            tile.image = image[region[0]:region[1], region[2]:region[3]]
+
+        results = tile.pipeline.run(tile.image, *parameters)
+        hy0, hx0 = tile.region[0], tile.region[2]
+        return [result[y0 - hy0:y1 - hy0, x0 - hx0:x1 - hx0] for result in results]
+
+
+class _PreviewTile:
+    # A tile of the preview: the part of the image that is preprocessed for the tile (the tile and its halo)
+    # and the pipeline that remembers the results of the preprocessing steps for it.
+    def __init__(self):
+        self.region = None  # (top, bottom, left, right) of the preprocessed part of the image
+        self.image = None
+        self.pipeline = PreprocessingPipeline()
+
+
+def _region_contains(region, other_region):
+    # Returns whether the (top, bottom, left, right) region contains the other region. Region may be None.
+    return (region is not None and region[0] <= other_region[0] and other_region[1] <= region[1] and
+            region[2] <= other_region[2] and other_region[3] <= region[3])
 
 
 def plot_intensity_histogram(image, histogram, lo_val, hi_val):
@@ -351,24 +495,6 @@ def plot_intensity_histogram(image, histogram, lo_val, hi_val):
     plt.show()
 
 
-def get_histogram_percentile(histogram, percentile):
-    """
-    :param histogram: intensity histogram of an image, assumed to have a histogram bin for each possible intensity (e.g bins for 0, 1, 2,...65535 for a 16-bit image)
-    :param percentile: the request intensity percentile e.g 95 for the 95th-percentile
-    :return: the intensity value corresponding to the given percentile
-    """
-
-    total = np.sum(histogram)
-    needed = total * (percentile / 100.0)
-    running_total = 0
-    i = 0
-    for i, val in enumerate(histogram):
-        running_total += val[0]
-        if running_total >= needed:
-            break
-    return i
-
-
 def pad_image(image, min_height, min_width):
     """
     Returns the image padded (if needed) with zeroes so that it is at least min_height x min_width pixels.
@@ -0,0 +1,178 @@
+# Headless batch preprocessing of overview images.
+#
+# Preprocesses all overview images in a folder exactly like the "Preprocess" dialog does, but without a GUI,
+# so that it can run unattended (e.g. overnight on a compute node). The images are distributed over a pool of worker
+# processes, and each worker preprocesses its image in tiles (see preprocessing.preprocess_tiled()), so that
+# besides the image itself and its 8-bit result only the tiles that are being processed are in memory.
+# For each image a preprocessed 8-bit TIFF is written, and a JSON file records the preprocessing parameters
+# and the timings of all images. Only modules that do not depend on wxPython are used, so this also runs on
+# a machine without the GUI packages.
+#
+# Usage example:
+#   python src/preprocess_overviews.py /data/overviews /data/preprocessed --processes 4 --kernel2 71
+
+import os
+import sys
+import glob
+import json
+import time
+import argparse
+import multiprocessing
+import cv2
+import numpy as np
+import image_tools
+from preprocessing_cache import PREPROCESSING_VERSION
+from preprocessing import relevant_intensity_range, preprocess_tiled, PREPROCESSING_TILE_SIZE
+from gaussian_blur import BLUR_METHODS, EXACT_BLUR
+
+# Default preprocessing parameters; the same as the initial values in PreprocessDialog
+DEFAULT_PARAMETERS = {'lo_percentile': 2,
+                      'hi_percentile': 98,
+                      'gaussian_kernel1_size': 29,
+                      'laplacian_delta': -270,
+                      'gaussian_kernel2_size': 63,
+                      'edge_blur_method': EXACT_BLUR}
+
+
+def main():
+    args = _parse_arguments()
+
+    parameters = dict(DEFAULT_PARAMETERS)
+    if args.parameters:  # e.g. the JSON file written by an earlier run
+        with open(args.parameters) as f:
+            parameters.update(json.load(f)['parameters'])
+    for name in DEFAULT_PARAMETERS:
+        value = getattr(args, name)
+        if value is not None:
+            parameters[name] = value
+
+    image_paths = sorted(glob.glob(os.path.join(args.input_folder, args.pattern)))
+    if not image_paths:
+        sys.exit('No images matching {} found in {}'.format(args.pattern, args.input_folder))
+
+    if not os.path.isdir(args.output_folder):
+        os.makedirs(args.output_folder)
+
+    num_processes = min(args.processes or multiprocessing.cpu_count(), len(image_paths))
+    threads_per_process = args.threads or max(1, multiprocessing.cpu_count() // num_processes)
+    print('Preprocessing {} images with {} processes, {} threads each'.format(len(image_paths), num_processes, threads_per_process))
+    print('Parameters: {}'.format(parameters))
+
+    start_time = time.time()
+    tasks = [(path, args.output_folder, parameters, args.tile_size, threads_per_process, args.histogram_sample_step)
+             for path in image_paths]
+    pool = multiprocessing.Pool(num_processes)
+    try:
+        records = []
+        for record in pool.imap_unordered(_preprocess_overview_task, tasks):
+            print('{}: {}'.format(record['input'], record.get('error') or '{:.1f} s'.format(record['timings']['total'])))
+            records.append(record)
+    finally:
+        pool.close()
+        pool.join()
+    total_time = time.time() - start_time
+
+    records.sort(key=lambda record: image_paths.index(record['input']))
+    summary = {'preprocessing_version': PREPROCESSING_VERSION,
+               'parameters': parameters,
+               'processes': num_processes,
+               'threads_per_process': threads_per_process,
+               'tile_size': args.tile_size,
+               'histogram_sample_step': args.histogram_sample_step,
+               'total_time': total_time,
+               'images': records}
+    summary_path = os.path.join(args.output_folder, 'preprocessing.json')
+    with open(summary_path, 'w') as f:
+        json.dump(summary, f, indent=4)
+
+    num_failed = sum(1 for record in records if 'error' in record)
+    print('Preprocessed {} images in {:.1f} s ({} failed); parameters and timings written to {}'.format(
+        len(records) - num_failed, total_time, num_failed, summary_path))
+    if num_failed > 0:
+        sys.exit(1)
+
+
+def preprocess_overview(input_path, output_path, parameters, tile_size, num_threads=None, histogram_sample_step=1):
+    """
+    Preprocesses an overview image file, just like the Preprocess dialog, and saves the result as an 8-bit image file.
+    :param parameters: dictionary with the preprocessing parameters (see PreprocessDialog.get_preprocessing_parameters())
+    :param tile_size: the image is preprocessed in tiles of this size (see preprocessing.preprocess_tiled())
+    :param num_threads: number of threads for preprocessing the tiles; None to use as many threads as there are CPU cores
+    :param histogram_sample_step: see image_tools.intensity_histogram()
+    :return: a dictionary with the time (in seconds) spent on each part of the work, and the intensity range used for contrast enhancement
+    """
+    timings = {}
+    start_time = time.time()
+
+    img = image_tools.read_image_as_grayscale(input_path, cv2.IMREAD_GRAYSCALE + cv2.IMREAD_ANYDEPTH)  # IMREAD_ANYDEPTH to preserve as 16 bit
+    if img is None:
+        raise IOError('Failed to read {}'.format(input_path))
+    if img.dtype == np.uint8:  # see ContourFinderPanel._on_preprocess_button_click()
+        img = img.astype(np.uint16) * 257
+    timings['read'] = time.time() - start_time
+
+    t = time.time()
+    _, lo_val, hi_val = relevant_intensity_range(img, parameters['lo_percentile'], parameters['hi_percentile'], histogram_sample_step)
+    timings['histogram'] = time.time() - t
+
+    t = time.time()
+    preprocessed = preprocess_tiled(img, lo_val, hi_val,
+                                    parameters['gaussian_kernel1_size'], parameters['laplacian_delta'], parameters['gaussian_kernel2_size'],
+                                    parameters['edge_blur_method'], tile_size=tile_size, num_threads=num_threads)
+    timings['preprocess'] = time.time() - t
+    del img
+
+    t = time.time()
+    if not image_tools.save_image(preprocessed, output_path):
+        raise IOError('Failed to write {}'.format(output_path))
+    timings['write'] = time.time() - t
+
+    timings['total'] = time.time() - start_time
+    return {'lo_val': lo_val, 'hi_val': hi_val, 'shape': list(preprocessed.shape), 'timings': timings}
+
+
+def _preprocess_overview_task(task):
+    # Runs in a worker process. Errors are reported in the result, so that one bad image does not stop the whole batch.
+    input_path, output_folder, parameters, tile_size, num_threads, histogram_sample_step = task
+    name = os.path.splitext(os.path.basename(input_path))[0]
+    output_path = os.path.join(output_folder, name + '_preprocessed.tif')
+    record = {'input': input_path, 'output': output_path}
+    try:
+        record.update(preprocess_overview(input_path, output_path, parameters, tile_size, num_threads, histogram_sample_step))
+    except Exception as e:
+        record['error'] = '{}: {}'.format(type(e).__name__, e)
+    return record
+
+
+def _parse_arguments():
+    parser = argparse.ArgumentParser(description='Preprocess all overview images in a folder (without GUI), '
+                                                 'like the Preprocess dialog does, for automatic slice contour finding.')
+    parser.add_argument('input_folder', help='folder with the overview images')
+    parser.add_argument('output_folder', help='folder where the preprocessed images and preprocessing.json are written; it is created if needed')
+    parser.add_argument('--pattern', default='*.tif', help='file name pattern of the overview images (default: %(default)s)')
+    parser.add_argument('--parameters', help='JSON file with the preprocessing parameters, e.g. the preprocessing.json of an earlier run; '
+                                             'the options below override it')
+    parser.add_argument('--lo-percentile', dest='lo_percentile', type=float, help='default: {}'.format(DEFAULT_PARAMETERS['lo_percentile']))
+    parser.add_argument('--hi-percentile', dest='hi_percentile', type=float, help='default: {}'.format(DEFAULT_PARAMETERS['hi_percentile']))
+    parser.add_argument('--kernel1', dest='gaussian_kernel1_size', type=_odd_integer, help='denoising blur kernel size (odd); default: {}'.format(DEFAULT_PARAMETERS['gaussian_kernel1_size']))
+    parser.add_argument('--delta', dest='laplacian_delta', type=int, help='Laplacian delta; default: {}'.format(DEFAULT_PARAMETERS['laplacian_delta']))
+    parser.add_argument('--kernel2', dest='gaussian_kernel2_size', type=_odd_integer, help='edge blur kernel size (odd); default: {}'.format(DEFAULT_PARAMETERS['gaussian_kernel2_size']))
+    parser.add_argument('--edge-blur', dest='edge_blur_method', choices=BLUR_METHODS,
+                        help="edge blur method; 'fast' approximates large kernels with a cascade of box filters (default: {})".format(DEFAULT_PARAMETERS['edge_blur_method']))
+    parser.add_argument('--processes', type=int, help='number of images preprocessed at the same time (default: number of CPU cores)')
+    parser.add_argument('--threads', type=int, help='number of threads per process (default: number of CPU cores / number of processes)')
+    parser.add_argument('--tile-size', dest='tile_size', type=int, default=PREPROCESSING_TILE_SIZE, help='tile size in pixels (default: %(default)s)')
+    parser.add_argument('--histogram-sample-step', dest='histogram_sample_step', type=int, default=1,
+                        help='estimate the intensity percentiles from every n-th pixel of every n-th row (default: %(default)s, all pixels)')
+    return parser.parse_args()
+
+
+def _odd_integer(s):
+    value = int(s)
+    if value % 2 != 1:
+        raise argparse.ArgumentTypeError('{} is not an odd number'.format(s))
+    return value
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,269 @@
+# Preprocessing of overview images for automatic slice contour finding: the edges of the slices are detected and blurred,
+# so that the slice contours are attracted to them. This module does not depend on wxPython, so that overview images
+# can also be preprocessed without a GUI (see preprocess_overviews.py); the interactive dialog is in preprocess_dialog.py.
+
+import numpy as np
+import cv2
+from multiprocessing.pool import ThreadPool
+import image_tools
+from gaussian_blur import gaussian_blur, EXACT_BLUR
+
+# Size of the tiles in which large images are preprocessed by preprocess_tiled()
+PREPROCESSING_TILE_SIZE = 1024
+
+# Size of the Laplacian kernel used for edge detection during preprocessing
+LAPLACIAN_KERNEL_SIZE = 5
+
+
+def preprocessing_steps(img, lo_val, hi_val, gaussian_kernel1_size, laplacian_delta, gaussian_kernel2_size, edge_blur_method=EXACT_BLUR):
+    """
+    Preprocesses an overview image so edges have a high intensity which smoothly decreases further away from the edge.
+    :param edge_blur_method: the method for the final edge blur, see gaussian_blur.gaussian_blur()
+    :return: a tuple with the result of each preprocessing step: (contrast enhanced image, blurred image, Laplacian,
+             thresholded Laplacian, preprocessed image); the preprocessed image is 8-bit
+    """
+    return PreprocessingPipeline().run(img, lo_val, hi_val, gaussian_kernel1_size, laplacian_delta, gaussian_kernel2_size, edge_blur_method)
+
+
+def preprocess_image(img, lo_val, hi_val, gaussian_kernel1_size, laplacian_delta, gaussian_kernel2_size, edge_blur_method=EXACT_BLUR):
+    """
+    Preprocesses an overview image, just like preprocessing_steps(), but returns only the final 8-bit preprocessed image.
+    The result of each preprocessing step is released as soon as the next step is done, so at any time
+    at most the input image and the results of two consecutive steps are in memory.
+    """
+    step_parameters = _preprocessing_step_parameters(lo_val, hi_val, gaussian_kernel1_size, laplacian_delta, gaussian_kernel2_size, edge_blur_method)
+    result = img
+    for step, parameters in zip(_PREPROCESSING_STEPS, step_parameters):
+        result = step(result, *parameters)
+    return result
+
+
+class PreprocessingPipeline:
+    """
+    The chain of preprocessing steps, which remembers the result of each step. When it is run again, only the steps
+    whose parameters changed, and the steps after them, are recalculated. For example, if only the size of the final
+    edge blur kernel changed, only the final blur is recalculated.
+    """
+
+    def __init__(self):
+        self._image = None  # the input image of the most recent run
+        self._step_parameters = [None] * len(_PREPROCESSING_STEPS)  # the parameters of each step in the most recent run
+        self._step_results = [None] * len(_PREPROCESSING_STEPS)
+
+    def run(self, img, lo_val, hi_val, gaussian_kernel1_size, laplacian_delta, gaussian_kernel2_size, edge_blur_method=EXACT_BLUR):
+        """
+        :return: a tuple with the result of each preprocessing step (see preprocessing_steps())
+        """
+        step_parameters = _preprocessing_step_parameters(lo_val, hi_val, gaussian_kernel1_size, laplacian_delta, gaussian_kernel2_size, edge_blur_method)
+        changed = img is not self._image
+        self._image = img
+        step_input = img
+        for i, step in enumerate(_PREPROCESSING_STEPS):
+            if changed or step_parameters[i] != self._step_parameters[i]:
+                self._step_results[i] = step(step_input, *step_parameters[i])
+                self._step_parameters[i] = step_parameters[i]
+                changed = True  # all subsequent steps need to be recalculated as well
+            step_input = self._step_results[i]
+        return tuple(self._step_results)
+
+
+def scaled_preprocessing_parameters(level, gaussian_kernel1_size, laplacian_delta, gaussian_kernel2_size):
+    """
+    Scales the preprocessing parameters for full resolution images to those for an image at the given (downsampled)
+    pyramid level, so that preprocessing the downsampled image approximates the downsampled preprocessed image.
+    The Gaussian kernels shrink with the image. The Laplacian delta is scaled with the Laplacian itself, which is
+    stronger on the downsampled image (see _laplacian_response_ratio()).
+    :return: a tuple (gaussian_kernel1_size, laplacian_delta, gaussian_kernel2_size) for the pyramid level
+    """
+    if level == 0:
+        return gaussian_kernel1_size, laplacian_delta, gaussian_kernel2_size
+    scale = 2 ** level
+    scaled_kernel1_size = 2 * int(round((gaussian_kernel1_size // 2) / float(scale))) + 1
+    scaled_kernel2_size = 2 * int(round((gaussian_kernel2_size // 2) / float(scale))) + 1
+    ratio = _laplacian_response_ratio(level, gaussian_kernel1_size, scaled_kernel1_size)
+    return scaled_kernel1_size, laplacian_delta * ratio, scaled_kernel2_size
+
+
+def _laplacian_response_ratio(level, gaussian_kernel1_size, scaled_kernel1_size):
+    # Returns the ratio of the peak Laplacian of a blurred step edge at the given pyramid level and at full resolution.
+    # For an ideal image this would be 4 ** level (second derivatives per pixel), but the Laplacian kernel and
+    # the downsampling themselves smooth the image too, and at lower resolutions they do so relatively more.
+    # So we measure the ratio on a small synthetic image of a vertical step edge instead.
+    scale = 2 ** level
+    edge = np.zeros((4 * scale, 4 * (gaussian_kernel1_size + LAPLACIAN_KERNEL_SIZE) * scale), dtype=np.float32)
+    edge[:, edge.shape[1] // 2:] = 1.0
+    laplacian = cv2.Laplacian(cv2.GaussianBlur(edge, (gaussian_kernel1_size, gaussian_kernel1_size), 0), cv2.CV_32F, ksize=LAPLACIAN_KERNEL_SIZE)
+    for _ in range(level):
+        edge = cv2.pyrDown(edge)
+    scaled_laplacian = cv2.Laplacian(cv2.GaussianBlur(edge, (scaled_kernel1_size, scaled_kernel1_size), 0), cv2.CV_32F, ksize=LAPLACIAN_KERNEL_SIZE)
+    return float(np.max(scaled_laplacian)) / float(np.max(laplacian))
+
+
+# Imporant note: for the iterative contour finding to work well, the preprocessed image should have an intensity profile around the edges
+# that varies smoothly, from relatively "far" from the edge, and with no local minima/maxima in the neighborhood.
+
+def _contrast_enhancement_step(img, lo_val, hi_val):
+    contrast_enhanced_img = enhance_contrast(img, lo_val, hi_val)
+    # print('Contrast enhanced: shape={} dtype={} min={} max={}'.format(contrast_enhanced_img.shape, contrast_enhanced_img.dtype, np.min(contrast_enhanced_img), np.max(contrast_enhanced_img)))
+    return contrast_enhanced_img
+
+
+def _denoising_blur_step(contrast_enhanced_img, gaussian_kernel1_size):
+    # Gaussian blurring to remove some of the noise,
+    # Needed because afterwards we will use the Laplacian to detect edges,
+    # and this is very sensitive to the presence of noise.
+    kernel_size = (gaussian_kernel1_size, gaussian_kernel1_size)  # must be odd
+    sigma_x, sigma_y = 0, 0   # 0 means calculate sigma from the kernel size
+    return cv2.GaussianBlur(contrast_enhanced_img, kernel_size, sigma_x, sigma_y)
+
+
+def _laplacian_step(blurred_img, laplacian_delta):
+    # Laplacian (of the Gaussian) to detect edges.
+    # Note the use of an offset (laplacian_delta).
+    # The Laplacian kernel and the delta are integer, so for 8 and 16-bit images the Laplacian is integer too.
+    # Its magnitude stays far below 2**24, so 32-bit floats represent it exactly (64-bit floats would only waste memory).
+    laplacian = cv2.Laplacian(blurred_img, cv2.CV_32F, LAPLACIAN_KERNEL_SIZE, scale=1, delta=laplacian_delta)
+    # print('Laplacian (of Gaussian) 5 scale=1, delta={}: shape={} dtype={} min={} max={}'.format(laplacian_delta, laplacian.shape, laplacian.dtype, np.min(laplacian), np.max(laplacian)))
+    return laplacian
+
+
+def _threshold_step(laplacian):
+    # The Laplacian is now a floating point image, having negative values.
+    # Threshold it to positive values to keep only the edges.
+    # The result is an 8-bit mask with 255 for edges and 0 elsewhere. It is built in place in the boolean
+    # comparison result (which uses one byte per pixel, with values 0 and 1).
+    mask = (laplacian > 0).view(np.uint8)  # laplacian > 0  means edges
+    np.multiply(mask, 255, out=mask)
+    return mask
+
+
+def _edge_blur_step(abs_laplacian, gaussian_kernel2_size, edge_blur_method):
+    # Perform Gaussian blur on the detected edges, this is needed for the active contours lateron
+    # to feel the attraction of an edge even some distance away from the edge.
+    # The edge mask is blurred as a 16-bit image (0 or 65535) because blurring the 8-bit mask would round differently.
+    abs_laplacian_16bit = np.empty(abs_laplacian.shape, dtype=np.uint16)
+    np.multiply(abs_laplacian, np.uint16(257), out=abs_laplacian_16bit)  # 255 * 257 = 65535
+    # (For the large kernels that are typically used here, the fast blur method is much faster but approximate.)
+    result = gaussian_blur(abs_laplacian_16bit, gaussian_kernel2_size, edge_blur_method)  # kernel size must be odd
+    del abs_laplacian_16bit
+    # print('Gaussian of Laplacian of Gaussian: shape={} dtype={} min={} max={}'.format(abs_laplacian.shape, abs_laplacian.dtype, np.min(abs_laplacian), np.max(abs_laplacian)))
+
+    # Convert images to 8-bit so they can be more easily turned into wxPython bitmaps for viewing
+    return image_tools.grayscale_image_16bit_to_8bit(result)
+
+
+# The preprocessing steps, in order. Each step takes the result of the previous step, followed by its own parameters.
+_PREPROCESSING_STEPS = [_contrast_enhancement_step, _denoising_blur_step, _laplacian_step, _threshold_step, _edge_blur_step]
+
+
+def _preprocessing_step_parameters(lo_val, hi_val, gaussian_kernel1_size, laplacian_delta, gaussian_kernel2_size, edge_blur_method):
+    # Returns the parameters of each of the _PREPROCESSING_STEPS, as a list of tuples.
+    return [(lo_val, hi_val), (gaussian_kernel1_size,), (laplacian_delta,), (), (gaussian_kernel2_size, edge_blur_method)]
+
+
+def preprocessing_halo(gaussian_kernel1_size, gaussian_kernel2_size):
+    """
+    Returns the number of pixels around a tile that are needed to preprocess the tile exactly as if it was
+    preprocessed as part of the whole image: the sum of the radii of the kernels of the successive preprocessing steps.
+    (The box filter cascade of the fast edge blur method is not larger than the Gaussian kernel that it approximates.)
+    """
+    return gaussian_kernel1_size // 2 + LAPLACIAN_KERNEL_SIZE // 2 + gaussian_kernel2_size // 2
+
+
+def preprocess_tiled(img, lo_val, hi_val, gaussian_kernel1_size, laplacian_delta, gaussian_kernel2_size, edge_blur_method=EXACT_BLUR,
+                     tile_size=PREPROCESSING_TILE_SIZE, num_threads=None):
+    """
+    Preprocesses an image (see preprocessing_steps()) in tiles, on a pool of threads, and writes the result
+    into a single preallocated 8-bit image. Each tile is preprocessed together with a halo of surrounding pixels
+    that is as wide as the preprocessing kernels reach, so the result is identical to preprocessing the whole image at once.
+    (At the image border the tiles are not padded, so OpenCV handles the border just like for the whole image.)
+    Only the tiles that are being processed by the threads are kept in memory, together with their intermediate results.
+
+    :param num_threads: number of threads; None to use as many threads as there are CPU cores
+    :return: the preprocessed 8-bit image
+    """
+    height, width = img.shape[:2]
+    halo = preprocessing_halo(gaussian_kernel1_size, gaussian_kernel2_size)
+    result = np.empty((height, width), dtype=np.uint8)
+
+    def preprocess_tile(tile):
+        y0, y1, x0, x1 = tile
+        hy0, hy1 = max(0, y0 - halo), min(height, y1 + halo)
+        hx0, hx1 = max(0, x0 - halo), min(width, x1 + halo)
+        preprocessed = preprocess_image(img[hy0:hy1, hx0:hx1], lo_val, hi_val,
+                                        gaussian_kernel1_size, laplacian_delta, gaussian_kernel2_size, edge_blur_method)
+        result[y0:y1, x0:x1] = preprocessed[y0 - hy0:y1 - hy0, x0 - hx0:x1 - hx0]
+
+    tiles = [(y, min(y + tile_size, height), x, min(x + tile_size, width))
+             for y in range(0, height, tile_size)
+             for x in range(0, width, tile_size)]
+
+    # Note: OpenCV releases the GIL, so the tiles are really preprocessed in parallel.
+    pool = ThreadPool(num_threads)
+    try:
+        pool.map(preprocess_tile, tiles, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+    return result
+
+
+def get_max_possible_intensity(image):
+    """
+    Returns the maximum intensity value that can be represented by the data type used to represent a pixel in the image.
+    """
+    if image.dtype == np.uint16:
+        return 65535
+    elif image.dtype == np.uint8:
+        return 255
+    else:
+        raise RuntimeError('Only 8-bit and 16-bit images are supported.')
+
+
+def enhance_contrast(image, lo_val, hi_val):
+    """
+    Enhances the contrast of a given image by stretching the pixel intensities between lo_val and hi_val
+    to the maximum range possible for the image's pixel data type (e.g. it stretches to 0-255 for 8-bit images).
+    Returns the contrast enhanced image.
+    """
+
+    assert lo_val < hi_val
+
+    # note: Numpy subtract() and multiply() perform saturating arithmetic, so we're protected from overflow
+    image = cv2.subtract(image, lo_val)
+    one = np.ones(image.shape, dtype=image.dtype)
+    max_val = float(get_max_possible_intensity(image))
+    image = cv2.multiply(image, one, scale=max_val / (hi_val - lo_val))
+    return image
+
+
+def relevant_intensity_range(image, lo_percentile, hi_percentile, sample_step=1):
+    """
+    Calculates the intensity histogram of the given image, as well as the pixel intensities for lo_percentile and hi_percentile percentiles.
+    :param image:
+    :param lo_percentile:
+    :param hi_percentile:
+    :param sample_step: if larger than 1, the histogram is estimated from a strided subsample of the image (see image_tools.intensity_histogram())
+    :return: a tuple with the histogram and the pixel intensities for the requested low and high percentiles.
+    """
+    # Build image histogram
+    get_max_possible_intensity(image)  # checks that the image is 8 or 16-bit
+    histogram = image_tools.intensity_histogram(image, sample_step)
+
+    # Find intensity value for the low and hi percentiles
+    # (e.g. 1 and 99-th percentile, of 0.5 and 99.5th percentile)
+    # These percentiles produce better contrast enhancement than just the minimum and maximum image intensity values,
+    # because the microscope images often have a thin but very dark border that we want to ignore.
+    lo_val, hi_val = [int(val) for val in image_tools.histogram_percentiles(histogram, [lo_percentile, hi_percentile])]
+
+    return histogram, lo_val, hi_val
+
+
+def get_histogram_percentile(histogram, percentile):
+    """
+    :param histogram: intensity histogram of an image, assumed to have a histogram bin for each possible intensity (e.g bins for 0, 1, 2,...65535 for a 16-bit image)
+    :param percentile: the request intensity percentile e.g 95 for the 95th-percentile
+    :return: the intensity value corresponding to the given percentile
+    """
+    return int(image_tools.histogram_percentiles(histogram, [percentile])[0])
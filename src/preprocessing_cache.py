@@ -0,0 +1,109 @@
+# On-disk cache of preprocessed overview images.
+#
+# Preprocessing a large overview image takes a while, so the result is stored in a cache folder, as an uncompressed
+# .npy file that can be memory-mapped when it is needed again. The files are content-addressed: their name is a hash
+# of the identity of the overview image file (path, size and modification time) and of the preprocessing parameters.
+# The total size of the cache is bounded, the least recently used images are evicted first.
+
+import os
+import json
+import hashlib
+import numpy as np
+
+# Version of the preprocessing algorithm; increment it when the preprocessing changes, so that old cached results are not used anymore.
+PREPROCESSING_VERSION = 1
+
+
+class PreprocessingCache:
+    def __init__(self, folder, max_size_bytes):
+        """
+        :param folder: the folder where the cached images are stored; it is created if needed
+        :param max_size_bytes: the maximum total size of the cached images
+        """
+        self._folder = folder
+        self._max_size_bytes = max_size_bytes
+
+    def get(self, overview_image_path, parameters):
+        """
+        :param overview_image_path: path of the (original) overview image
+        :param parameters: dictionary with the preprocessing parameters
+        :return: the cached preprocessed image, memory-mapped read-only; or None if it is not in the cache
+        """
+        path = self._path(overview_image_path, parameters)
+        if path is None or not os.path.isfile(path):
+            return None
+        try:
+            image = np.load(path, mmap_mode='r')
+        except (IOError, ValueError) as e:  # e.g. a corrupt file
+            print('Failed to read cached preprocessed image {}: {}'.format(path, e))
+            return None
+        os.utime(path, None)  # mark as most recently used
+        return image
+
+    def put(self, overview_image_path, parameters, image):
+        """
+        Adds a preprocessed image to the cache, and evicts the least recently used images if the cache becomes too large.
+        :param overview_image_path: path of the (original) overview image
+        :param parameters: dictionary with the preprocessing parameters
+        :param image: the preprocessed image
+        """
+        path = self._path(overview_image_path, parameters)
+        if path is None or image.nbytes > self._max_size_bytes:
+            return
+
+        # Write to a temporary file first, so that an interrupted write does not leave a truncated image in the cache.
+        # The cache is only an optimization, so failing to write it (e.g. a full disk) is not an error.
+        temp_path = path + '.tmp'
+        try:
+            if not os.path.isdir(self._folder):
+                os.makedirs(self._folder)
+            with open(temp_path, 'wb') as f:
+                np.save(f, image)
+            if os.path.exists(path):
+                os.remove(path)  # e.g. on Windows, this fails if the old file is still memory-mapped
+            os.rename(temp_path, path)
+            self._evict(keep=path)
+        except (IOError, OSError) as e:
+            print('Failed to cache preprocessed image {}: {}'.format(path, e))
+            if os.path.exists(temp_path):
+                try:
+                    os.remove(temp_path)
+                except OSError:
+                    pass
+
+    def _path(self, overview_image_path, parameters):
+        # Returns the path of the cache file for the given overview image and preprocessing parameters,
+        # or None if the overview image file does not exist.
+        try:
+            stat = os.stat(overview_image_path)
+        except OSError:
+            return None
+        identity = {'version': PREPROCESSING_VERSION,
+                    'path': os.path.abspath(overview_image_path),
+                    'size': stat.st_size,
+                    'mtime': stat.st_mtime,
+                    'parameters': parameters}
+        key = hashlib.sha1(json.dumps(identity, sort_keys=True).encode('utf-8')).hexdigest()
+        return os.path.join(self._folder, key + '.npy')
+
+    def _evict(self, keep):
+        # Removes the least recently used cache files until the total size of the cache is within bounds.
+        # The file keep (the one that was just added) is never removed.
+        entries = []
+        for filename in os.listdir(self._folder):
+            if filename.endswith('.npy'):
+                path = os.path.join(self._folder, filename)
+                stat = os.stat(path)
+                entries.append((stat.st_mtime, stat.st_size, path))  # get() sets the modification time when an image is used
+
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total_size <= self._max_size_bytes:
+                break
+            if path == keep:
+                continue
+            try:
+                os.remove(path)
+                total_size -= size
+            except OSError as e:  # e.g. on Windows, a memory-mapped file cannot be removed
+                print('Failed to remove cached preprocessed image {}: {}'.format(path, e))
@@ -0,0 +1,260 @@
+# Automatic ribbon building: starting from one or two "seed" slice contours, new slices are predicted at the bottom
+# of the ribbon and then snapped onto the actual slice outlines in the preprocessed overview image by contour optimization.
+
+import time
+import itertools
+import threading
+import numpy as np
+from contour_finder import contour_to_vector
+
+
+def grow_ribbon(contour_finder, image, pyramid, seed_slices, max_score_drop_ratio, ghost_callback=None):
+    """
+    Generator that grows one or two seed slices into a ribbon of slices. It yields the new slices one by one,
+    and stops when a tentative new slice is of too low quality (see terminate_ribbon_building()).
+
+    :param contour_finder: the ContourFinder used for optimizing the new slice contours
+    :param image: the preprocessed overview image
+    :param pyramid: image pyramid of the preprocessed overview image, for coarse-to-fine contour optimization (or None)
+    :param seed_slices: list with one or two slice contours, each a list of (x,y) vertex coordinates; if there are
+           two seed slices, the second one must be the bottom one
+    :param max_score_drop_ratio: see terminate_ribbon_building()
+    :param ghost_callback: optional function(contour, color) for debugging: called with each predicted slice contour
+           ("Blue") and with the rejected contour that terminated the ribbon ("Red")
+    :return: a generator of new slice contours, each a list of (x,y) vertex coordinates
+    """
+    # convert from [(x,y)] to [np.array] for easier calculations on point vectors
+    slices = [[np.array(vertex) for vertex in s] for s in seed_slices]
+
+    old_slice, mat = _ribbon_building_bootstrap(slices)
+    old_edge_scores = contour_finder.calculate_contour_edge_scores(image, contour_to_vector(old_slice))
+    while True:
+        # Predict an approximate next slice (approximate shape and approximate position)
+        new_slice = _transform_slice(old_slice, mat)
+        if ghost_callback:
+            ghost_callback(new_slice, "Blue")
+
+        # Use gradient descent to find the true location and shape of the next slice,
+        # in the neighborhood of our approximation.
+        new_slice_for_model, new_edge_scores = contour_finder.optimize_contour(image, new_slice, pyramid, return_edge_scores=True)
+
+        # Assess if tentative new slice stands a chance of being correct. If not, then terminate ribbon building.
+        # We use the previous slice (which turned out to be good) as the template to judge the quality of the new slice.
+        # Its edge scores were already calculated when it was optimized, so we do not need to score it again.
+        template_edge_scores = old_edge_scores
+        if terminate_ribbon_building(template_edge_scores, new_edge_scores, max_score_drop_ratio):
+            print('Tentative new contour of low quality; terminating ribbon building')
+            if ghost_callback:
+                ghost_callback(new_slice_for_model, "Red")
+            return
+
+        yield new_slice_for_model
+
+        # Prepare for estimating the next slice
+        new_slice = [np.array(vertex) for vertex in
+                     new_slice_for_model]  # convert from [(x,y)] to [np.array([x,y])] for easier calculations on point vectors
+        mat = _estimate_transformation(old_slice, new_slice)
+        old_slice = new_slice
+        old_edge_scores = new_edge_scores
+
+
+def terminate_ribbon_building(template_edge_scores, new_edge_scores, max_score_drop_ratio):
+    """
+    Returns whether to terminate automatic ribbon building because. This may happen because we reached the end of a
+    ribbon, or because we failed to track the ribbon correctly (typically because of a sudden break or kink in the ribbon)
+
+    :param template_edge_scores: the edge scores of the template contour (see ContourFinder.calculate_contour_edge_scores())
+    :param new_edge_scores: the edge scores of the tentative new contour
+    :param max_score_drop_ratio:
+    :return: true if the tentative new contour is likely to be an incorrect or spurious slice contour;
+             false if there is a good chance that the new contour matches a real slice outline
+    """
+    template_scores = np.array(template_edge_scores)
+    new_scores = np.array(new_edge_scores)
+    poor_quality = np.any(new_scores < template_scores * max_score_drop_ratio)
+    return poor_quality
+
+
+def group_seed_slices(slices):
+    """
+    Groups seed slices per ribbon, for growing several ribbons at once. Two consecutive slices form a seed pair of the
+    same ribbon if the second slice is attached to the bottom edge of the first one; all other slices are single seeds.
+
+    :param slices: list of slice contours, each a list of (x,y) vertex coordinates
+    :return: list with for each ribbon a list of one or two seed slices (in the format expected by grow_ribbon())
+    """
+    seeds = []
+    i = 0
+    while i < len(slices):
+        if i + 1 < len(slices) and _attached(slices[i], slices[i + 1]):
+            seeds.append([slices[i], slices[i + 1]])
+            i += 2
+        else:
+            seeds.append([slices[i]])
+            i += 1
+    return seeds
+
+
+def _attached(slice1, slice2):
+    # Returns whether slice2 is (approximately) attached to the bottom edge of slice1:
+    # the middle of the top edge of slice2 must be close to the middle of the bottom edge of slice1.
+    slice1 = [np.array(vertex) for vertex in slice1]
+    slice2 = [np.array(vertex) for vertex in slice2]
+    mid_bottom1 = (slice1[0] + slice1[1]) / 2.0
+    mid_top1 = (slice1[2] + slice1[3]) / 2.0
+    mid_top2 = (slice2[2] + slice2[3]) / 2.0
+    slice_height = np.linalg.norm(mid_bottom1 - mid_top1)
+    return np.linalg.norm(mid_top2 - mid_bottom1) < 0.5 * slice_height
+
+
+class RibbonGrowingThread(threading.Thread):
+    """
+    Background thread that grows a ribbon (see grow_ribbon()) and posts the new slices in batches.
+    Note: the callbacks are called on this background thread, GUI code must forward them to the GUI thread (e.g. with wx.CallAfter).
+    """
+
+    def __init__(self, contour_finder, image, pyramid, seed_slices, max_slices, max_score_drop_ratio,
+                 slices_callback, done_callback, ghost_callback=None, batch_interval=0.5):
+        """
+        :param contour_finder: a ContourFinder for the exclusive use of this thread
+        :param image, pyramid, seed_slices, max_score_drop_ratio, ghost_callback: see grow_ribbon()
+        :param max_slices: maximum number of new slices, or None to keep adding slices until the end of the ribbon
+        :param slices_callback: function(new_slices, score_samples, num_slices, slices_per_second) called with each batch of new slices,
+               their score samples (see ContourFinder.calculate_contour_score_samples(); so the caller can cache them),
+               and the total number of slices and the number of slices per second so far
+        :param done_callback: function(num_slices, slices_per_second, cancelled) called when ribbon growing has finished
+        :param batch_interval: the new slices are posted at most every batch_interval seconds
+        """
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self._contour_finder = contour_finder
+        self._image = image
+        self._pyramid = pyramid
+        self._seed_slices = seed_slices
+        self._max_slices = max_slices
+        self._max_score_drop_ratio = max_score_drop_ratio
+        self._slices_callback = slices_callback
+        self._done_callback = done_callback
+        self._ghost_callback = ghost_callback
+        self._batch_interval = batch_interval
+        self._cancelled = threading.Event()
+
+    def cancel(self):
+        """
+        Requests the thread to stop growing the ribbon. The slice that is being optimized is finished first.
+        """
+        self._cancelled.set()
+
+    def run(self):
+        start_time = time.time()
+        last_post_time = start_time
+        batch = []
+        batch_score_samples = []
+        num_slices = 0
+        new_slices = grow_ribbon(self._contour_finder, self._image, self._pyramid, self._seed_slices,
+                                 self._max_score_drop_ratio, self._ghost_callback)
+        if self._max_slices is not None:
+            new_slices = itertools.islice(new_slices, self._max_slices)
+        try:
+            for new_slice in new_slices:
+                batch.append(new_slice)
+                # The score samples of the optimized slice are still in our contour finder's cache, so this does not resample them.
+                batch_score_samples.append(self._contour_finder.calculate_contour_score_samples(self._image, contour_to_vector(new_slice)))
+                num_slices += 1
+                if self._cancelled.is_set():
+                    break
+
+                now = time.time()
+                if now - last_post_time >= self._batch_interval:
+                    self._slices_callback(batch, batch_score_samples, num_slices, num_slices / (now - start_time))
+                    batch = []
+                    batch_score_samples = []
+                    last_post_time = now
+        finally:
+            slices_per_second = num_slices / max(time.time() - start_time, 1e-6)
+            if batch:
+                self._slices_callback(batch, batch_score_samples, num_slices, slices_per_second)
+            self._done_callback(num_slices, slices_per_second, self._cancelled.is_set())
+
+
+def _ribbon_building_bootstrap(slices):
+    assert len(slices) == 1 or len(slices) == 2
+    if len(slices) == 1:
+        mat = _estimate_initial_transformation(slices[0])
+        slic = slices[0]
+    else:
+        mat = _estimate_transformation(slices[0], slices[1])
+        slic = slices[1]
+
+    return slic, mat
+
+
+def _estimate_initial_transformation(slice):
+    mid_bottom = (slice[0] + slice[1]) / 2.0
+    mid_top = (slice[2] + slice[3]) / 2.0
+
+    translation = mid_bottom - mid_top
+
+    # The rotation angle would be:
+    # (a) the angle between the top and the bottom edge of the slice
+    # plus
+    # (b) the angle due to a possible wedge-shaped gap between slices.
+    # For now we assume that the top and bottom edge of the slice are parallel (IMPROVE)
+    # and the gap cannot be estimated from a single slice. So we assume the rotation angle to be zero for now.
+    # rotation_angle = 0
+
+    return _build_transformation_matrix(translation)
+
+
+def _estimate_transformation(slice1, slice2):
+    """
+    Estimate a rigid coordinate transformation that approximately maps one slice onto another.
+
+    :param slice1: the source slice, as a list of np.array([x,y]) vertex coordinates
+    :param slice2: the target slice (cfr slice1)
+    :return: a 3x3 numpy transformation matrix that transforms the coordinates of slice1 into the coordinates of the
+             approximate position of slice2, assuming that slice2 is attached at the bottom edge of slice1,
+             forming a ribbon. For now the transformation is always a simple translation.
+    """
+
+    # Estimate translation
+    mid_top1 = (slice1[2] + slice1[3]) / 2.0
+    mid_top2 = (slice2[2] + slice2[3]) / 2.0
+    translation = mid_top2 - mid_top1
+
+    # Estimate rotation from angle between top1 en top2, in degrees
+    # Not yet implemented!
+    # rotation_angle = 0
+
+    return _build_transformation_matrix(translation)
+
+
+def _build_transformation_matrix(translation):
+    # Note: if rotation ever needs to be implemented, then we will need both the rotation angle and the rotation
+    # center as additional arguments. The full transformation then consists of (1) translating the rotation center to
+    # the origin, (2) rotating, (3) translating back, and (4) the translation from one slice to the next.
+
+    tx, ty = translation
+
+    mat = np.array([[1, 0, tx],
+                    [0, 1, ty],
+                    [0, 0,  1]])
+    return mat
+
+
+def _transform_slice(slice, mat):
+    """
+    :param slice: a list of four 2x1 numpy arrays, one for each vertex in the slice outline
+    :param mat: the transformation matrix
+    :return: the transformed slice outline (as list of numpy arrays)
+    """
+
+    # Make homogeneous coordinates
+    slice = [np.array([x, y, 1.0]) for (x, y) in slice]
+
+    # Transform each vertex in the slice outline
+    slice = [np.dot(mat, vertex) for vertex in slice]
+
+    # From homogeneous coordinates back to *whataretheycalled?*, so drop the final 1
+    # (Also, but not obvious here: convert from numpy array to (x, y) pair as vertex representation)
+    return [vertex[0:2] for vertex in slice]
@@ -18,13 +18,7 @@ import cv2
 import sys
 import math
 import time
-
-# Setup code for memoization
-# (see @memory.cache decorator below)
-from tempfile import mkdtemp
-from joblib import Memory
-cachedir = mkdtemp()
-memory = Memory(cachedir=cachedir, verbose=0)
+import multiprocessing
 
 # Some useful colors (in BGR)
 red = (0, 0, 255)
@@ -83,14 +77,16 @@ def difference_hu(cnt, template_cnt): # doesn't work *at all* (maybe because of
     d = cv2.matchShapes(cnt, template_cnt, method = 3, parameter = 0) # cv2.CONTOURS_MATCH_I3) #.CV_CONTOURS_MATCH_I2)  # the lower the matchShapes() result, the more similar
     return d
 
-def get_contour_descriptors(cnt):
+def get_contour_descriptors(cnt, area = None):
+    """Returns the descriptors (width, height, square root of the area) of a contour.
+    If the area of the contour is already known it can be passed, to avoid calculating it again."""
     rect = cv2.minAreaRect(cnt)
     width, height = rect[1]   # CHECKME: rect is (cx,cy),(width,height),angle
     if height > width:
         t = width
         width = height
         height = t
-    areasqrt = math.sqrt(cv2.contourArea(cnt))
+    areasqrt = math.sqrt(cv2.contourArea(cnt) if area is None else area)
     # print('{} {} {}'.format(width, height, areasqrt))
     return (width, height, areasqrt)
 
@@ -113,20 +109,127 @@ def is_concave(cnt, i):
     p3 = cnt[(i + 1) % n]
     return not is_left_turn(p1, p2, p3)  # FIXME FIXME -  need to define orientation and axes up/down
 
-def best_split_in_two(cnt, template_cnt):
+class ChunkDescriptors:
+    """
+    Precomputed geometry of a contour, for quickly comparing the chunks that can be cut off from it with a template slice
+    (see difference()). The chunks are vertex ranges of the contour, or such a range with another range cut off.
+    The concavity of each vertex (see is_concave()) is calculated only once, and so are the template descriptors.
+    The area of a chunk is calculated in constant time from prefix sums of the terms of the shoelace formula, so that
+    only cv2.minAreaRect() remains to be called for a chunk. Often even that is not needed: the area alone gives a lower
+    bound on the difference with the template (see area_difference()).
+    """
+    def __init__(self, cnt, template_descriptors):
+        """
+        :param cnt: an OpenCV contour
+        :param template_descriptors: the descriptors of the template slice contour (see get_contour_descriptors())
+        """
+        # 64-bit integers (or floats for non-integer contours) so that the cross products do not overflow.
+        # For integer contours the areas are then exactly the same as those calculated by cv2.contourArea().
+        points = cnt.reshape(-1, 2).astype(np.int64 if np.issubdtype(cnt.dtype, np.integer) else np.float64)
+        x = points[:, 0]
+        y = points[:, 1]
+
+        edges = np.roll(points, -1, axis = 0) - points  # edge from vertex i to vertex i+1
+        turns = edges[:, 0] * np.roll(edges[:, 1], -1) - edges[:, 1] * np.roll(edges[:, 0], -1)  # cross product of the edges before and after vertex i+1
+        self.concave = np.roll(turns >= 0, 1)  # concave[i] == is_concave(cnt, i)
+
+        # Shoelace formula: twice the signed area of a polygon is the sum of the cross products of its consecutive vertices.
+        shoelace_terms = x[:-1] * y[1:] - y[:-1] * x[1:]  # for edges i -> i+1, without the closing edge
+        self._shoelace_sums = np.concatenate(([0], np.cumsum(shoelace_terms))).tolist()  # _shoelace_sums[k] = sum of the terms for edges 0..k-1
+
+        # Plain lists, because the methods below access single elements, which is much faster for lists than for numpy arrays.
+        self._x = x.tolist()
+        self._y = y.tolist()
+        self._points = points
+        self._template_descriptors = template_descriptors
+        self.template_areasqrt = template_descriptors[2]
+        self._template_diagonal = math.hypot(template_descriptors[0], template_descriptors[1])
+
+    def _cross(self, a, b):
+        # Returns the shoelace formula term for the (cut) edge from vertex a to vertex b
+        return self._x[a] * self._y[b] - self._y[a] * self._x[b]
+
+    def range_area(self, start, end):
+        """Returns the area of the contour formed by vertices start, start+1, ..., end (start < end)."""
+        return abs(self._shoelace_sums[end] - self._shoelace_sums[start] + self._cross(end, start)) * 0.5
+
+    def chunk_area(self, start, end, j, i):
+        """Returns the area of the chunk cut off from vertex range start..end by the line between vertices j and i
+        (start <= j < i <= end): the contour formed by vertices i, i+1, ..., end, start, start+1, ..., j."""
+        twice_signed_area = (self._shoelace_sums[end] - self._shoelace_sums[i] + self._cross(end, start) +
+                             self._shoelace_sums[j] - self._shoelace_sums[start] + self._cross(j, i))
+        return abs(twice_signed_area) * 0.5
+
+    def is_concave_in_range(self, start, end, v):
+        """Returns whether vertex v is concave in the contour formed by vertex range start..end.
+        Its neighbors are the same as in the whole contour, except for the range endpoints, which are connected to each other."""
+        if start < v < end:
+            return self.concave[v]
+        prev = end if v == start else v - 1
+        next = start if v == end else v + 1
+        return (self._x[v] - self._x[prev]) * (self._y[next] - self._y[v]) - (self._y[v] - self._y[prev]) * (self._x[next] - self._x[v]) >= 0
+
+    def twice_signed_range_areas(self, starts, ends):
+        """Returns a numpy array with twice the signed area of the contour formed by each vertex range starts[k]..ends[k]
+        (numpy arrays of vertex indices). The chunk cut off from range start..end by the line between vertices j and i
+        has half the absolute difference of the values for ranges start..end and j..i as its area."""
+        shoelace_sums = np.asarray(self._shoelace_sums, dtype = self._points.dtype)
+        x = self._points[:, 0]
+        y = self._points[:, 1]
+        return shoelace_sums[ends] - shoelace_sums[starts] + x[ends] * y[starts] - y[ends] * x[starts]
+
+    def endpoint_concavities(self, starts, ends, vertices):
+        """Returns a numpy array with is_concave_in_range(starts[k], ends[k], vertices[k]) for each k,
+        where each vertex is one of the endpoints of its range."""
+        prev = np.where(vertices == starts, ends, vertices - 1)
+        next = np.where(vertices == ends, starts, vertices + 1)
+        p, v, n = self._points[prev], self._points[vertices], self._points[next]
+        return (v[:, 0] - p[:, 0]) * (n[:, 1] - v[:, 1]) - (v[:, 1] - p[:, 1]) * (n[:, 0] - v[:, 0]) >= 0
+
+    def area_difference(self, area):
+        """Returns a lower bound for the difference between a chunk with the given area and the template: the part of
+        the difference that only depends on the area."""
+        return (self.template_areasqrt - math.sqrt(area))**2
+
+    def chunk_difference_lower_bounds(self, start, end, js, is_, areas):
+        """Returns a numpy array with a lower bound for the difference between the template and each chunk cut off from
+        vertex range start..end by the line between vertices js[k] and is_[k] (numpy arrays), with the given areas.
+        Besides area_difference() it counts the difference in size: the minimum area rectangle of the chunk contains
+        its corners start, end, j and i, so its diagonal is at least as long as the largest distance between them."""
+        corners = [self._points[start], self._points[end], self._points[js], self._points[is_]]
+        diameters = np.zeros(len(js))
+        for a in range(4):
+            for b in range(a + 1, 4):
+                np.maximum(diameters, np.hypot(*(corners[a] - corners[b]).T), out = diameters)
+        # (with some slack, because cv2.minAreaRect() calculates in single precision)
+        too_large = np.maximum(diameters * (1 - 1e-4) - 1e-3 - self._template_diagonal, 0)
+        return (self.template_areasqrt - np.sqrt(areas))**2 + too_large**2
+
+    def difference(self, chunk, area):
+        """Returns the same as difference(chunk, template_cnt), with the area of the chunk calculated beforehand."""
+        (cnt_w, cnt_h, cnt_as) = get_contour_descriptors(chunk, area)
+        (template_w, template_h, template_as) = self._template_descriptors
+        return (template_w - cnt_w)**2 + (template_h - cnt_h)**2 + (template_as - cnt_as)**2
+
+def best_split_in_two(cnt, template_cnt, template_descriptors = None):
     num_points = len(cnt)
+    if template_descriptors is None:
+        template_descriptors = get_contour_descriptors(template_cnt)
+    descriptors = ChunkDescriptors(cnt, template_descriptors)
     best_split_indices = None
     best_difference = 1.0e10
     # Try out all pairs of vertices as a split line
     # and perform the split such that the chunk we clip off
     # resembles the template slice as much as possible.
     for i in range(0, num_points):   # i = 0, 1, ..., num_points-1
+        if not descriptors.concave[i]:
+            continue  # skip, the trapezoid slice shape implies inward corners between consecutive slices; so for efficiency we only consider cuts there.
         for j in range(0, i):        # j = 0, 1, ..., i - 1
             if (abs(i-j) == 1) or (abs(i-j) == num_points - 1):
                 continue  # skip, this wouldn't really cut off anything
 
-            if (not is_concave(cnt, i)) or (not is_concave(cnt, j)):
-                continue  # skip, the trapezoid slice shape implies inward corners between consecutive slices; so for efficiency we only consider cuts there.
+            if not descriptors.concave[j]:
+                continue  # skip, see above
 
             # POSSIBLE IMPROVEME
             # If line i-j intersects the contour itself,
@@ -134,8 +237,12 @@ def best_split_in_two(cnt, template_cnt):
             # because the contours are most of the time so well behaved
             # that this happens only infrequently.
 
+            area = descriptors.chunk_area(0, num_points - 1, j, i)
+            if descriptors.area_difference(area) >= best_difference:
+                continue  # skip, this chunk cannot be better than the best one so far
+
             chunk = extract_subcontour(cnt, i, j)
-            chunk_error = difference(chunk, template_cnt)
+            chunk_error = descriptors.difference(chunk, area)
             if chunk_error < best_difference:
                 best_split_indices = (i, j)
                 best_difference = chunk_error
@@ -152,6 +259,7 @@ def greedy_contour_segmentation_into_slices(cnt, template_contour):
 
     cnt_area = cv2.contourArea(cnt)
     template_area = cv2.contourArea(template_contour)
+    template_descriptors = get_contour_descriptors(template_contour)
 
     # FIXME: code below is sloppy
     if (len(cnt) == 3):
@@ -161,7 +269,7 @@ def greedy_contour_segmentation_into_slices(cnt, template_contour):
         slices.append(cnt)
     else:
         while (len(cnt) > 3) and (cnt_area >= 1.5 * template_area):
-            (cnt1, cnt2) = best_split_in_two(cnt, template_contour)
+            (cnt1, cnt2) = best_split_in_two(cnt, template_contour, template_descriptors)
             slices.append(cnt1)
             cnt = cnt2
             cnt_area = cv2.contourArea(cnt)
@@ -169,70 +277,222 @@ def greedy_contour_segmentation_into_slices(cnt, template_contour):
 
     return (None, slices)
 
-# Returns a (cost value, list of slice contours) for the
-# optimal split of cnt into contours of the slices
-@memory.cache
-def best_contour_segmentation_into_slices(cnt, template_slice_contour):
-
-    cost_nosplit = difference(cnt, template_slice_contour)
-
-    best_cost = cost_nosplit
-    best_split = [cnt]
-
+class SegmentationTimeout(Exception):
+    """Raised when the optimal segmentation of a contour takes longer than allowed."""
+    pass
+
+# Returns a (cost value, list of slice contours) for the optimal split of cnt into contours of the slices.
+# The contour is split by a sequence of nested cuts between concave vertices, each slice lies between two consecutive cuts.
+# The optimal sequence is found by dynamic programming over the cuts, filled in on demand starting from the whole contour
+# (with an explicit stack instead of recursion), where lower bounds on the slice costs rule out most candidate cuts.
+# max_slices is the maximum number of slices (None for no maximum); if the segmentation takes longer than timeout seconds
+# (None for no maximum), SegmentationTimeout is raised.
+def best_contour_segmentation_into_slices(cnt, template_slice_contour, max_slices=None, timeout=None):
     num_points = len(cnt)
-    if num_points > 120:
-        return (best_cost, best_split)
-
-    # Note: A possible performance improvement is to assume no ribbon contains more than x slices,
-    #       and to not try to subdivide any further if we've hit x slices already.
-
-    # Try out all pairs of vertices as a split line
-    for i in range(0, num_points):   # i = 0, 1, ..., num_points-1
-        for j in range(0, i):        # j = 0, 1, ..., i - 1
-            if (abs(i-j) == 1) or (abs(i-j) == num_points - 1):
-                continue  # skip, this wouldn't really cut off anything
-
-            if (not is_concave(cnt, i)) or (not is_concave(cnt, j)):
-                continue
-
-            chunk1 = extract_subcontour(cnt, i, j)
-            chunk2 = extract_subcontour(cnt, j, i)
-
-            # Assume the first contour is a single slice.
-            # (we don't lose generality because all possible chunks are considered, so also the chunk that is a single slice)
-            cost1 = difference(chunk1, template_slice_contour)
-            slices1 = [chunk1]
-
-            if cost1 >= best_cost:
-                continue
-
-            (cost2, slices2) = best_contour_segmentation_into_slices(chunk2, template_slice_contour)
-            if cost1 + cost2 < best_cost:
-                best_cost = cost1 + cost2
-                best_split = slices1 + slices2
-
-    return (best_cost, best_split)
+    deadline = None if timeout is None else time.time() + timeout
+    descriptors = ChunkDescriptors(cnt, get_contour_descriptors(template_slice_contour))
+
+    # Only concave vertices are considered as endpoints of a cut line (the trapezoid slice shape implies inward corners
+    # between consecutive slices); and the first and last vertex because they are the endpoints of the initial vertex
+    # range (0..num_points-1 is the whole contour).
+    candidate_vertices = np.array([v for v in range(num_points) if v == 0 or v == num_points - 1 or descriptors.concave[v]])
+
+    # The cuts (j, i): pairs of candidate vertices that do not lie next to each other, and last the whole contour.
+    starts, ends = np.triu_indices(len(candidate_vertices), 1)
+    starts, ends = candidate_vertices[starts], candidate_vertices[ends]
+    keep = (ends - starts >= 2) & ((starts > 0) | (ends < num_points - 1))
+    starts, ends = np.append(starts[keep], 0), np.append(ends[keep], num_points - 1)
+    num_cuts = len(starts)
+    whole_contour = num_cuts - 1
+
+    twice_areas = descriptors.twice_signed_range_areas(starts, ends).astype(np.float64)
+    start_concave = descriptors.endpoint_concavities(starts, ends, starts)  # whether j is concave in range j..i
+    end_concave = descriptors.endpoint_concavities(starts, ends, ends)
+    single_slice_costs = np.array([descriptors.difference(cnt[j:i + 1], descriptors.range_area(j, i)) for j, i in zip(starts.tolist(), ends.tolist())])
+
+    # The cuts sorted on area, for looking up the ones that cut off a slice with a given area
+    area_order = np.argsort(twice_areas)
+    sorted_twice_areas = twice_areas[area_order]
+
+    starts_list, ends_list = starts.tolist(), ends.tolist()
+    chunk_costs = {}  # (outer cut, inner cut) -> cost of the slice between them
+
+    # The tables of the dynamic program: for each maximum number of slices (None for no maximum) the cost of the
+    # optimal segmentation of each range, its first cut (-1 for no cut), and whether these were calculated yet.
+    # Only the entries that are needed for the whole contour are calculated. Until then, the cost is a lower bound
+    # (see table()), or the cost of the unrestricted optimal segmentation when that is known.
+    tables = {None: (np.zeros(num_cuts), np.full(num_cuts, -1, dtype = int), np.zeros(num_cuts, dtype = bool)),
+              1: (single_slice_costs, np.full(num_cuts, -1, dtype = int), np.ones(num_cuts, dtype = bool))}
+    num_slices = np.zeros(num_cuts, dtype = int)  # the number of slices of the unrestricted optimal segmentations
+    unrestricted_costs, unrestricted_cuts, unrestricted_known = tables[None]
+
+    def table(max_slices):
+        if max_slices not in tables:
+            # The slices of a range have a total area of at least that of the range. If that is more than max_slices times
+            # the template area, the difference in area alone costs at least as much as max_slices equal slices.
+            lower_bounds = np.maximum(np.sqrt(np.abs(twice_areas) * 0.5) - math.sqrt(max_slices) * descriptors.template_areasqrt, 0)**2 * (1 - 1e-9)
+            tables[max_slices] = (lower_bounds, np.full(num_cuts, -1, dtype = int), np.zeros(num_cuts, dtype = bool))
+        return tables[max_slices]
+
+    def known_cost(cut, max_slices):
+        # Returns the cost of the optimal segmentation of the range of the cut into at most max_slices slices, or None
+        # if it is not calculated yet. A range whose unrestricted optimal segmentation has at most max_slices slices
+        # is segmented the same way.
+        costs, cuts, known = table(max_slices)
+        if not known[cut] and max_slices is not None and unrestricted_known[cut] and num_slices[cut] <= max_slices:
+            costs[cut], cuts[cut], known[cut] = unrestricted_costs[cut], unrestricted_cuts[cut], True
+        return costs[cut] if known[cut] else None
+
+    def best_segmentation(outer, max_slices):
+        # Generator for the optimal segmentation of the range of cut 'outer' into at most max_slices slices (at least 2).
+        # When the cost of the optimal segmentation of a nested cut is needed and not known yet, it yields ('need', cut)
+        # and expects the cost to be sent back. Finally it yields ('done', cost, inner cut or -1 for no cut).
+        start, end = starts_list[outer], ends_list[outer]
+        inner_max_slices = None if max_slices is None else max_slices - 1
+        inner_costs, _, inner_known = table(inner_max_slices)
+        best_cost = single_slice_costs[outer]
+        best_cut = -1
+        best_cut_order = None
+        # Look up the candidate inner cuts in two rounds: first the ones whose slice has about the same area as the template,
+        # then (only if the best cost found is still too large to rule them out) the ones whose slice area differs more.
+        radius = 0.1 * descriptors.template_areasqrt + 1.0
+        for previous_bound, bound in ((-1.0, radius**2), (radius**2, float('inf'))):
+            if previous_bound >= best_cost:
+                break
+            if bound == float('inf'):
+                radius = math.sqrt(best_cost) * (1 + 1e-9) + 1e-9  # the area difference alone rules out everything outside
+            candidates = _cuts_in_area_band(sorted_twice_areas, area_order, twice_areas[outer], descriptors.template_areasqrt, radius)
+            j = starts[candidates]
+            i = ends[candidates]
+            nested = ((j >= start) & (i <= end) & ((j > start) | (i < end)) &
+                      ((j > start) | start_concave[outer]) & ((i < end) | end_concave[outer]))
+            candidates = candidates[nested]
+            areas = np.abs(twice_areas[outer] - twice_areas[candidates]) * 0.5
+            area_costs = (descriptors.template_areasqrt - np.sqrt(areas))**2
+            candidate_inner_costs = np.maximum(inner_costs[candidates], unrestricted_costs[candidates])
+            keep = (area_costs <= bound) & (area_costs > previous_bound) & (area_costs + candidate_inner_costs <= best_cost * (1 + 1e-12))
+            candidates = candidates[keep]
+            areas = areas[keep]
+            candidate_inner_costs = candidate_inner_costs[keep]
+            lower_bounds = descriptors.chunk_difference_lower_bounds(start, end, starts[candidates], ends[candidates], areas) + candidate_inner_costs
+            order = np.argsort(lower_bounds, kind = 'mergesort')
+            for lower_bound, inner, area in zip(lower_bounds[order].tolist(), candidates[order].tolist(), areas[order].tolist()):
+                if lower_bound > best_cost * (1 + 1e-12):
+                    break
+                j, i = starts_list[inner], ends_list[inner]
+                cost1 = chunk_costs.get((outer, inner))
+                if cost1 is None:
+                    cost1 = chunk_costs[(outer, inner)] = descriptors.difference(_cut_off_chunk(cnt, start, end, j, i), area)
+                inner_cost = max(inner_costs[inner], unrestricted_costs[inner])
+                if cost1 + inner_cost > best_cost * (1 + 1e-12):
+                    continue
+                if not inner_known[inner]:
+                    inner_cost = yield ('need', inner)
+                cost = cost1 + inner_cost
+                # On a tie, prefer no cut, and otherwise the cut with the lowest (i, j)
+                if cost < best_cost or (cost == best_cost and best_cut >= 0 and (i, j) < best_cut_order):
+                    best_cost, best_cut, best_cut_order = cost, inner, (i, j)
+        yield ('done', best_cost, best_cut)
+
+    def solve(cut, max_slices):
+        # Calculates the table entry for the optimal segmentation of the range of the cut into at most max_slices slices,
+        # and all entries it depends on, with an explicit stack of best_segmentation() generators instead of recursion.
+        if known_cost(cut, max_slices) is not None:
+            return
+        stack = [(cut, max_slices, best_segmentation(cut, max_slices))]
+        sent = None
+        while stack:
+            if deadline is not None and time.time() > deadline:
+                raise SegmentationTimeout()
+            outer, max_slices, steps = stack[-1]
+            step = steps.send(sent)
+            if step[0] == 'need':
+                inner, inner_max_slices = step[1], None if max_slices is None else max_slices - 1
+                sent = known_cost(inner, inner_max_slices)
+                if sent is None:
+                    stack.append((inner, inner_max_slices, best_segmentation(inner, inner_max_slices)))
+            else:
+                stack.pop()
+                costs, cuts, known = table(max_slices)
+                _, costs[outer], cuts[outer] = step
+                known[outer] = True
+                if max_slices is None:
+                    num_slices[outer] = 1 if cuts[outer] < 0 else 1 + num_slices[cuts[outer]]
+                sent = costs[outer]
+
+    solve(whole_contour, None)
+    if max_slices is not None and num_slices[whole_contour] > max_slices:
+        max_slices = max(max_slices, 1)
+        solve(whole_contour, max_slices)
+    else:
+        max_slices = None
+    best_cost = table(max_slices)[0][whole_contour]
 
-def segment_contours_into_slices(contours, template_slice_contour, junk_contours = [], greedy = False):
+    # Collect the slices of the best segmentation by following the cuts
+    slices = []
+    outer = whole_contour
+    while True:
+        cut = table(max_slices)[1][outer]
+        start, end = starts_list[outer], ends_list[outer]
+        if cut < 0:
+            slices.append(cnt if outer == whole_contour else cnt[start:end + 1])
+            break
+        slices.append(_cut_off_chunk(cnt, start, end, starts_list[cut], ends_list[cut]))
+        outer = cut
+        if max_slices is not None:
+            max_slices -= 1
+
+    return (float(best_cost), slices)
+
+def _cuts_in_area_band(sorted_twice_areas, area_order, outer_twice_area, template_areasqrt, radius):
+    # Returns the indices of the cuts that cut off a chunk with an area between (template_areasqrt - radius)**2 and
+    # (template_areasqrt + radius)**2 from a range with the given twice signed area (with a margin for rounding errors).
+    low = max(template_areasqrt - radius, 0.0)**2 * 2
+    high = (template_areasqrt + radius)**2 * 2
+    margin = 1e-9 * (abs(outer_twice_area) + high) + 1.0
+    bands = [(outer_twice_area - high - margin, outer_twice_area - low + margin),
+             (outer_twice_area + low - margin, outer_twice_area + high + margin)]
+    return np.concatenate([area_order[np.searchsorted(sorted_twice_areas, a):np.searchsorted(sorted_twice_areas, b, side = 'right')] for a, b in bands])
+
+def _cut_off_chunk(cnt, start, end, j, i):
+    # Returns the chunk that is cut off from the contour formed by vertex range start..end of cnt by the line between vertices j and i
+    # (start <= j < i <= end): vertices i, i+1, ..., end, start, start+1, ..., j.
+    # (This is extract_subcontour(cnt[start:end + 1], i - start, j - start).)
+    return np.concatenate((cnt[i:end + 1], cnt[start:j + 1]))
+
+def segment_contours_into_slices(contours, template_slice_contour, junk_contours = [], greedy = False, max_slices_per_ribbon = None,
+                                 num_processes = 1, timeout = None, timing_callback = None):
     """Returns a list of ribbons, where each ribbon is a list of slice contours.
+    The ribbons are in the same order as their contours, but the contours in junk_contours (a list of indices) are skipped.
     The list of slice contours in each ribbon is ordered in the same order they are physically connected.
+    max_slices_per_ribbon is the maximum number of slices in a ribbon (or None for no maximum); it is ignored by the greedy algorithm.
+    num_processes is the number of worker processes that segment ribbons concurrently; 1 to segment the ribbons one after
+    another in this process, or None to use as many processes as there are CPU cores.
+    timeout is the maximum time in seconds for the optimal segmentation of a ribbon (or None for no maximum);
+    a ribbon that takes longer is segmented with the greedy algorithm instead.
+    timing_callback is a function(contour_index, num_vertices, num_slices, seconds, timed_out) that is called
+    (on the calling thread) for each ribbon when it is segmented, in the same order as the contours.
     """
-    ribbons = []
+    indices = [i for i in range(len(contours)) if i not in junk_contours]
+    tasks = [(contours[i], template_slice_contour, greedy, max_slices_per_ribbon, timeout) for i in indices]
 
-    num_contours = len(contours)
-    for i, cnt in enumerate(contours):
-        print('Processing contour {}/{} ({} vertices)'.format(i, num_contours-1, len(cnt)))
-        if i in junk_contours:
-            print('   Skipped')
-        else:
-            t0 = time.clock()
-            if greedy:
-                (_, new_ribbon) = greedy_contour_segmentation_into_slices(cnt, template_slice_contour)
-            else:
-                (_, new_ribbon) = best_contour_segmentation_into_slices(cnt, template_slice_contour)
+    if num_processes == 1:
+        results = (_segment_contour_task(task) for task in tasks)
+        pool = None
+    else:
+        pool = multiprocessing.Pool(num_processes)
+        results = pool.imap(_segment_contour_task, tasks)  # imap returns the results in the same order as the tasks
+
+    ribbons = []
+    try:
+        for i, (new_ribbon, seconds, timed_out) in zip(indices, results):
             ribbons.append(new_ribbon)
-            t1 = time.clock()
-            print('   {} slice(s), {:.1f} sec'.format(len(new_ribbon), t1-t0))
+            if timing_callback is not None:
+                timing_callback(i, len(contours[i]), len(new_ribbon), seconds, timed_out)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
 
     # At this point the slices in each ribbon are ordered randomly.
     # We now reorder them so that consecutive slices in the ribbon are also
@@ -241,6 +501,22 @@ def segment_contours_into_slices(contours, template_slice_contour, junk_contours
 
     return ribbons
 
+def _segment_contour_task(task):
+    # Segments a single contour (possibly in a worker process).
+    # Returns the slice contours, the time it took, and whether the optimal segmentation timed out.
+    cnt, template_slice_contour, greedy, max_slices, timeout = task
+    start_time = time.time()
+    timed_out = False
+    if greedy:
+        (_, new_ribbon) = greedy_contour_segmentation_into_slices(cnt, template_slice_contour)
+    else:
+        try:
+            (_, new_ribbon) = best_contour_segmentation_into_slices(cnt, template_slice_contour, max_slices, timeout)
+        except SegmentationTimeout:
+            timed_out = True
+            (_, new_ribbon) = greedy_contour_segmentation_into_slices(cnt, template_slice_contour)
+    return new_ribbon, time.time() - start_time, timed_out
+
 # def order_slices_sequentially(ribbon):
 #     """Given a ribbon (an unordered list of slices), it returns
 #     the same ribbon but with the slices ordered sequentially. (In the same order that the slices are connected physically).
@@ -353,7 +629,10 @@ def segment_image(filename, threshold = 128, min_contour_area = 0, contour_simpl
     # display(imgc, 'Detected contours')
 
     # Isolate the individual slices
-    ribbons = segment_contours_into_slices(simple_contours, template_contour, junk_contours, greedy)
+    def print_timing(contour_index, num_vertices, num_slices, seconds, timed_out):
+        print('Contour {}/{} ({} vertices): {} slice(s), {:.1f} sec{}'.format(contour_index, len(simple_contours) - 1, num_vertices, num_slices, seconds,
+                                                                              ' (timed out, greedy segmentation)' if timed_out else ''))
+    ribbons = segment_contours_into_slices(simple_contours, template_contour, junk_contours, greedy, timing_callback = print_timing)
 
     # Flatten the list with ribbons with slices, into a list of slices.
     slices = [slice for ribbon in ribbons for slice in ribbon]
@@ -1,5 +1,7 @@
 import wx
 import cv2
+import threading
+import traceback
 import polygon_simplification
 import tools
 
@@ -8,12 +10,17 @@ from ribbons_mask_dialog import RibbonsMaskDialog
 
 # WORK IN PROGRESS - WORK IN PROGRESS - WORK IN PROGRESS - WORK IN PROGRESS
 
+# Maximum time (in seconds) for the optimal segmentation of a single ribbon into slices.
+# Ribbons that take longer are segmented with the (much faster, but less accurate) greedy algorithm instead.
+RIBBON_SEGMENTATION_TIMEOUT = 120
+
 class SegmentationPanel(wx.Panel):
     _canvas = None
     _model = None
 
     # user interface
     done_button = None
+    _load_button = None
     _segment_button = None
     _save_button = None
 
@@ -42,13 +49,13 @@ class SegmentationPanel(wx.Panel):
         button_size = (175, -1)
         self.done_button = wx.Button(self, wx.ID_ANY, "Done", size=button_size)  # The ApplicationFame will listen to clicks on this button.
 
-        load_button = wx.Button(self, wx.ID_ANY, "Load Mask and Template", size=button_size)
+        self._load_button = wx.Button(self, wx.ID_ANY, "Load Mask and Template", size=button_size)
         self._segment_button = wx.Button(self, wx.ID_ANY, "Segment", size=button_size)
         self._segment_button.Enable(False)
         self._save_button = wx.Button(self, wx.ID_ANY, "Save", size=button_size)
         self._save_button.Enable(False)
 
-        self.Bind(wx.EVT_BUTTON, self._on_load_button_click, load_button)
+        self.Bind(wx.EVT_BUTTON, self._on_load_button_click, self._load_button)
         self.Bind(wx.EVT_BUTTON, self._on_segment_button_click, self._segment_button)
         self.Bind(wx.EVT_BUTTON, self._on_save_button_click, self._save_button)
 
@@ -57,7 +64,7 @@ class SegmentationPanel(wx.Panel):
         contents.Add(title, 0, wx.ALL | wx.EXPAND, border=b)
         contents.Add(separator, 0, wx.ALL | wx.EXPAND, border=b)
         contents.Add(instructions_label, 0, wx.ALL | wx.EXPAND, border=b)
-        contents.Add(load_button, 0, wx.ALL | wx.CENTER, border=b)
+        contents.Add(self._load_button, 0, wx.ALL | wx.CENTER, border=b)
         contents.Add(self._segment_button, 0, wx.ALL | wx.CENTER, border=b)
         contents.Add(self._save_button, 0, wx.ALL | wx.CENTER, border=b)
         contents.Add(self.done_button, 0, wx.ALL | wx.CENTER, border=b)
@@ -116,20 +123,46 @@ class SegmentationPanel(wx.Panel):
         print('Simplifying ribbon contours. May be slow, please be patient.')
         wait = wx.BusyInfo("Simplifying contours. Please wait...")
         green = (0, 255, 0)
-        simplified_ribbons = []
+        desired_num_vertices = []
         for ribbon in ribbons:
             estimated_num_slices_in_ribbon = round(tools.polygon_area(ribbon) / tools.polygon_area(self._template_slice_contour))
             print('Estimated number of slices in ribbon: {}'.format(estimated_num_slices_in_ribbon))
             desired_num_vertices_in_ribbon = estimated_num_slices_in_ribbon * 5  # we want at least 4 points per slice, plus some extra to handle accidental dents in the slice shape
-            simplified_ribbon = polygon_simplification.reduce_polygon(ribbon, desired_num_vertices_in_ribbon)
-            simplified_ribbons.append(simplified_ribbon)
+            desired_num_vertices.append(desired_num_vertices_in_ribbon)
+        simplified_ribbons = polygon_simplification.reduce_polygons(ribbons, desired_num_vertices, num_processes = None)  # the ribbons are simplified concurrently
         del wait
 
-        # Perform greedy/optimal split of ribbon
-        wait = wx.BusyInfo("Segmenting ribbons into slices. Please wait...")
+        # Perform greedy/optimal split of ribbon.
+        # The ribbons are segmented concurrently by worker processes. This is done on a background thread,
+        # so the user interface stays responsive; the result is handled in _segmentation_done().
+        print('Segmenting {} ribbons into slices...'.format(len(simplified_ribbons)))
         simplified_ribbons_opencv = [tools.list_to_opencv_contour(rib) for rib in simplified_ribbons]
-        rbns = segment_contours_into_slices(simplified_ribbons_opencv, self._template_slice_contour, junk_contours = [], greedy = False)
-        del wait
+        self._enable_buttons(False)
+        thread = threading.Thread(target=self._segment_ribbons, args=(simplified_ribbons_opencv,))
+        thread.daemon = True
+        thread.start()
+
+    def _segment_ribbons(self, ribbons):
+        # Runs on a background thread.
+        rbns = None
+        try:
+            rbns = segment_contours_into_slices(ribbons, self._template_slice_contour, junk_contours = [], greedy = False,
+                                                num_processes = None, timeout = RIBBON_SEGMENTATION_TIMEOUT,
+                                                timing_callback = lambda *timing: wx.CallAfter(self._ribbon_segmented, len(ribbons), *timing))
+        except Exception:
+            traceback.print_exc()
+        finally:
+            wx.CallAfter(self._segmentation_done, rbns)
+
+    def _ribbon_segmented(self, num_ribbons, ribbon_index, num_vertices, num_slices, seconds, timed_out):
+        print('Ribbon {}/{} ({} vertices): {} slice(s), {:.1f} sec{}'.format(ribbon_index + 1, num_ribbons, num_vertices, num_slices, seconds,
+                                                                             ' (optimal segmentation timed out, segmented greedily)' if timed_out else ''))
+
+    def _segmentation_done(self, rbns):
+        if rbns is None:
+            print('Segmentation failed')
+            self._enable_buttons(True)
+            return
 
         # Merge slices of each ribbon in one single list of slices
         slices = [tools.opencv_contour_to_list(slc) for rbn in rbns for slc in rbn]  # Flatten the list with ribbons with slices, into a list of slices.
@@ -142,7 +175,7 @@ class SegmentationPanel(wx.Panel):
         acute_threshold_radians = 0 # 30 * math.pi / 180.0
         simplify_slices = True
         if simplify_slices:
-            slices = [polygon_simplification.reduce_polygon(slice, 4, acute_threshold_radians) for slice in slices]
+            slices = polygon_simplification.reduce_polygons(slices, 4, acute_threshold_radians)  # in this process, the slices have only a few vertices
             self._slices = slices  # only allow saving the slice contours if each slice has exactly 4 vertices
 
         # Show each slice, with slice numbers
@@ -151,7 +184,8 @@ class SegmentationPanel(wx.Panel):
             self._canvas.seg_add_text(str(i), tools.polygon_center(slice), "Red", font_size = 100)
         self._canvas.redraw()
 
-        self._segment_button.Enable(False)
+        self._load_button.Enable(True)
+        self.done_button.Enable(True)
         self._save_button.Enable(self._slices is not None)
 
         print('...Segmentation done...')
@@ -164,6 +198,12 @@ class SegmentationPanel(wx.Panel):
         # 5: simplify each split slice to exactly 4 points (some may have a few more)
         # 6: save slice outlines to JSON for later use
 
+    def _enable_buttons(self, enable):
+        # (Dis)allow the user to start something else while the ribbons are being segmented.
+        self._load_button.Enable(enable)
+        self._segment_button.Enable(enable)
+        self.done_button.Enable(enable)
+
     def _on_save_button_click(self, event):
         defaultDir = ''
         defaultFile = 'slices.json'
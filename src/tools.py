@@ -11,6 +11,11 @@ import subprocess
 # so we can use the exist_ok parameter of mkdir()
 from pathlib2 import Path
 
+# The image file I/O, conversion and histogram functions do not depend on wxPython, they are in image_tools
+# (so they can be used without a GUI), but they are available here as well.
+from image_tools import (grayscale_image_16bit_to_8bit, grayscale_image_float_to_8bit, read_image_as_grayscale, save_image,
+                         intensity_histogram, histogram_percentiles, intensity_percentiles)
+
 # # Some useful colors (in BGR) for OpenCV
 # red = (0, 0, 255)
 # yellow = (0, 255, 255)
@@ -56,25 +61,6 @@ def list_to_opencv_contour(coords_list):
     return np.expand_dims(np.asarray(coords_list), axis = 1)
 
 
-def grayscale_image_16bit_to_8bit(image):
-    # Convert a 16-bit OpenCV grayscale image to 8-bit.
-    # The full 16-bit range is mapped onto 0 to 255.
-    assert image.dtype == np.uint16
-    return (image / 257).astype(np.uint8)  # Note: 65535 = 255 * 257 (exactly)
-
-
-def grayscale_image_float_to_8bit(image):
-    # Convert a floating point OpenCV grayscale image to 8-bit.
-    # The range between the lowest and the highest floating point pixel intensity
-    # is mapped linearly onto 0 to 255.
-    assert image.dtype == np.float
-    min_val = np.min(image)
-    max_val = np.max(image)
-    # linearly map min to max -> 0 to 255
-    image = ((image - min_val) / (max_val - min_val) * 255).astype(np.uint8)
-    return image
-
-
 def wx_bitmap_from_OpenCV_image(image):
     """
     :param image: an grayscale OpenCV image (i.e a 2D numpy array)
@@ -83,7 +69,7 @@ def wx_bitmap_from_OpenCV_image(image):
     assert len(image.shape) == 2  # image must be a single channel, so shape is only (rows, cols)
     if image.dtype == np.uint16:
         image = grayscale_image_16bit_to_8bit(image)
-    elif image.dtype == np.float:
+    elif image.dtype == np.float64 or image.dtype == np.float32:
         image = grayscale_image_float_to_8bit(image)
     else:
         assert image.dtype == np.uint8
@@ -114,30 +100,6 @@ def read_image_as_color_image(filename):
     return img
 
 
-def read_image_as_grayscale(filename, flags=cv2.IMREAD_GRAYSCALE):
-    """
-    Reads an image file and returns it as an OpenCV image object.
-    This may be preferable over reading it through wxPython since (I think) wxPython expands grayscale images to RGB,
-    and this is not ideal since we are dealing with potentially large images.
-    :param filename: full file path of the image to read
-    :param flags: XXX e.g. cv2.IMREAD_GRAYSCALE to convert image to grayscale after reading;
-                           cv2.IMREAD_ANYDEPTH to preserve 16-bit images as 16-bit (otherwise we get 8-bit automatically)
-    :return: An OpenCV grayscale image object, or None on error.
-             The image is indexed like this: img[y, x].
-    """
-    img = cv2.imread(filename, flags)
-    return img
-
-def save_image(image, filename):
-    """
-    :param image: the image data as a numpy array (8-bit and 16-bit grayscale images are supported, when saving to TIFF)
-    :param filename: filename to save the image to; extension determines the file format type
-    :return: True if saving was successful, False otherwise
-    """
-    assert len(image.shape) == 2  # only grayscale has been tested
-    return cv2.imwrite(filename, image)
-
-
 def sample_image(image, pos):
     """
     Returns the pixel value in the image at a given position. The position can be specified with sub-pixel accuracy,
@@ -180,6 +142,43 @@ def sample_image(image, pos):
     return val
 
 
+def sample_image_at_positions(image, positions):
+    """
+    Vectorized version of sample_image(): returns the bilinearly interpolated pixel values in the image at many positions at once.
+    The result is numerically identical to calling sample_image() on each position in turn, but avoids the Python loop.
+    :param image: an OpenCV grayscale image, image[0][0] is the top left pixel, the first index is the y-coordinate, y-axis points down
+    :param positions: an m x 2 numpy array with the (x, y) positions in the image; x and y are floating point. (The array is not modified.)
+    :return: a numpy array with the m (interpolated) pixel values, as floating point
+    """
+
+    # Clip positions to image boundaries (see sample_image() for the reason for eps)
+    eps = 1e-4
+    image_height, image_width = image.shape
+    x = np.maximum(0, np.minimum(positions[:, 0], image_width-1-eps))
+    y = np.maximum(0, np.minimum(positions[:, 1], image_height-1-eps))
+
+    # Find interpolation factors
+    x_left = x.astype(np.intp)
+    y_top = y.astype(np.intp)
+
+    x_right = x_left + 1
+    y_bottom = y_top + 1
+
+    x_fraction = x - x_left
+    y_fraction = y - y_top
+
+    # Gather the 4 surrounding pixels of each position, as float for safe calculations
+    val_tl = image[y_top, x_left].astype(np.float64)
+    val_tr = image[y_top, x_right].astype(np.float64)
+    val_bl = image[y_bottom, x_left].astype(np.float64)
+    val_br = image[y_bottom, x_right].astype(np.float64)
+
+    # Bilinear interpolation
+    val_top    = val_tl + x_fraction * (val_tr - val_tl)
+    val_bottom = val_bl + x_fraction * (val_br - val_bl)
+    return val_top + y_fraction * (val_bottom - val_top)
+
+
 def polygon_area(polygon):  # polygon is a list of (x,y) coordinates
     pts = np.asarray(polygon).astype(np.float)
     pts = np.vstack([pts, pts[0]])  # close the polygon (TODO: check if open or not, or document requirement for open)
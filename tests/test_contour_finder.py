@@ -0,0 +1,37 @@
+import os
+import sys
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from contour_finder import ContourFinder, contour_to_vector
+
+
+def _blurred_edge_image():
+    # Synthetic preprocessed overview image: the bright outline of a rectangular slice, blurred so the contour score
+    # increases smoothly towards the edge, as it does in real preprocessed images.
+    image = np.zeros((300, 400), dtype=np.float32)
+    cv2.rectangle(image, (100, 80), (300, 220), 255.0, 3)
+    return cv2.GaussianBlur(image, (0, 0), 10)
+
+
+def test_analytic_gradient_matches_finite_difference_gradient():
+    image = _blurred_edge_image()
+    contour_finder = ContourFinder()
+    contour_finder.edge_sample_distance = 5.0
+    contour_finder.h_for_gradient_approximation = 0.01  # small h, so the forward difference is accurate
+
+    # Contours near (but not on) the slice outline, where the score gradient is large.
+    contours = [[(90, 70), (310, 75), (305, 230), (95, 225)],
+                [(112, 91), (289, 88), (292, 209), (108, 212)],
+                [(104.5, 83.25), (296.75, 84.5), (295.5, 215.75), (103.25, 216.5)]]
+    contour_vectors = np.array([contour_to_vector(contour) for contour in contours])
+
+    analytic = contour_finder._calculate_analytic_gradients(image, contour_vectors)
+    finite_difference = contour_finder._calculate_finite_difference_gradients(image, contour_vectors)
+
+    # The analytic gradient uses Sobel image derivatives instead of the exact derivative of the bilinearly interpolated
+    # image, so both gradients agree only approximately: we allow a 5% error relative to the gradient magnitude.
+    for a, f in zip(analytic, finite_difference):
+        assert np.linalg.norm(a - f) <= 0.05 * np.linalg.norm(f)
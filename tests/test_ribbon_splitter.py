@@ -0,0 +1,97 @@
+import os
+import sys
+import math
+import cv2
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from ribbon_splitter import best_contour_segmentation_into_slices, difference, extract_subcontour, is_concave
+
+
+def _reference_segmentation(cnt, template_contour, max_slices=None, memo=None):
+    # The straightforward recursion that best_contour_segmentation_into_slices() replaces: cut off a chunk between two
+    # concave vertices as a slice, and segment the rest recursively. With max_slices, the rest gets one slice less.
+    if memo is None:
+        memo = {}
+    key = (cnt.tobytes(), len(cnt), max_slices)
+    if key in memo:
+        return memo[key]
+
+    best_cost = difference(cnt, template_contour)
+    best_split = [cnt]
+    num_points = len(cnt)
+    if max_slices is None or max_slices > 1:
+        for i in range(0, num_points):
+            for j in range(0, i):
+                if (abs(i - j) == 1) or (abs(i - j) == num_points - 1):
+                    continue
+                if (not is_concave(cnt, i)) or (not is_concave(cnt, j)):
+                    continue
+
+                chunk1 = extract_subcontour(cnt, i, j)
+                chunk2 = extract_subcontour(cnt, j, i)
+                cost1 = difference(chunk1, template_contour)
+                if cost1 >= best_cost:
+                    continue
+
+                cost2, slices2 = _reference_segmentation(chunk2, template_contour, None if max_slices is None else max_slices - 1, memo)
+                if cost1 + cost2 < best_cost:
+                    best_cost = cost1 + cost2
+                    best_split = [chunk1] + slices2
+
+    memo[key] = (best_cost, best_split)
+    return best_cost, best_split
+
+
+def _synthetic_ribbon(num_slices, seed, angle, slice_width=60, slice_height=40, notch=4):
+    # Returns the (simplified) outline of a ribbon of num_slices trapezoid-like slices, with small notches between
+    # the slices, rotated over the given angle; and the contour of a template slice.
+    rng = np.random.RandomState(seed)
+    image = np.zeros((800, 300 + num_slices * slice_width), dtype=np.uint8)
+    top, bottom = [], []
+    for k in range(num_slices + 1):
+        x = 50 + k * slice_width + rng.uniform(-3, 3)
+        if 0 < k < num_slices:
+            top += [(x - 5, 300), (x, 300 + notch), (x + 5, 300)]
+            bottom += [(x - 5, 300 + slice_height), (x, 300 + slice_height - notch), (x + 5, 300 + slice_height)]
+        else:
+            top += [(x, 300)]
+            bottom += [(x, 300 + slice_height)]
+    points = np.array(top + bottom[::-1], dtype=np.float64)
+    c, s = math.cos(angle), math.sin(angle)
+    points = (points - points.mean(axis=0)).dot([[c, s], [-s, c]]) + [image.shape[1] / 2.0, 400]
+    cv2.fillPoly(image, [points.astype(np.int32).reshape(-1, 1, 2)], 255)
+    contours = cv2.findContours(image, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)[-2]  # OpenCV 3 returns 3 values, OpenCV 4 only 2
+    ribbon = max(contours, key=cv2.contourArea)
+    template = np.array([[[0, 0]], [[slice_width, 0]], [[slice_width, slice_height]], [[0, slice_height]]])
+    return cv2.approxPolyDP(ribbon, 1.5, True), template
+
+
+def _assert_same_segmentation(result, expected):
+    cost, slices = result
+    expected_cost, expected_slices = expected
+    assert cost == pytest.approx(expected_cost, rel=1e-9)
+    assert len(slices) == len(expected_slices)
+    for slice_contour, expected_slice_contour in zip(slices, expected_slices):
+        assert np.array_equal(slice_contour, expected_slice_contour)
+
+
+RIBBONS = [(num_slices, seed, angle) for num_slices in (1, 2, 3, 5, 8) for seed, angle in ((0, 0.3), (1, 1.0), (2, 2.5), (3, -0.7))]
+
+
+@pytest.mark.parametrize('num_slices, seed, angle', RIBBONS)
+def test_segmentation_matches_reference_recursion(num_slices, seed, angle):
+    ribbon, template = _synthetic_ribbon(num_slices, seed, angle)
+    _assert_same_segmentation(best_contour_segmentation_into_slices(ribbon, template),
+                              _reference_segmentation(ribbon, template))
+
+
+@pytest.mark.parametrize('num_slices, seed, angle', [ribbon for ribbon in RIBBONS if ribbon[0] >= 3])
+@pytest.mark.parametrize('max_slices', [1, 2, 3])
+def test_segmentation_with_max_slices_matches_reference_recursion(num_slices, seed, angle, max_slices):
+    ribbon, template = _synthetic_ribbon(num_slices, seed, angle)
+    _assert_same_segmentation(best_contour_segmentation_into_slices(ribbon, template, max_slices=max_slices),
+                              _reference_segmentation(ribbon, template, max_slices))
+